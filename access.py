@@ -0,0 +1,242 @@
+import logging
+import math
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Iterable
+
+from telegram.ext import filters
+
+from config import settings
+from database import delete_user, list_users, refund_daily_usage, take_daily_usage, upsert_user
+from metrics import RATE_LIMITED, UNAUTHORIZED
+
+logger = logging.getLogger(__name__)
+
+# Token bucket mỗi user: tối đa RATE_LIMIT_BURST câu hỏi liền nhau, hồi RATE_LIMIT_PER_MINUTE
+# câu mỗi phút; 0 để tắt. Admin không bị giới hạn.
+RATE_LIMIT_PER_MINUTE = settings.rate_limit_per_minute
+RATE_LIMIT_BURST = settings.rate_limit_burst
+# Số câu hỏi mỗi ngày (theo giờ máy chủ) của user thường; 0 để tắt. Ghi đè từng user bằng /adduser
+DAILY_QUOTA = settings.daily_quota
+# Log truy cập trái phép: mỗi user tối đa một dòng mỗi khoảng, toàn bộ tối đa vài dòng mỗi phút
+UNAUTHORIZED_LOG_INTERVAL = settings.unauthorized_log_interval
+_UNAUTHORIZED_LOG_PER_MINUTE = 10
+_UNAUTHORIZED_TRACKED = 1024
+
+ROLE_ADMIN = "admin"
+ROLE_USER = "user"
+ROLES = (ROLE_ADMIN, ROLE_USER)
+
+# Filter dùng chung cho mọi handler; tập user_id thay đổi tại chỗ khi thêm/bớt user
+# (filters.User kiểm tra bằng set, O(1), và an toàn khi sửa lúc bot đang chạy)
+allowed_users = filters.User(allow_empty=False)
+admin_users = filters.User(allow_empty=False)
+
+_users: dict[int, dict] = {}
+
+
+class TokenBucket:
+    """Token bucket: ``capacity`` token, hồi ``rate`` token mỗi giây."""
+
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Lấy một token. Trả về 0 nếu được, hoặc số giây phải chờ tới token kế tiếp."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+@dataclass
+class _DailyCounter:
+    day: str
+    questions: int
+
+
+_buckets: dict[int, TokenBucket] = {}
+_daily: dict[int, _DailyCounter] = {}
+
+
+def _apply(user: dict) -> None:
+    uid = user["telegram_user_id"]
+    _users[uid] = user
+    allowed_users.add_user_ids(uid)
+    if user["role"] == ROLE_ADMIN:
+        admin_users.add_user_ids(uid)
+    else:
+        admin_users.remove_user_ids(uid)
+
+
+async def load_users(bootstrap_admins: Iterable[int] = ()) -> None:
+    """Nạp danh sách user từ database vào filter. Gọi trong ``post_init``.
+
+    ``bootstrap_admins`` (``ALLOWED_USER_ID``) luôn được đảm bảo là admin, nên
+    database cũ (một user) vẫn chạy như trước mà không cần cấu hình thêm.
+    """
+    known = {u["telegram_user_id"]: u for u in await list_users()}
+    for uid in bootstrap_admins:
+        if known.get(uid, {}).get("role") != ROLE_ADMIN:
+            await upsert_user(uid, ROLE_ADMIN, known.get(uid, {}).get("daily_quota"))
+    for user in await list_users():
+        _apply(user)
+    admins = sum(1 for u in _users.values() if u["role"] == ROLE_ADMIN)
+    logger.info("Đã nạp %d user được phép (%d admin)", len(_users), admins)
+
+
+async def add_user(telegram_user_id: int, role: str = ROLE_USER, daily_quota: int | None = None,
+                   added_by: int | None = None) -> None:
+    """Thêm hoặc cập nhật user; có hiệu lực ngay với filter."""
+    if role not in ROLES:
+        raise ValueError(role)
+    await upsert_user(telegram_user_id, role, daily_quota, added_by)
+    previous = _users.get(telegram_user_id, {})
+    _apply({
+        "telegram_user_id": telegram_user_id,
+        "role": role,
+        "daily_quota": daily_quota,
+        "added_by": previous.get("added_by", added_by),
+        "added_at": previous.get("added_at"),
+    })
+    logger.info("User %d: role=%s quota=%s (bởi %s)", telegram_user_id, role, daily_quota, added_by)
+
+
+async def remove_user(telegram_user_id: int) -> bool:
+    """Thu hồi quyền của user; lịch sử chat vẫn giữ. Trả về False nếu user không có trong danh sách."""
+    removed = await delete_user(telegram_user_id)
+    _users.pop(telegram_user_id, None)
+    allowed_users.remove_user_ids(telegram_user_id)
+    admin_users.remove_user_ids(telegram_user_id)
+    _buckets.pop(telegram_user_id, None)
+    _daily.pop(telegram_user_id, None)
+    if removed:
+        logger.info("Đã thu hồi quyền của user %d", telegram_user_id)
+    return removed
+
+
+def get_user(telegram_user_id: int) -> dict | None:
+    return _users.get(telegram_user_id)
+
+
+def is_admin(telegram_user_id: int) -> bool:
+    return telegram_user_id in admin_users.user_ids
+
+
+def users_snapshot() -> list[dict]:
+    """Danh sách user (admin trước) kèm số câu hỏi hôm nay đã biết trong bộ nhớ."""
+    today = _today()
+    result = []
+    for uid, user in _users.items():
+        counter = _daily.get(uid)
+        result.append({**user, "questions_today": counter.questions if counter and counter.day == today else None})
+    return sorted(result, key=lambda u: (u["role"] != ROLE_ADMIN, u["telegram_user_id"]))
+
+
+def _today() -> str:
+    return time.strftime("%Y-%m-%d")
+
+
+def _quota_for(telegram_user_id: int) -> int:
+    user = _users.get(telegram_user_id) or {}
+    quota = user.get("daily_quota")
+    return DAILY_QUOTA if quota is None else quota
+
+
+async def check_request(telegram_user_id: int) -> str | None:
+    """Áp rate limit và hạn mức ngày cho một câu hỏi, trước khi xếp hàng gọi Perplexity.
+
+    Câu hỏi được chấp nhận thì được tính vào hạn mức ngày ngay; nếu sau đó nó không
+    được xếp hàng thì caller gọi ``refund_request``.
+
+    Returns:
+        None nếu được phép, ngược lại là thông báo từ chối cho người dùng.
+    """
+    if is_admin(telegram_user_id):
+        return None
+
+    if RATE_LIMIT_PER_MINUTE > 0:
+        bucket = _buckets.get(telegram_user_id)
+        if bucket is None:
+            bucket = _buckets[telegram_user_id] = TokenBucket(max(1, RATE_LIMIT_BURST), RATE_LIMIT_PER_MINUTE / 60)
+        wait = bucket.take()
+        if wait:
+            RATE_LIMITED.inc(reason="rate")
+            logger.info("Rate limit | user_id=%d | chờ %.1fs", telegram_user_id, wait)
+            return f"Bạn gửi hơi nhanh — vui lòng thử lại sau {math.ceil(wait)} giây."
+
+    quota = _quota_for(telegram_user_id)
+    if quota > 0:
+        today = _today()
+        counter = _daily.get(telegram_user_id)
+        # Bộ đếm trong bộ nhớ chỉ để từ chối nhanh; kiểm tra và cộng thật nằm trong một
+        # câu lệnh SQL (hai câu hỏi cùng lúc không thể cùng lọt qua lượt cuối)
+        used = None
+        if counter is None or counter.day != today or counter.questions < quota:
+            used = await take_daily_usage(telegram_user_id, today, quota)
+        _daily[telegram_user_id] = _DailyCounter(today, quota if used is None else used)
+        if used is None:
+            RATE_LIMITED.inc(reason="quota")
+            logger.info("Hết hạn mức ngày | user_id=%d | quota=%d", telegram_user_id, quota)
+            return f"Bạn đã dùng hết {quota} câu hỏi của hôm nay. Hạn mức được làm mới vào 0 giờ."
+    return None
+
+
+async def refund_request(telegram_user_id: int, day: str | None = None) -> None:
+    """Trả lại lượt hạn mức của một câu hỏi đã qua ``check_request`` nhưng không được trả lời.
+
+    Args:
+        telegram_user_id: ID của người dùng Telegram.
+        day: Ngày câu hỏi được tính (YYYY-MM-DD), mặc định hôm nay.
+    """
+    if is_admin(telegram_user_id) or _quota_for(telegram_user_id) <= 0:
+        return
+    day = day or _today()
+    counter = _daily.get(telegram_user_id)
+    if counter is not None and counter.day == day:
+        counter.questions = max(0, counter.questions - 1)
+    await refund_daily_usage(telegram_user_id, day)
+
+
+# user_id -> (lần log gần nhất, số update bị bỏ qua không log từ đó)
+_unauthorized_seen: OrderedDict[int | str, list] = OrderedDict()
+_unauthorized_log_bucket = TokenBucket(_UNAUTHORIZED_LOG_PER_MINUTE, _UNAUTHORIZED_LOG_PER_MINUTE / 60)
+
+
+def log_unauthorized(user_id: int | str) -> None:
+    """Ghi log update từ user không được phép, có giới hạn.
+
+    Mỗi user tối đa một dòng mỗi ``UNAUTHORIZED_LOG_INTERVAL`` giây (kèm số update đã
+    bỏ qua), và toàn bộ tối đa ``_UNAUTHORIZED_LOG_PER_MINUTE`` dòng mỗi phút, nên
+    spam từ một hay nhiều tài khoản không làm ngập log. Metric vẫn đếm mọi update.
+    """
+    UNAUTHORIZED.inc()
+    now = time.monotonic()
+    entry = _unauthorized_seen.get(user_id)
+    if entry is not None:
+        _unauthorized_seen.move_to_end(user_id)
+        if now - entry[0] < UNAUTHORIZED_LOG_INTERVAL:
+            entry[1] += 1
+            return
+    if _unauthorized_log_bucket.take():
+        if entry is not None:
+            entry[1] += 1
+        return
+    suppressed = entry[1] if entry is not None else 0
+    _unauthorized_seen[user_id] = [now, 0]
+    _unauthorized_seen.move_to_end(user_id)
+    while len(_unauthorized_seen) > _UNAUTHORIZED_TRACKED:
+        _unauthorized_seen.popitem(last=False)
+    if suppressed:
+        logger.warning("Từ chối truy cập từ user_id=%s (+%d update không ghi log)", user_id, suppressed)
+    else:
+        logger.warning("Từ chối truy cập từ user_id=%s", user_id)
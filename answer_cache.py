@@ -0,0 +1,113 @@
+import hashlib
+import json
+import logging
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+
+from config import settings
+from database import get_cached_answer, put_cached_answer
+from metrics import CACHE_LOOKUPS
+
+# TTL mỗi câu trả lời (giây); 0 để tắt cache
+ANSWER_CACHE_TTL = settings.answer_cache_ttl
+ANSWER_CACHE_SIZE = settings.answer_cache_size
+# Lưu thêm một tầng cache trong SQLite để sống sót qua các lần restart
+ANSWER_CACHE_PERSIST = settings.answer_cache_persist
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_TRAILING_PUNCT = " ?!.…"
+
+
+def normalize_question(text: str) -> str:
+    """Chuẩn hoá câu hỏi để các biến thể gần giống nhau dùng chung một key.
+
+    NFKC + casefold, gộp khoảng trắng, bỏ dấu câu ở cuối ("Hôm nay có tin gì?"
+    và "hôm nay có tin gì" cho cùng kết quả).
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = _WHITESPACE_RE.sub(" ", text)
+    return text.strip().rstrip(_TRAILING_PUNCT)
+
+
+def make_key(model: str, messages: list[dict]) -> str:
+    """Tạo cache key từ model, system prompt, history đã sanitize và câu hỏi.
+
+    ``messages`` là danh sách gửi lên API: phần tử cuối là câu hỏi hiện tại.
+    History nằm trong key nên sau ``/clear`` (history rỗng) không thể nhận
+    nhầm câu trả lời được sinh ra trong một ngữ cảnh khác.
+    """
+    *context, question = messages
+    material = {
+        "model": model,
+        "context": [[m["role"], m["content"]] for m in context],
+        "question": normalize_question(question["content"]),
+    }
+    raw = json.dumps(material, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """Cache câu trả lời: LRU trong bộ nhớ + tầng SQLite tuỳ chọn, mỗi entry có TTL."""
+
+    def __init__(self, ttl: float, max_size: int, persist: bool = False):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.persist = persist
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, str, list[str]]] = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_size > 0
+
+    async def get(self, key: str) -> tuple[str, list[str]] | None:
+        if not self.enabled:
+            return None
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, answer, citations = entry
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                CACHE_LOOKUPS.inc(result="hit")
+                return answer, list(citations)
+            del self._entries[key]
+
+        if self.persist:
+            row = await get_cached_answer(key, now)
+            if row is not None:
+                answer, citations, expires_at = row
+                self._remember(key, expires_at, answer, citations)
+                self.hits += 1
+                CACHE_LOOKUPS.inc(result="hit")
+                return answer, list(citations)
+
+        self.misses += 1
+        CACHE_LOOKUPS.inc(result="miss")
+        return None
+
+    async def put(self, key: str, answer: str, citations: list[str]) -> None:
+        if not self.enabled:
+            return
+        expires_at = time.time() + self.ttl
+        self._remember(key, expires_at, answer, list(citations))
+        if self.persist:
+            await put_cached_answer(key, answer, citations, expires_at)
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _remember(self, key: str, expires_at: float, answer: str, citations: list[str]) -> None:
+        self._entries[key] = (expires_at, answer, citations)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_TTL, ANSWER_CACHE_SIZE, ANSWER_CACHE_PERSIST)
@@ -0,0 +1,199 @@
+"""Benchmark lưu trích dẫn: cột JSON ``citations`` so với bảng ``urls`` + ``message_citations``.
+
+Dựng cùng một lịch sử (mỗi câu trả lời ~5 trích dẫn, phần lớn là vài trăm URL phổ
+biến lặp lại) trên hai schema:
+  - cũ (version 7): mảng JSON trong ``chat_history.citations``, mọi lần đọc context
+    đều đọc cột này và ``json.loads`` từng row;
+  - mới (version hiện tại): mỗi URL lưu một lần, tin nhắn trỏ tới qua id; đọc context
+    không chạm tới trích dẫn, export nạp chúng theo trang.
+
+So sánh kích thước file (sau VACUUM) và phần dành cho trích dẫn (cột JSON, hoặc hai
+bảng mới theo ``dbstat``), thời gian đọc context và thời gian đọc một trang
+export kèm trích dẫn.
+
+Chạy từ thư mục gốc của repo:
+
+    python bench/bench_citations.py [--turns 100000] [--repeat 200]
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from database import _MIGRATIONS  # noqa: E402
+
+_OLD_VERSION = 7
+_CONTEXT_LIMIT = 40
+_EXPORT_PAGE = 500
+
+OLD_CONTEXT = """
+    SELECT id, role, content, citations, timestamp, token_count
+    FROM chat_history
+    WHERE session_id = ? AND id < ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+NEW_CONTEXT = """
+    SELECT id, role, content, timestamp, token_count
+    FROM chat_history
+    WHERE session_id = ? AND id < ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+EXPORT_PAGE = """
+    SELECT id, session_id, role, content, timestamp
+    FROM chat_history
+    WHERE telegram_user_id = ? AND id > ?
+    ORDER BY id
+    LIMIT ?
+"""
+OLD_EXPORT_PAGE = EXPORT_PAGE.replace("content, timestamp", "content, citations, timestamp")
+NEW_EXPORT_CITATIONS = """
+    SELECT c.message_id, u.url
+    FROM message_citations c
+             JOIN urls u ON u.id = c.url_id
+    WHERE c.message_id IN ({})
+    ORDER BY c.message_id, c.position
+"""
+
+
+def _citations(rng: random.Random, popular: list[str]) -> list[str]:
+    urls = []
+    for _ in range(rng.randint(3, 8)):
+        if rng.random() < 0.8:
+            urls.append(popular[min(int(rng.paretovariate(1.2)) - 1, len(popular) - 1)])
+        else:
+            urls.append(f"https://news.example.vn/bai-viet/{rng.randrange(10 ** 9)}.html")
+    return urls
+
+
+def build_db(path: str, turns: int, new_schema: bool) -> None:
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    for version, statements in _MIGRATIONS:
+        if version > _OLD_VERSION and not new_schema:
+            break
+        for statement in statements:
+            conn.execute(statement)
+    conn.execute("INSERT INTO sessions (id, telegram_user_id) VALUES (1, 1)")
+    rng = random.Random(42)
+    popular = [f"https://{site}/{topic}/{n}" for n in range(100)
+               for site, topic in (("vi.wikipedia.org", "wiki"), ("vnexpress.net", "kinh-doanh"),
+                                   ("www.sbv.gov.vn", "lai-suat"))]
+    for turn in range(turns):
+        question = "câu hỏi " + "x" * rng.randint(20, 200)
+        answer = "câu trả lời " + "y" * rng.randint(200, 1500)
+        citations = _citations(rng, popular)
+        conn.execute(
+            "INSERT INTO chat_history (telegram_user_id, session_id, role, content, token_count)"
+            " VALUES (1, 1, 'user', ?, ?)",
+            (question, len(question) // 4),
+        )
+        if new_schema:
+            message_id = conn.execute(
+                "INSERT INTO chat_history (telegram_user_id, session_id, role, content, token_count)"
+                " VALUES (1, 1, 'assistant', ?, ?)",
+                (answer, len(answer) // 4),
+            ).lastrowid
+            conn.executemany("INSERT OR IGNORE INTO urls (url) VALUES (?)", [(u,) for u in citations])
+            conn.executemany(
+                "INSERT INTO message_citations (message_id, position, url_id)"
+                " SELECT ?, ?, id FROM urls WHERE url = ?",
+                [(message_id, pos, url) for pos, url in enumerate(citations)],
+            )
+        else:
+            conn.execute(
+                "INSERT INTO chat_history (telegram_user_id, session_id, role, content, citations, token_count)"
+                " VALUES (1, 1, 'assistant', ?, ?, ?)",
+                (answer, json.dumps(citations), len(answer) // 4),
+            )
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def _table_bytes(conn: sqlite3.Connection, names: tuple[str, ...]) -> int:
+    try:
+        return sum(row[0] for row in conn.execute(
+            f"SELECT pgsize FROM dbstat WHERE name IN ({', '.join('?' * len(names))})", names
+        ))
+    except sqlite3.OperationalError:  # SQLite build không có dbstat
+        return 0
+
+
+def measure_context(conn: sqlite3.Connection, old: bool, repeat: int, max_id: int) -> float:
+    rng = random.Random(7)
+    starts = [rng.randint(_CONTEXT_LIMIT, max_id) for _ in range(repeat)]
+
+    def run():
+        for before_id in starts:
+            rows = conn.execute(OLD_CONTEXT if old else NEW_CONTEXT, (1, before_id, _CONTEXT_LIMIT)).fetchall()
+            if old:
+                # Đường đọc cũ: dict hoá và parse JSON trích dẫn cho mọi row
+                [{"content": r[2], "citations": json.loads(r[3])} for r in rows]
+            else:
+                [{"content": r[2]} for r in rows]
+
+    return min(timeit.repeat(run, number=1, repeat=5)) / repeat
+
+
+def measure_export(conn: sqlite3.Connection, old: bool, pages: int) -> float:
+    def run():
+        last_id = 0
+        for _ in range(pages):
+            if old:
+                rows = conn.execute(OLD_EXPORT_PAGE, (1, last_id, _EXPORT_PAGE)).fetchall()
+                [json.loads(r[4]) for r in rows]
+            else:
+                rows = conn.execute(EXPORT_PAGE, (1, last_id, _EXPORT_PAGE)).fetchall()
+                ids = [r[0] for r in rows if r[2] == "assistant"]
+                conn.execute(NEW_EXPORT_CITATIONS.format(", ".join("?" * len(ids))), ids).fetchall()
+            last_id = rows[-1][0]
+
+    return min(timeit.repeat(run, number=1, repeat=5)) / pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=100_000, help="số lượt hỏi/đáp")
+    parser.add_argument("--repeat", type=int, default=200, help="số lần đọc context mỗi lượt đo")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for label, new_schema in (("JSON", False), ("urls", True)):
+            path = os.path.join(tmp, f"{label}.db")
+            build_db(path, args.turns, new_schema)
+            conn = sqlite3.connect(path)
+            if new_schema:
+                citation_bytes = _table_bytes(conn, ("urls", "message_citations"))
+            else:
+                citation_bytes = conn.execute("SELECT SUM(LENGTH(citations)) FROM chat_history").fetchone()[0]
+            results[label] = (
+                os.path.getsize(path),
+                citation_bytes,
+                measure_context(conn, not new_schema, args.repeat, args.turns * 2),
+                measure_export(conn, not new_schema, min(20, args.turns * 2 // _EXPORT_PAGE)),
+            )
+            conn.close()
+
+    print(f"{args.turns:,} lượt hỏi/đáp, 3–8 trích dẫn mỗi câu trả lời")
+    for label, (size, citation_bytes, context, export) in results.items():
+        print(f"  {label:5s} file {size / 2 ** 20:7.1f} MiB, trong đó trích dẫn {citation_bytes / 2 ** 20:5.1f} MiB")
+        print(f"        context {_CONTEXT_LIMIT} tin: {context * 1e6:8.1f} µs"
+              f" | trang export {_EXPORT_PAGE} tin: {export * 1000:6.2f} ms")
+    old, new = results["JSON"], results["urls"]
+    print(f"  trích dẫn: -{(1 - new[1] / old[1]) * 100:.0f}% | file: -{(1 - new[0] / old[0]) * 100:.0f}%"
+          f" | context: {old[2] / new[2]:.1f}x nhanh hơn")
+
+
+if __name__ == "__main__":
+    main()
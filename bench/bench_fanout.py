@@ -0,0 +1,111 @@
+"""Benchmark /deep: thời gian của các truy vấn con gọi song song so với gọi lần lượt.
+
+Chạy ``fanout.fan_out`` trên Perplexity giả lập của ``bench/loadtest.py`` (độ trễ
+dao động ± ``--api-jitter``), với cùng một bộ truy vấn con:
+  - lần lượt: ``concurrency=1``, tổng thời gian ≈ tổng độ trễ các lần gọi;
+  - song song: ``concurrency=DEEP_MAX_CONCURRENCY`` (hoặc ``--concurrency``), tổng thời
+    gian ≈ lần gọi chậm nhất khi concurrency ≥ số truy vấn con.
+Sau đó đo thêm bước tổng hợp (stream) để có thời gian đầu-cuối của một câu hỏi /deep.
+Answer cache bị tắt để mọi lần đo đều gọi API.
+
+Chạy từ thư mục gốc của repo:
+
+    python bench/bench_fanout.py [--subqueries 4] [--api-latency 1.0] [--rounds 5]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from http_server import HttpServer  # noqa: E402
+from loadtest import FakePerplexity  # noqa: E402
+
+API_PORT = 18092
+
+
+async def _run_fan_out(queries: list[str], concurrency: int) -> tuple[float, float]:
+    """Returns: (tổng thời gian, độ trễ của truy vấn con chậm nhất)."""
+    from fanout import fan_out
+
+    started = time.perf_counter()
+    slowest = 0.0
+    async for sub in fan_out(queries, concurrency=concurrency):
+        assert sub.ok, sub.answer
+        slowest = max(slowest, sub.seconds)
+    return time.perf_counter() - started, slowest
+
+
+async def run(args: argparse.Namespace) -> None:
+    from fanout import CitationIndex, DEEP_MAX_CONCURRENCY, fan_out, synthesize
+    from perplexity_client import close_client, open_client
+
+    api = FakePerplexity(argparse.Namespace(
+        api_latency=args.api_latency, api_jitter=args.api_jitter, chunks=20, chunk_interval=0.01,
+        error_rate=0.0, citations=3, answer_words=150, seed=42,
+    ))
+    server = HttpServer("127.0.0.1", API_PORT)
+    server.route("POST", "/chat/completions", api.handle)
+    await server.start()
+    await open_client()
+    concurrency = args.concurrency or DEEP_MAX_CONCURRENCY
+    try:
+        sequential, parallel, slowest, total = [], [], [], []
+        for r in range(args.rounds):
+            queries = [f"Đối tượng {i} (vòng {r}): đặc điểm chính" for i in range(args.subqueries)]
+            elapsed, _ = await _run_fan_out(queries, 1)
+            sequential.append(elapsed)
+            elapsed, slow = await _run_fan_out(queries, concurrency)
+            parallel.append(elapsed)
+            slowest.append(slow)
+
+            # Đầu-cuối: fan-out + tổng hợp stream
+            started = time.perf_counter()
+            index = CitationIndex()
+            answers = []
+            async for sub in fan_out([q + " (e2e)" for q in queries], concurrency=concurrency):
+                sub.answer = index.add(sub.answer, sub.citations)
+                answers.append(sub)
+            async for _ in synthesize("So sánh các đối tượng", answers):
+                pass
+            total.append(time.perf_counter() - started)
+    finally:
+        await close_client()
+        await server.stop()
+
+    med = statistics.median
+    print(
+        f"{args.subqueries} truy vấn con, độ trễ API {args.api_latency:.2f}s ±{args.api_jitter:.0%},"
+        f" concurrency={concurrency}, {args.rounds} vòng (trung vị)"
+    )
+    print(f"  lần lượt            : {med(sequential):6.2f}s")
+    print(f"  song song           : {med(parallel):6.2f}s  (truy vấn chậm nhất {med(slowest):.2f}s)")
+    print(f"  song song + tổng hợp: {med(total):6.2f}s")
+    print(f"  → nhanh hơn {med(sequential) / med(parallel):.1f}x; song song / chậm nhất = {med(parallel) / med(slowest):.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subqueries", type=int, default=4, help="số truy vấn con")
+    parser.add_argument("--api-latency", type=float, default=1.0, help="độ trễ trung bình mỗi lần gọi (giây)")
+    parser.add_argument("--api-jitter", type=float, default=0.5, help="dao động độ trễ, tỉ lệ ±")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=0, help="số truy vấn con chạy cùng lúc (0: DEEP_MAX_CONCURRENCY)")
+    args = parser.parse_args()
+
+    os.environ.update({
+        "PERPLEXITY_API_KEY": "bench",
+        "PERPLEXITY_API_URL": f"http://127.0.0.1:{API_PORT}/chat/completions",
+        "ANSWER_CACHE_TTL": "0",
+        "PERPLEXITY_MAX_CONCURRENCY": str(max(8, args.subqueries)),
+    })
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Micro-benchmark: ``md_to_html`` (renderer một lượt) so với bản chained ``re.sub`` cũ.
+
+Hai kịch bản:
+  - render một lần toàn bộ câu trả lời, với hai mẫu: ``SAMPLE`` dày đặc markup (mỗi
+    dòng đều có token) và ``PROSE`` gần với câu trả lời thật (đoạn văn dài, vài chỗ in
+    đậm, trích dẫn [n], danh sách);
+  - stream: câu trả lời đến theo từng delta và được render lại ở mỗi lần sửa tin
+    nhắn. Bản cũ phải render lại toàn bộ văn bản đã nhận; renderer mới chỉ xử lý
+    các dòng mới (``feed``) cộng dòng đang dở (``peek``).
+
+Chạy từ thư mục gốc của repo:
+
+    python bench/bench_md_to_html.py [--repeat 20] [--size 40000]
+"""
+import argparse
+import re
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from telegram_html import MarkdownRenderer, render_markdown  # noqa: E402
+
+SAMPLE = """## Tổng quan
+
+Đây là **câu trả lời mẫu** với *nhấn mạnh*, `inline code` và trích dẫn [1][2].
+
+- Ý thứ nhất với **điểm chính** và [liên kết](https://example.com/a?b=1&c=2)
+- Ý thứ hai: 3 < 5 && 7 > 2
+1. Bước một
+2. Bước hai
+
+```python
+def hello(name):
+    return f"Xin chào {name} <3"
+```
+
+### Kết luận
+Văn bản dài hơn để mô phỏng một câu trả lời thật, có __bold__ và *italic* xen kẽ.
+
+"""
+
+PROSE = """## Tổng quan
+
+Theo các nguồn gần đây, hiệu năng của hệ thống phụ thuộc chủ yếu vào độ trễ mạng và cách bộ nhớ \
+đệm được cấu hình [1][2]. Trong thực tế, phần lớn thời gian phản hồi nằm ở bước gọi dịch vụ bên \
+ngoài, còn phần xử lý nội bộ chỉ chiếm một tỉ lệ nhỏ [3]. Điều này có nghĩa là tối ưu **kiến trúc \
+gọi song song** thường mang lại lợi ích lớn hơn tối ưu từng hàm riêng lẻ.
+
+- Giảm số lần gọi mạng bằng cách gộp yêu cầu [2]
+- Dùng bộ nhớ đệm có thời hạn cho các câu hỏi lặp lại [4]
+- Theo dõi độ trễ p95 thay vì chỉ nhìn giá trị trung bình
+
+Ngoài ra, việc đo đạc liên tục giúp phát hiện sớm các điểm nghẽn trước khi chúng ảnh hưởng đến \
+người dùng cuối, đặc biệt khi lưu lượng tăng đột biến vào giờ cao điểm [5].
+
+"""
+
+
+def legacy_md_to_html(text: str) -> str:
+    """Bản ``md_to_html`` trước đây: sáu lượt ``re.sub`` nối tiếp nhau."""
+    text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    text = re.sub(
+        r"```(?:\w+)?\n?(.*?)```",
+        lambda m: f"<pre><code>{m.group(1).strip()}</code></pre>",
+        text,
+        flags=re.DOTALL,
+    )
+    text = re.sub(r"`([^`\n]+)`", r"<code>\1</code>", text)
+    text = re.sub(r"\*\*(.+?)\*\*", r"<b>\1</b>", text, flags=re.DOTALL)
+    text = re.sub(r"__(.+?)__", r"<b>\1</b>", text, flags=re.DOTALL)
+    text = re.sub(r"(?<!\*)\*(?!\*)(.+?)(?<!\*)\*(?!\*)", r"<i>\1</i>", text)
+    text = re.sub(r"^#{1,3} +(.+)$", r"<b>\1</b>", text, flags=re.MULTILINE)
+    return text
+
+
+def stream_legacy(text: str, delta: int, flush_every: int) -> None:
+    received = []
+    for i, start in enumerate(range(0, len(text), delta), 1):
+        received.append(text[start:start + delta])
+        if i % flush_every == 0:
+            legacy_md_to_html("".join(received))
+    legacy_md_to_html("".join(received))
+
+
+def stream_incremental(text: str, delta: int, flush_every: int) -> None:
+    renderer = MarkdownRenderer()
+    rendered = []
+    for i, start in enumerate(range(0, len(text), delta), 1):
+        rendered.append(renderer.feed(text[start:start + delta]))
+        if i % flush_every == 0:
+            "".join(rendered) + renderer.peek()
+    rendered.append(renderer.finish())
+    "".join(rendered)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--size", type=int, default=40_000, help="Số ký tự của câu trả lời mẫu")
+    parser.add_argument("--delta", type=int, default=20, help="Số ký tự mỗi delta khi stream")
+    parser.add_argument("--flush-every", type=int, default=10, help="Render lại sau mỗi N delta")
+    args = parser.parse_args()
+
+    text = (SAMPLE * (args.size // len(SAMPLE) + 1))[: args.size]
+    prose = (PROSE * (args.size // len(PROSE) + 1))[: args.size]
+    print(f"Câu trả lời: {len(text):,} ký tự, {text.count(chr(10)):,} dòng, repeat={args.repeat}")
+
+    for label, sample in (("markup dày đặc", text), ("văn xuôi", prose)):
+        print(f"Render một lần ({label}):")
+        for name, fn in (("legacy re.sub", legacy_md_to_html), ("single-pass", render_markdown)):
+            best = min(timeit.repeat(lambda: fn(sample), number=1, repeat=args.repeat))
+            print(f"  {name:<14} {best * 1000:8.3f} ms")
+
+    print(f"Stream (delta={args.delta} ký tự, render lại mỗi {args.flush_every} delta):")
+    for name, fn in (("legacy re.sub", stream_legacy), ("incremental", stream_incremental)):
+        best = min(timeit.repeat(
+            lambda: fn(text, args.delta, args.flush_every), number=1, repeat=max(1, args.repeat // 4)
+        ))
+        print(f"  {name:<14} {best * 1000:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
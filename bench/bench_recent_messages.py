@@ -0,0 +1,121 @@
+"""Benchmark truy vấn context của ``get_recent_messages`` trên lịch sử lớn.
+
+So sánh hai schema trên cùng dữ liệu (vài user "nặng" với 100k+ tin nhắn mỗi người):
+  - cũ: index ``(telegram_user_id)`` + ``ORDER BY timestamp DESC`` — SQLite phải
+    đọc và sort toàn bộ lịch sử của user cho mỗi câu hỏi;
+  - mới: index ``(telegram_user_id, id)`` + ``ORDER BY id DESC`` — đọc đúng
+    ``limit`` row cuối theo thứ tự index.
+
+Chạy từ thư mục gốc của repo:
+
+    python bench/bench_recent_messages.py [--users 3] [--messages 120000] [--repeat 200]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from database import _MIGRATIONS  # noqa: E402
+
+OLD_QUERY = """
+    SELECT id, role, content, citations, timestamp
+    FROM chat_history
+    WHERE telegram_user_id = ?
+    ORDER BY timestamp DESC
+    LIMIT ?
+"""
+NEW_QUERY = """
+    SELECT id, role, content, citations, timestamp
+    FROM chat_history
+    WHERE telegram_user_id = ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+
+
+def build_db(path: str, users: int, messages: int) -> None:
+    """Tạo database với schema version 1 và ``messages`` tin nhắn cho mỗi user, xen kẽ nhau."""
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    for statement in _MIGRATIONS[0][1]:
+        conn.execute(statement)
+    rng = random.Random(42)
+    start = time.time() - messages * 30
+    rows = []
+    for i in range(messages):
+        ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(start + i * 30))
+        for user_id in range(1, users + 1):
+            role = "user" if i % 2 == 0 else "assistant"
+            content = "x" * rng.randint(40, 400)
+            rows.append((user_id, role, content, "[]", ts))
+        if len(rows) >= 50_000:
+            conn.executemany(
+                "INSERT INTO chat_history (telegram_user_id, role, content, citations, timestamp)"
+                " VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            rows.clear()
+    if rows:
+        conn.executemany(
+            "INSERT INTO chat_history (telegram_user_id, role, content, citations, timestamp)"
+            " VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def measure(conn: sqlite3.Connection, query: str, users: int, limit: int, repeat: int) -> float:
+    def run():
+        for user_id in range(1, users + 1):
+            conn.execute(query, (user_id, limit)).fetchall()
+
+    return min(timeit.repeat(run, number=1, repeat=repeat)) / users
+
+
+def plan(conn: sqlite3.Connection, query: str) -> str:
+    rows = conn.execute("EXPLAIN QUERY PLAN " + query, (1, 4)).fetchall()
+    return "; ".join(row[-1] for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=3, help="số user nặng")
+    parser.add_argument("--messages", type=int, default=120_000, help="số tin nhắn mỗi user")
+    parser.add_argument("--limit", type=int, default=4, help="số tin nhắn context lấy ra")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        t0 = time.perf_counter()
+        build_db(path, args.users, args.messages)
+        print(f"Tạo {args.users * args.messages:,} row trong {time.perf_counter() - t0:.1f}s")
+
+        conn = sqlite3.connect(path)
+        old_plan = plan(conn, OLD_QUERY)
+        old = measure(conn, OLD_QUERY, args.users, args.limit, args.repeat)
+
+        for statement in _MIGRATIONS[1][1]:
+            conn.execute(statement)
+        conn.commit()
+        conn.execute("ANALYZE")
+        new_plan = plan(conn, NEW_QUERY)
+        new = measure(conn, NEW_QUERY, args.users, args.limit, args.repeat)
+        conn.close()
+
+    print(f"cũ : {old * 1000:9.3f} ms/truy vấn | {old_plan}")
+    print(f"mới: {new * 1000:9.3f} ms/truy vấn | {new_plan}")
+    print(f"nhanh hơn {old / new:,.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Benchmark ``/search``: FTS5 so với ``LIKE`` trên lịch sử lớn.
+
+Dựng database với schema hiện tại (mọi migration, kể cả bảng FTS5 và trigger) và
+vài user có 100k+ tin nhắn mỗi người, rồi so sánh:
+  - ``LIKE '%từ%'`` trên ``content``: phải đọc toàn bộ lịch sử của user;
+  - ``database.search_messages``: tra index FTS5, xếp hạng bm25, lấy snippet.
+
+Với chủ đề phổ biến, ``LIKE ... ORDER BY id DESC LIMIT`` dừng ngay ở vài tin mới
+nhất nên nhanh, nhưng không xếp hạng; FTS5 xếp hạng mọi tin khớp (~1% lịch sử).
+
+Chạy từ thư mục gốc của repo:
+
+    python bench/bench_search.py [--users 3] [--messages 100000] [--repeat 20]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import database  # noqa: E402
+
+LIKE_QUERY = """
+    SELECT id, session_id, role, timestamp, content
+    FROM chat_history
+    WHERE telegram_user_id = ? AND content LIKE ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+
+# Chủ đề xuất hiện trong ~1% tin nhắn, và chủ đề hiếm (vài chục lần trong cả lịch sử)
+_COMMON = (
+    "thời tiết", "lãi suất", "ngân hàng", "bóng đá", "du lịch", "máy tính", "điện thoại",
+    "Python", "SQLite", "chứng khoán", "bất động sản", "sức khoẻ", "dinh dưỡng", "học máy",
+    "trí tuệ nhân tạo", "lịch sử", "văn hoá", "giáo dục", "âm nhạc", "điện ảnh",
+)
+_RARE = ("giá vàng SJC", "Hội An", "thuế thu nhập cá nhân")
+_RARE_RATE = 0.0003
+_FILLER = "là của và có cho những được trong với một các này không người khi".split()
+
+
+def build_db(path: str, users: int, messages: int) -> None:
+    """Tạo database đủ schema và ``messages`` tin nhắn cho mỗi user; trigger điền index FTS."""
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    for version, statements in database._MIGRATIONS:
+        for statement in statements:
+            conn.execute(statement)
+    conn.execute(f"PRAGMA user_version = {database.SCHEMA_VERSION}")
+    rng = random.Random(42)
+    for user_id in range(1, users + 1):
+        conn.execute("INSERT INTO sessions (id, telegram_user_id) VALUES (?, ?)", (user_id, user_id))
+    rows = []
+    for i in range(messages):
+        for user_id in range(1, users + 1):
+            words = [rng.choice(_FILLER) for _ in range(rng.randint(10, 80))]
+            if rng.random() < 0.2:
+                words.insert(rng.randrange(len(words)), rng.choice(_COMMON))
+            if rng.random() < _RARE_RATE:
+                words.insert(rng.randrange(len(words)), rng.choice(_RARE))
+            content = " ".join(words)
+            rows.append((user_id, user_id, "user" if i % 2 == 0 else "assistant", content))
+        if len(rows) >= 50_000:
+            conn.executemany(
+                "INSERT INTO chat_history (telegram_user_id, session_id, role, content) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            rows.clear()
+    if rows:
+        conn.executemany(
+            "INSERT INTO chat_history (telegram_user_id, session_id, role, content) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def measure_like(path: str, term: str, users: int, limit: int, repeat: int) -> tuple[float, int]:
+    conn = sqlite3.connect(path)
+    hits = 0
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for user_id in range(1, users + 1):
+            hits = len(conn.execute(LIKE_QUERY, (user_id, f"%{term}%", limit)).fetchall())
+        best = min(best, (time.perf_counter() - start) / users)
+    conn.close()
+    return best, hits
+
+
+async def measure_fts(term: str, users: int, limit: int, repeat: int) -> tuple[float, int]:
+    await database.open_db()
+    hits = 0
+    best = float("inf")
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for user_id in range(1, users + 1):
+                results, _ = await database.search_messages(user_id, term, limit=limit)
+                hits = len(results)
+            best = min(best, (time.perf_counter() - start) / users)
+    finally:
+        await database.close_db()
+    return best, hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=3, help="số user nặng")
+    parser.add_argument("--messages", type=int, default=100_000, help="số tin nhắn mỗi user")
+    parser.add_argument("--limit", type=int, default=5, help="số kết quả mỗi trang")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        database.DB_PATH = path
+        t0 = time.perf_counter()
+        build_db(path, args.users, args.messages)
+        print(f"Tạo {args.users * args.messages:,} row (kèm index FTS5) trong {time.perf_counter() - t0:.1f}s")
+
+        # Cụm hiếm, cụm hiếm gõ không dấu (chỉ FTS5), chủ đề phổ biến (~1%)
+        cases = (("giá vàng SJC", '"giá vàng sjc"'), ("Hội An", "hoi an"), ("bóng đá", '"bóng đá"'))
+        for term, fts_term in cases:
+            like, like_hits = measure_like(path, term, args.users, args.limit, args.repeat)
+            fts, fts_hits = asyncio.run(measure_fts(fts_term, args.users, args.limit, args.repeat))
+            print(f"{term!r}")
+            print(f"  LIKE: {like * 1000:9.3f} ms/truy vấn ({like_hits} kết quả)")
+            print(f"  FTS5: {fts * 1000:9.3f} ms/truy vấn ({fts_hits} kết quả, xếp hạng bm25 + snippet)")
+            print(f"  LIKE / FTS5 = {like / fts:,.1f}x")
+
+
+if __name__ == "__main__":
+    main()
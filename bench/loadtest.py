@@ -0,0 +1,392 @@
+"""Load test offline: chạy bot thật với Perplexity và Telegram Bot API giả lập.
+
+Hai server giả lập chạy local trên ``http_server.HttpServer``:
+  - Perplexity: ``POST /chat/completions``, trả lời thường hoặc SSE, có độ trễ, tỉ lệ
+    lỗi và citations cấu hình được;
+  - Telegram Bot API: ``getMe``, ``sendMessage``, ``editMessageText``,
+    ``sendChatAction``… trả về object hợp lệ và đếm số lần gọi.
+
+``Application`` được tạo bằng ``main.build_application`` (đủ handler, ``post_init``,
+scheduler, database) và nhận update JSON qua ``update_queue`` như khi chạy thật.
+N user mô phỏng gửi tin nhắn theo vòng kín: mỗi user chờ câu trả lời xong mới gửi
+câu tiếp theo. Độ trễ đầu-cuối tính từ lúc update vào hàng đợi tới khi bot gửi
+xong câu trả lời và lưu lượt hội thoại.
+
+Chạy từ thư mục gốc của repo:
+
+    python bench/loadtest.py [--users 20] [--messages 10] [--api-latency 0.5] [--no-stream]
+
+Các biến môi trường của bot (``DB_WRITE_BEHIND``, ``PERPLEXITY_MAX_CONCURRENCY``,
+``STREAM_EDIT_INTERVAL``…) vẫn có hiệu lực, nên có thể so sánh hai cấu hình trên cùng
+tải. ``--max-p95-ms`` / ``--min-rate`` trả exit code 1 khi vượt ngưỡng, dùng làm gate
+cho các thay đổi hiệu năng; ``--json`` ghi kết quả ra file.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from urllib.parse import parse_qsl
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from http_server import HttpServer, Request, Response  # noqa: E402
+
+TOKEN = "123456:LOADTEST"
+API_PORT = 18090
+TELEGRAM_PORT = 18091
+FIRST_USER_ID = 10_000
+
+_WORDS = (
+    "Perplexity", "Telegram", "SQLite", "asyncio", "độ", "trễ", "thông", "lượng", "câu",
+    "trả", "lời", "nguồn", "tham", "khảo", "dữ", "liệu", "mô", "hình", "hệ", "thống",
+    "người", "dùng", "kết", "quả", "phân", "tích", "so", "sánh", "ví", "dụ", "cụ", "thể",
+)
+
+
+def _sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(words)).capitalize() + "."
+
+
+class FakePerplexity:
+    """Giả lập ``POST /chat/completions`` của Perplexity."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.latency = args.api_latency
+        self.jitter = args.api_jitter
+        self.chunks = args.chunks
+        self.chunk_interval = args.chunk_interval
+        self.error_rate = args.error_rate
+        self.citations = args.citations
+        self.answer_words = args.answer_words
+        self.rng = random.Random(args.seed)
+        self.requests = 0
+        self.errors = 0
+        self.streams = 0
+
+    def _delay(self) -> float:
+        return max(0.0, self.latency * (1 + self.rng.uniform(-self.jitter, self.jitter)))
+
+    def _answer(self) -> tuple[str, list[str]]:
+        n = self.requests
+        citations = [f"https://example.com/{n}/{i}" for i in range(1, self.citations + 1)]
+        parts = ["**Tóm tắt:** " + _sentence(self.rng, 12)]
+        remaining = max(0, self.answer_words - 12)
+        while remaining > 0:
+            words = min(remaining, 20)
+            ref = f" [{self.rng.randint(1, self.citations)}]" if self.citations else ""
+            parts.append("- " + _sentence(self.rng, words) + ref)
+            remaining -= words
+        return "\n".join(parts), citations
+
+    async def handle(self, request: Request) -> Response:
+        self.requests += 1
+        payload = json.loads(request.body)
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            await asyncio.sleep(self._delay() / 4)
+            return Response(503, json.dumps({"error": "fake overload"}), content_type="application/json")
+
+        text, citations = self._answer()
+        usage = {"prompt_tokens": len(request.body) // 4, "completion_tokens": len(text.encode()) // 4}
+        if not payload.get("stream"):
+            await asyncio.sleep(self._delay())
+            body = {
+                "model": payload["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}}],
+                "citations": citations,
+                "usage": usage,
+            }
+            return Response(body=json.dumps(body), content_type="application/json")
+
+        self.streams += 1
+        return Response(body=self._stream(payload["model"], text, citations, usage), content_type="text/event-stream")
+
+    async def _stream(self, model: str, text: str, citations: list[str], usage: dict):
+        await asyncio.sleep(self._delay())
+        step = max(1, len(text) // self.chunks)
+        pieces = [text[i:i + step] for i in range(0, len(text), step)]
+        for idx, piece in enumerate(pieces):
+            chunk = {"model": model, "choices": [{"index": 0, "delta": {"content": piece}}]}
+            if idx == len(pieces) - 1:
+                chunk["citations"] = citations
+                chunk["usage"] = usage
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode()
+            await asyncio.sleep(self.chunk_interval)
+        yield b"data: [DONE]\n\n"
+
+
+class FakeTelegram:
+    """Giả lập các method Bot API mà bot dùng khi trả lời."""
+
+    METHODS = (
+        "getMe", "sendMessage", "editMessageText", "sendChatAction", "sendDocument",
+        "deleteWebhook", "setWebhook", "answerCallbackQuery",
+    )
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self._message_id = 0
+
+    def register(self, server: HttpServer) -> None:
+        for method in self.METHODS:
+            server.route("POST", f"/bot{TOKEN}/{method}", self.handle)
+
+    async def handle(self, request: Request) -> Response:
+        method = request.path.rsplit("/", 1)[-1]
+        self.calls[method] += 1
+        if request.headers.get("content-type", "").startswith("application/json"):
+            params = json.loads(request.body or b"{}")
+        else:
+            params = dict(parse_qsl(request.body.decode("utf-8", "replace")))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Load Test", "username": "loadtest_bot"}
+        elif method in ("sendMessage", "editMessageText", "sendDocument"):
+            if method == "editMessageText":
+                message_id = int(params["message_id"])
+            else:
+                self._message_id += 1
+                message_id = self._message_id
+            chat_id = int(params.get("chat_id") or 0)
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return Response(body=json.dumps({"ok": True, "result": result}), content_type="application/json")
+
+
+def _db_size(path: str) -> int:
+    """Kích thước logic của DB (page_count * page_size), kể cả phần còn nằm trong WAL.
+
+    Không đo kích thước file: trước khi chạy ``-wal`` còn chứa các trang của migration,
+    sau ``close_db()`` thì WAL đã được checkpoint và xoá, nên so file sẽ ra số âm.
+    """
+    with contextlib.closing(sqlite3.connect(path)) as db:
+        page_count = db.execute("PRAGMA page_count").fetchone()[0]
+        page_size = db.execute("PRAGMA page_size").fetchone()[0]
+    return page_count * page_size
+
+
+def _percentile(values: list[float], q: float) -> float:
+    """Phân vị ``q`` (0..1) theo nearest-rank trên danh sách đã sắp xếp."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(q * len(values)) - 1))]
+
+
+def _fmt_size(n: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(n) < 1024:
+            return f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GiB"
+
+
+async def run(args: argparse.Namespace, db_path: str) -> dict:
+    # Import sau khi đã đặt biến môi trường: cấu hình của bot được đọc lúc import
+    from telegram import Update
+
+    import metrics
+    import utils
+    from main import build_application
+
+    logging.getLogger().setLevel(args.log_level)
+
+    api = FakePerplexity(args)
+    telegram = FakeTelegram(args.tg_latency)
+    server = HttpServer("127.0.0.1", API_PORT)
+    server.route("POST", "/chat/completions", api.handle)
+    tg_server = HttpServer("127.0.0.1", TELEGRAM_PORT)
+    telegram.register(tg_server)
+    await server.start()
+    await tg_server.start()
+
+    user_ids = [FIRST_USER_ID + i for i in range(args.users)]
+    app = build_application(TOKEN, user_ids, base_url=f"http://127.0.0.1:{TELEGRAM_PORT}/bot")
+
+    # Đánh dấu xong khi scheduler xử lý xong update: sau lần gửi Telegram cuối và add_turn
+    done: dict[int, asyncio.Event] = {}
+    process = utils.scheduler._process
+
+    async def tracked(job):
+        try:
+            await process(job)
+        finally:
+            for update_id in job.update_ids:
+                done[update_id].set()
+
+    utils.scheduler._process = tracked
+
+    latencies: list[float] = []
+    timeouts = 0
+    update_ids = iter(range(1, 1 << 30))
+    rng = random.Random(args.seed)
+
+    async def simulate_user(index: int, user_id: int) -> None:
+        nonlocal timeouts
+        await asyncio.sleep(args.ramp * index / max(1, args.users))
+        for k in range(args.messages):
+            update_id = next(update_ids)
+            # Câu hỏi khác nhau để không trúng answer cache
+            text = f"Câu hỏi {k + 1} của user {user_id}: " + _sentence(rng, rng.randint(5, args.question_words))
+            data = {
+                "update_id": update_id,
+                "message": {
+                    "message_id": update_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": user_id, "is_bot": False, "first_name": f"User {index}"},
+                    "text": text,
+                },
+            }
+            done[update_id] = asyncio.Event()
+            started = time.perf_counter()
+            await app.update_queue.put(Update.de_json(data, app.bot))
+            try:
+                await asyncio.wait_for(done[update_id].wait(), args.timeout)
+                latencies.append(time.perf_counter() - started)
+            except asyncio.TimeoutError:
+                timeouts += 1
+            del done[update_id]
+            if args.think:
+                await asyncio.sleep(rng.uniform(0, args.think))
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    db_before = _db_size(db_path)
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(simulate_user(i, uid) for i, uid in enumerate(user_ids)))
+        elapsed = time.perf_counter() - started
+    finally:
+        await app.stop()
+        await app.post_stop(app)
+        await app.shutdown()
+        await app.post_shutdown(app)
+        await server.stop()
+        await tg_server.stop()
+    db_after = _db_size(db_path)
+
+    latencies.sort()
+    return {
+        "users": args.users,
+        "messages_per_user": args.messages,
+        "stream": not args.no_stream,
+        "completed": len(latencies),
+        "timeouts": timeouts,
+        "elapsed_s": round(elapsed, 3),
+        "messages_per_s": round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+        "latency_ms": {
+            name: round(_percentile(latencies, q) * 1000, 1)
+            for name, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))
+        },
+        "api_requests": api.requests,
+        "api_errors": api.errors,
+        "telegram_calls": dict(telegram.calls),
+        "db_bytes_before": db_before,
+        "db_bytes_after": db_after,
+        "db_bytes_per_message": round((db_after - db_before) / len(latencies), 1) if latencies else 0.0,
+        "stages": {
+            key[0]: {"count": count, "avg_ms": round(total / count * 1000, 2)}
+            for key, (_, total, count) in metrics.STAGE_SECONDS._values.items()
+        },
+    }
+
+
+def report(result: dict) -> None:
+    lat = result["latency_ms"]
+    total = result["users"] * result["messages_per_user"]
+    print(
+        f"Tải       : {result['users']} user × {result['messages_per_user']} tin nhắn"
+        f" | stream={'bật' if result['stream'] else 'tắt'}"
+    )
+    print(
+        f"Hoàn tất  : {result['completed']}/{total} trong {result['elapsed_s']:.1f}s"
+        f" → {result['messages_per_s']:.2f} tin nhắn/giây (timeout: {result['timeouts']})"
+    )
+    print(f"Độ trễ    : p50={lat['p50']:.0f}ms p95={lat['p95']:.0f}ms p99={lat['p99']:.0f}ms max={lat['max']:.0f}ms")
+    calls = ", ".join(f"{k}={v}" for k, v in sorted(result["telegram_calls"].items()))
+    print(f"Perplexity: {result['api_requests']} request ({result['api_errors']} lỗi giả lập)")
+    print(f"Telegram  : {calls}")
+    growth = result["db_bytes_after"] - result["db_bytes_before"]
+    print(
+        f"Database  : {_fmt_size(result['db_bytes_before'])} → {_fmt_size(result['db_bytes_after'])}"
+        f" (+{_fmt_size(growth)}, {_fmt_size(result['db_bytes_per_message'])}/tin nhắn)"
+    )
+    for stage, s in sorted(result["stages"].items()):
+        print(f"  {stage:<16} n={s['count']:<6} avg={s['avg_ms']:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20, help="số user mô phỏng")
+    parser.add_argument("--messages", type=int, default=10, help="số tin nhắn mỗi user")
+    parser.add_argument("--think", type=float, default=0.0, help="nghỉ ngẫu nhiên tối đa giữa hai tin nhắn (giây)")
+    parser.add_argument("--ramp", type=float, default=1.0, help="thời gian giãn lúc các user bắt đầu (giây)")
+    parser.add_argument("--question-words", type=int, default=30, help="số từ tối đa mỗi câu hỏi")
+    parser.add_argument("--no-stream", action="store_true", help="tắt stream câu trả lời (STREAM_ANSWERS=0)")
+    parser.add_argument("--api-latency", type=float, default=0.5, help="độ trễ tới token đầu của Perplexity (giây)")
+    parser.add_argument("--api-jitter", type=float, default=0.2, help="dao động độ trễ, tỉ lệ ±")
+    parser.add_argument("--chunks", type=int, default=20, help="số chunk SSE mỗi câu trả lời")
+    parser.add_argument("--chunk-interval", type=float, default=0.02, help="giãn cách giữa hai chunk (giây)")
+    parser.add_argument("--answer-words", type=int, default=150, help="số từ mỗi câu trả lời")
+    parser.add_argument("--citations", type=int, default=3, help="số citation mỗi câu trả lời")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="tỉ lệ request Perplexity trả 503")
+    parser.add_argument("--tg-latency", type=float, default=0.0, help="độ trễ mỗi lời gọi Bot API (giây)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="thời gian chờ tối đa mỗi câu trả lời (giây)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", type=Path, help="ghi kết quả ra file JSON")
+    parser.add_argument("--max-p95-ms", type=float, help="exit code 1 nếu p95 vượt ngưỡng")
+    parser.add_argument("--min-rate", type=float, help="exit code 1 nếu số tin nhắn/giây thấp hơn ngưỡng")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "loadtest.db")
+        os.environ.update({
+            "TELEGRAM_TOKEN": TOKEN,
+            "PERPLEXITY_API_KEY": "loadtest",
+            "PERPLEXITY_API_URL": f"http://127.0.0.1:{API_PORT}/chat/completions",
+            "DB_PATH": db_path,
+            "STREAM_ANSWERS": "0" if args.no_stream else "1",
+            "METRICS_ENABLED": "1",
+            "METRICS_PORT": "0",
+        })
+        result = asyncio.run(run(args, db_path))
+
+    report(result)
+    if args.json:
+        args.json.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    failed = []
+    if args.max_p95_ms is not None and result["latency_ms"]["p95"] > args.max_p95_ms:
+        failed.append(f"p95 {result['latency_ms']['p95']:.0f}ms > {args.max_p95_ms:.0f}ms")
+    if args.min_rate is not None and result["messages_per_s"] < args.min_rate:
+        failed.append(f"{result['messages_per_s']:.2f} tin nhắn/giây < {args.min_rate}")
+    if result["timeouts"]:
+        failed.append(f"{result['timeouts']} câu hỏi quá {args.timeout:.0f}s")
+    if failed:
+        print("FAIL: " + "; ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,173 @@
+import html
 import logging
-import tempfile
-from pathlib import Path
+from urllib.parse import urlsplit
 
-from telegram import Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import ContextTypes
 
-from database import clear_history, get_all_messages
-from utils import _build_export_content
+from access import DAILY_QUOTA, ROLES, ROLE_USER, add_user, is_admin, remove_user, users_snapshot
+from database import (
+    SNIPPET_END,
+    SNIPPET_START,
+    count_messages,
+    get_active_session,
+    get_citations,
+    list_sessions,
+    new_session,
+    search_messages,
+    switch_session,
+)
+from exporter import FORMATS, _fmt_timestamp, export_history
+from router import PROFILES, get_override, set_override, usage_snapshot
+from scheduler import MODE_DEEP
+from utils import submit_question
 
 logger = logging.getLogger(__name__)
 
+SEARCH_PAGE_SIZE = 5
+# Số câu tìm kiếm gần nhất giữ trong user_data để nút chuyển trang còn dùng được
+_SEARCH_HISTORY = 20
+# Số nguồn (tên miền) hiện dưới mỗi câu trả lời trong kết quả /search
+_SEARCH_SOURCES = 3
+
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    admin_help = (
+        "\n\n<b>Quản trị:</b>\n"
+        "/users – Danh sách user được phép\n"
+        "/adduser &lt;id&gt; [user|admin] [hạn mức/ngày] – Cấp quyền hoặc đổi vai trò\n"
+        "/removeuser &lt;id&gt; – Thu hồi quyền"
+    ) if is_admin(update.effective_user.id) else ""
     await update.message.reply_text(
         "Xin chào! Tôi là trợ lý nghiên cứu AI tích hợp Perplexity.\n\n"
         "Hãy gửi bất kỳ câu hỏi nào, tôi sẽ tìm kiếm và trả lời bằng tiếng Việt "
         "kèm các nguồn trích dẫn.\n\n"
         "<b>Lệnh có sẵn:</b>\n"
         "/start  – Hiển thị tin nhắn này\n"
-        "/export – Xuất toàn bộ lịch sử hội thoại ra file .md\n"
-        "/clear  – Xóa lịch sử hội thoại, bắt đầu cuộc trò chuyện mới",
+        "/new [tên] – Bắt đầu phiên hội thoại mới\n"
+        "/sessions – Danh sách các phiên gần đây\n"
+        "/switch &lt;id&gt; – Quay lại một phiên cũ\n"
+        "/model [auto|fast|pro|reason] – Chọn model (mặc định tự động theo câu hỏi)\n"
+        "/deep &lt;câu hỏi&gt; – Tách câu hỏi (vd. so sánh nhiều thứ) thành nhiều truy vấn tìm song song rồi tổng hợp\n"
+        "/search &lt;từ khoá&gt; – Tìm trong lịch sử hội thoại\n"
+        "/export [md|jsonl|html] [gz] [id] – Xuất lịch sử hội thoại ra file\n"
+        "/clear  – Bắt đầu cuộc trò chuyện mới (lịch sử cũ vẫn được lưu)"
+        + admin_help,
         parse_mode="HTML",
     )
 
 
 async def cmd_clear(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Không xoá gì: chỉ chuyển sang session mới, lịch sử cũ vẫn xem/xuất được
+    user_id = update.effective_user.id
+    if not await count_messages(user_id, await get_active_session(user_id)):
+        await update.message.reply_text("Phiên hiện tại đang trống, không cần làm mới.")
+        return
+    session_id = await new_session(user_id)
+    await update.message.reply_text(
+        f"Đã bắt đầu hội thoại mới (phiên <b>#{session_id}</b>). "
+        "Lịch sử cũ vẫn được lưu — xem bằng /sessions, xuất bằng /export &lt;id&gt;.",
+        parse_mode="HTML",
+    )
+    logger.info("User_id=%d chuyển sang session mới %d qua /clear", user_id, session_id)
+
+
+async def cmd_new(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    title = " ".join(context.args or []).strip()[:100] or None
+    session_id = await new_session(user_id, title)
+    await update.message.reply_text(
+        f"Đã mở phiên mới <b>#{session_id}</b>"
+        + (f" — {html.escape(title)}" if title else "")
+        + ".\nDùng /sessions để xem các phiên cũ, /switch &lt;id&gt; để quay lại.",
+        parse_mode="HTML",
+    )
+
+
+async def cmd_sessions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    sessions = await list_sessions(user_id)
+    if not sessions:
+        await update.message.reply_text("Chưa có phiên hội thoại nào.")
+        return
+    active = await get_active_session(user_id)
+    lines = ["<b>Các phiên gần đây:</b>"]
+    for s in sessions:
+        title = s["title"] or (s["first_message"] or "(trống)")
+        if len(title) > 40:
+            title = title[:40] + "…"
+        when = _fmt_timestamp(s["last_at"] or s["created_at"])
+        marker = "▶" if s["id"] == active else "•"
+        lines.append(
+            f"{marker} <b>#{s['id']}</b> — {html.escape(title)} "
+            f"({s['message_count']} tin, {html.escape(when)})"
+        )
+    lines.append("\n/switch &lt;id&gt; để chuyển phiên, /export &lt;id&gt; để xuất một phiên.")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+
+async def cmd_switch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    deleted = await clear_history(user_id)
-    if deleted > 0:
+    arg = (context.args or [""])[0].lstrip("#")
+    if not arg.isdigit():
+        await update.message.reply_text("Cú pháp: /switch <id> — xem id bằng /sessions.")
+        return
+    session_id = int(arg)
+    if not await switch_session(user_id, session_id):
+        await update.message.reply_text(f"Không tìm thấy phiên #{session_id}.")
+        return
+    await update.message.reply_text(
+        f"Đã chuyển sang phiên <b>#{session_id}</b>.", parse_mode="HTML"
+    )
+
+
+async def cmd_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    if context.args:
+        try:
+            profile = set_override(user_id, context.args[0])
+        except ValueError:
+            await update.message.reply_text("Cú pháp: /model [auto|fast|pro|reason]")
+            return
         await update.message.reply_text(
-            f"Đã xóa <b>{deleted}</b> tin nhắn. Hội thoại mới bắt đầu!",
+            f"Đã ghim model <b>{profile.name}</b>." if profile
+            else "Đã chuyển về chọn model tự động.",
             parse_mode="HTML",
         )
-        logger.info("Đã xóa lịch sử của user_id=%d, %d tin nhắn bị xóa", user_id, deleted)
-    else:
-        await update.message.reply_text("Không có lịch sử nào để xóa.")
+        return
+
+    current = get_override(user_id)
+    usage = usage_snapshot()
+    lines = [
+        f"Model hiện tại: <b>{current.name if current else 'tự động'}</b>",
+        "Ghim model: /model fast | pro | reason, bỏ ghim: /model auto.",
+        "Chọn cho một câu hỏi: bắt đầu tin nhắn bằng !fast, !pro hoặc !reason.",
+        "",
+        "<b>Thống kê từ khi khởi động:</b>",
+    ]
+    for name, profile in PROFILES.items():
+        u = usage.get(name)
+        if u:
+            lines.append(
+                f"• {profile.alias} ({name}): {u['requests']} request, "
+                f"~${u['cost_usd']:.4f}, trễ TB {u['latency_avg']:.1f}s"
+            )
+        else:
+            lines.append(f"• {profile.alias} ({name}): chưa dùng")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+
+async def cmd_deep(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Lấy phần sau lệnh từ text gốc thay vì context.args để giữ nguyên xuống dòng
+    parts = update.message.text.split(maxsplit=1)
+    question = parts[1].strip() if len(parts) > 1 else ""
+    if not question:
+        await update.message.reply_text(
+            "Cú pháp: /deep &lt;câu hỏi&gt;\nVí dụ: /deep so sánh Python, Go và Rust về hiệu năng",
+            parse_mode="HTML",
+        )
+        return
+    await submit_question(update, context, question, MODE_DEEP)
 
 
 async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -42,31 +175,180 @@ async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     user_id = user.id
     username = user.username or user.full_name or str(user_id)
 
-    messages = await get_all_messages(user_id)
-    if not messages:
+    fmt = "md"
+    compress = False
+    session_id: int | None = None
+    for arg in (a.lower() for a in context.args or []):
+        if arg in FORMATS:
+            fmt = arg
+        elif arg in ("gz", "gzip"):
+            compress = True
+        elif arg.lstrip("#").isdigit():
+            session_id = int(arg.lstrip("#"))
+        else:
+            await update.message.reply_text(
+                "Cú pháp: /export [md|jsonl|html] [gz] [id phiên]\n"
+                "Ví dụ: /export html gz, /export 12"
+            )
+            return
+
+    total = await count_messages(user_id, session_id)
+    if not total:
         await update.message.reply_text("Không có lịch sử hội thoại nào để xuất.")
         return
 
-    content = _build_export_content(username, messages)
-
-    tmp_path: Path | None = None
+    tmp_path = await export_history(
+        user_id, username, total, fmt=fmt, compress=compress, session_id=session_id
+    )
+    scope = f"_s{session_id}" if session_id is not None else ""
+    filename = f"history_{username}{scope}.{fmt}" + (".gz" if compress else "")
     try:
-        with tempfile.NamedTemporaryFile(
-                mode="w",
-                suffix=".md",
-                prefix=f"history_{user_id}_",
-                encoding="utf-8",
-                delete=False,
-        ) as f:
-            f.write(content)
-            tmp_path = Path(f.name)
-
         with tmp_path.open("rb") as doc:
             await update.message.reply_document(
                 document=doc,
-                filename=f"history_{username}.md",
-                caption=f"Lịch sử hội thoại — {len(messages)} tin nhắn.",
+                filename=filename,
+                caption=f"Lịch sử hội thoại — {total} tin nhắn.",
             )
     finally:
-        if tmp_path and tmp_path.exists():
-            tmp_path.unlink()
+        tmp_path.unlink(missing_ok=True)
+
+
+def _format_snippet(snippet: str) -> str:
+    text = html.escape(" ".join(snippet.split()))
+    return text.replace(SNIPPET_START, "<b>").replace(SNIPPET_END, "</b>")
+
+
+def _format_sources(urls: list[str]) -> str:
+    """Tên miền (không lặp) của các nguồn trích dẫn, tối đa ``_SEARCH_SOURCES``."""
+    hosts = list(dict.fromkeys(urlsplit(url).hostname or url for url in urls))
+    text = ", ".join(hosts[:_SEARCH_SOURCES])
+    if len(hosts) > _SEARCH_SOURCES:
+        text += f" +{len(hosts) - _SEARCH_SOURCES}"
+    return "🔗 " + html.escape(text)
+
+
+async def _search_page(
+        user_id: int, search_id: int, query: str, page: int
+) -> tuple[str, InlineKeyboardMarkup | None]:
+    """Render một trang kết quả ``/search`` kèm nút chuyển trang."""
+    results, has_more = await search_messages(
+        user_id, query, limit=SEARCH_PAGE_SIZE, offset=page * SEARCH_PAGE_SIZE
+    )
+    if not results:
+        if page == 0:
+            return f"Không tìm thấy tin nhắn nào khớp với <b>{html.escape(query)}</b>.", None
+        return "Không còn kết quả nào.", None
+
+    # Trích dẫn chỉ được nạp cho các câu trả lời của trang đang hiện
+    citations = await get_citations([r["id"] for r in results if r["role"] == "assistant"])
+    lines = [f"<b>Kết quả cho “{html.escape(query)}”</b> — trang {page + 1}", ""]
+    for idx, r in enumerate(results, page * SEARCH_PAGE_SIZE + 1):
+        who = "Bạn" if r["role"] == "user" else "Trợ lý"
+        when = html.escape(_fmt_timestamp(r["timestamp"]))
+        lines.append(f"<b>{idx}.</b> {when} · phiên #{r['session_id']} · {who}")
+        lines.append(_format_snippet(r["snippet"]))
+        if r["id"] in citations:
+            lines.append(_format_sources(citations[r["id"]]))
+        lines.append("")
+    lines.append("/switch &lt;id&gt; để mở lại phiên, /export &lt;id&gt; để xuất phiên.")
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀ Trước", callback_data=f"search:{search_id}:{page - 1}"))
+    if has_more:
+        buttons.append(InlineKeyboardButton("Sau ▶", callback_data=f"search:{search_id}:{page + 1}"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+async def cmd_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    query = " ".join(context.args or []).strip()[:200]
+    if not query:
+        await update.message.reply_text(
+            "Cú pháp: /search <từ khoá>\n"
+            "Ví dụ: /search giá vàng, /search \"hội an\" du lịch, /search python*\n"
+            "Không phân biệt hoa thường và dấu (trừ đ)."
+        )
+        return
+
+    # callback_data giới hạn 64 byte: nút chỉ mang id của câu tìm kiếm, câu gốc giữ trong user_data
+    searches: dict[int, str] = context.user_data.setdefault("searches", {})
+    search_id = max(searches, default=0) + 1
+    searches[search_id] = query
+    for old in sorted(searches)[:-_SEARCH_HISTORY]:
+        del searches[old]
+
+    text, markup = await _search_page(user_id, search_id, query, 0)
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=markup)
+
+
+async def on_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Nút chuyển trang của ``/search`` (callback_data ``search:<id>:<trang>``)."""
+    callback = update.callback_query
+    _, search_id, page = callback.data.split(":")
+    query = context.user_data.get("searches", {}).get(int(search_id))
+    if query is None:
+        await callback.answer("Kết quả tìm kiếm đã hết hạn, hãy /search lại.", show_alert=True)
+        return
+    # Chỉ tìm trong lịch sử của chính người bấm nút
+    text, markup = await _search_page(callback.from_user.id, int(search_id), query, int(page))
+    await callback.answer()
+    await callback.edit_message_text(text, parse_mode="HTML", reply_markup=markup)
+
+
+async def cmd_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    lines = ["<b>User được phép:</b>"]
+    for u in users_snapshot():
+        quota = u["daily_quota"] if u["daily_quota"] is not None else DAILY_QUOTA
+        if u["role"] == "admin":
+            limits = "không giới hạn"
+        else:
+            used = "?" if u["questions_today"] is None else u["questions_today"]
+            limits = f"hôm nay {used}/{quota or '∞'}"
+        lines.append(f"• <code>{u['telegram_user_id']}</code> — {u['role']}, {limits}")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+
+async def cmd_adduser(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    args = context.args or []
+    usage = "Cú pháp: /adduser <user_id> [user|admin] [hạn mức/ngày]"
+    if not args or not args[0].lstrip("-").isdigit():
+        await update.message.reply_text(usage)
+        return
+    user_id = int(args[0])
+    role = ROLE_USER
+    daily_quota: int | None = None
+    for arg in (a.lower() for a in args[1:]):
+        if arg in ROLES:
+            role = arg
+        elif arg.isdigit():
+            daily_quota = int(arg)
+        else:
+            await update.message.reply_text(usage)
+            return
+    if user_id == update.effective_user.id and role != "admin":
+        await update.message.reply_text("Không thể tự hạ quyền admin của chính mình.")
+        return
+    await add_user(user_id, role, daily_quota, added_by=update.effective_user.id)
+    quota = "không giới hạn" if role == "admin" else f"{daily_quota if daily_quota is not None else DAILY_QUOTA} câu/ngày"
+    await update.message.reply_text(
+        f"Đã cấp quyền cho <code>{user_id}</code> — {role}, {quota}.", parse_mode="HTML"
+    )
+
+
+async def cmd_removeuser(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    arg = (context.args or [""])[0]
+    if not arg.lstrip("-").isdigit():
+        await update.message.reply_text("Cú pháp: /removeuser <user_id>")
+        return
+    user_id = int(arg)
+    if user_id == update.effective_user.id:
+        await update.message.reply_text("Không thể tự thu hồi quyền của chính mình.")
+        return
+    if not await remove_user(user_id):
+        await update.message.reply_text(f"User {user_id} không có trong danh sách.")
+        return
+    await update.message.reply_text(
+        f"Đã thu hồi quyền của <code>{user_id}</code>. Lịch sử chat của user vẫn được giữ.",
+        parse_mode="HTML",
+    )
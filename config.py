@@ -0,0 +1,161 @@
+"""Cấu hình của bot, đọc từ biến môi trường (và file ``.env``) đúng một lần.
+
+Mọi module lấy giá trị từ ``settings`` thay vì tự gọi ``os.getenv``/``load_dotenv``,
+nên thứ tự import không còn quyết định biến nào trong ``.env`` có hiệu lực, và giá
+trị sai kiểu được báo ngay khi khởi động, một lần cho tất cả.
+"""
+import os
+import types
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+from typing import Mapping
+
+from dotenv import load_dotenv
+
+_TRUE = ("1", "true", "yes", "on")
+_FALSE = ("0", "false", "no", "off", "")
+
+
+def _env(name: str, default, *, choices: tuple[str, ...] = ()):
+    """Khai báo một trường của ``Settings`` gắn với biến môi trường ``name``."""
+    return field(default=default, metadata={"env": name, "choices": choices})
+
+
+def _parse(name: str, raw: str, kind, choices: tuple[str, ...]):
+    raw = raw.strip()
+    optional = isinstance(kind, types.UnionType)
+    if optional:
+        if not raw:
+            return None
+        kind = next(t for t in kind.__args__ if t is not type(None))
+    if kind is bool:
+        if raw.lower() in _TRUE:
+            return True
+        if raw.lower() in _FALSE:
+            return False
+        raise ValueError(f"{name}={raw!r}: cần 1/0, true/false, yes/no")
+    if kind is str and choices:
+        raw = raw.lower()
+        if raw not in choices:
+            raise ValueError(f"{name}={raw!r}: cần một trong {' | '.join(choices)}")
+        return raw
+    try:
+        return kind(raw)
+    except ValueError:
+        raise ValueError(f"{name}={raw!r}: cần kiểu {kind.__name__}") from None
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Toàn bộ cấu hình, đã ép kiểu. Tên biến môi trường nằm trong metadata ``env``."""
+
+    # main.py
+    telegram_token: str = _env("TELEGRAM_TOKEN", "")
+    allowed_user_id: int | None = _env("ALLOWED_USER_ID", None)
+    bot_mode: str = _env("BOT_MODE", "polling", choices=("polling", "webhook"))
+    webhook_url: str = _env("WEBHOOK_URL", "")
+    webhook_listen: str = _env("WEBHOOK_LISTEN", "0.0.0.0")
+    webhook_port: int = _env("WEBHOOK_PORT", 8443)
+    webhook_path: str = _env("WEBHOOK_PATH", "/telegram")
+    webhook_secret: str = _env("WEBHOOK_SECRET", "")
+    shutdown_drain_timeout: float = _env("SHUTDOWN_DRAIN_TIMEOUT", 30.0)
+
+    # perplexity_client.py
+    perplexity_api_key: str = _env("PERPLEXITY_API_KEY", "")
+    perplexity_api_url: str = _env("PERPLEXITY_API_URL", "https://api.perplexity.ai/chat/completions")
+    context_token_budget: int = _env("CONTEXT_TOKEN_BUDGET", 1500)
+    context_max_messages: int = _env("CONTEXT_MAX_MESSAGES", 20)
+    context_summary: bool = _env("CONTEXT_SUMMARY", True)
+    summary_model: str = _env("SUMMARY_MODEL", "")  # trống: model mặc định của router
+    summary_max_tokens: int = _env("SUMMARY_MAX_TOKENS", 400)
+    http_max_connections: int = _env("PERPLEXITY_MAX_CONNECTIONS", 20)
+    http_max_keepalive: int = _env("PERPLEXITY_MAX_KEEPALIVE", 10)
+    http_keepalive_expiry: float = _env("PERPLEXITY_KEEPALIVE_EXPIRY", 60.0)
+    http_connect_timeout: float = _env("PERPLEXITY_CONNECT_TIMEOUT", 5.0)
+    http_read_timeout: float = _env("PERPLEXITY_READ_TIMEOUT", 30.0)
+    http_pool_timeout: float = _env("PERPLEXITY_POOL_TIMEOUT", 10.0)
+    perplexity_max_concurrency: int = _env("PERPLEXITY_MAX_CONCURRENCY", 4)
+    perplexity_max_attempts: int = _env("PERPLEXITY_MAX_ATTEMPTS", 3)
+    perplexity_retry_base_delay: float = _env("PERPLEXITY_RETRY_BASE_DELAY", 0.5)
+    perplexity_retry_max_delay: float = _env("PERPLEXITY_RETRY_MAX_DELAY", 8.0)
+    perplexity_deadline: float = _env("PERPLEXITY_DEADLINE", 60.0)
+    perplexity_breaker_threshold: int = _env("PERPLEXITY_BREAKER_THRESHOLD", 5)
+    perplexity_breaker_reset: float = _env("PERPLEXITY_BREAKER_RESET", 30.0)
+
+    # router.py
+    router_pro_words: int = _env("ROUTER_PRO_WORDS", 40)
+    router_reasoning_words: int = _env("ROUTER_REASONING_WORDS", 120)
+
+    # answer_cache.py
+    answer_cache_ttl: float = _env("ANSWER_CACHE_TTL", 900.0)
+    answer_cache_size: int = _env("ANSWER_CACHE_SIZE", 256)
+    answer_cache_persist: bool = _env("ANSWER_CACHE_PERSIST", False)
+
+    # utils.py
+    stream_answers: bool = _env("STREAM_ANSWERS", True)
+    stream_edit_interval: float = _env("STREAM_EDIT_INTERVAL", 1.0)
+    user_queue_max: int = _env("USER_QUEUE_MAX", 3)
+    user_queue_policy: str = _env("USER_QUEUE_POLICY", "merge", choices=("drop", "merge"))
+
+    # fanout.py
+    deep_max_subqueries: int = _env("DEEP_MAX_SUBQUERIES", 4)
+    deep_max_concurrency: int = _env("DEEP_MAX_CONCURRENCY", 4)
+    deep_deadline: float = _env("DEEP_DEADLINE", 45.0)
+
+    # recovery.py
+    recovery_max_age: float = _env("RECOVERY_MAX_AGE", 3600.0)
+
+    # access.py
+    rate_limit_per_minute: float = _env("RATE_LIMIT_PER_MINUTE", 6.0)
+    rate_limit_burst: int = _env("RATE_LIMIT_BURST", 3)
+    daily_quota: int = _env("DAILY_QUOTA", 100)
+    unauthorized_log_interval: float = _env("UNAUTHORIZED_LOG_INTERVAL", 300.0)
+
+    # database.py
+    db_path: str = _env("DB_PATH", "chat_history.db")
+    db_reader_pool_size: int = _env("DB_READER_POOL_SIZE", 4)
+    db_write_behind: bool = _env("DB_WRITE_BEHIND", False)
+    db_flush_interval_ms: int = _env("DB_FLUSH_INTERVAL_MS", 200)
+    db_flush_max_rows: int = _env("DB_FLUSH_MAX_ROWS", 64)
+
+    # exporter.py
+    export_page_size: int = _env("EXPORT_PAGE_SIZE", 500)
+
+    # maintenance.py
+    maintenance_interval: float = _env("MAINTENANCE_INTERVAL", 3600.0)
+    maintenance_first_delay: float = _env("MAINTENANCE_FIRST_DELAY", 300.0)
+    retention_days: float = _env("RETENTION_DAYS", 0.0)
+    retention_max_rows: int = _env("RETENTION_MAX_ROWS", 0)
+    archive_mode: str = _env("ARCHIVE_MODE", "table", choices=("table", "file", "delete"))
+    archive_dir: Path = _env("ARCHIVE_DIR", Path("archive"))
+
+    # metrics.py
+    metrics_enabled: bool = _env("METRICS_ENABLED", False)
+    metrics_host: str = _env("METRICS_HOST", "127.0.0.1")
+    metrics_port: int = _env("METRICS_PORT", 9108)
+    metrics_log_interval: float = _env("METRICS_LOG_INTERVAL", 0.0)
+
+    @classmethod
+    def from_env(cls, environ: Mapping[str, str] = os.environ) -> "Settings":
+        """Đọc mọi trường từ ``environ``; biến không đặt dùng giá trị mặc định.
+
+        Raises:
+            ValueError: Liệt kê mọi biến có giá trị không hợp lệ.
+        """
+        values = {}
+        errors = []
+        for f in fields(cls):
+            raw = environ.get(f.metadata["env"])
+            if raw is None:
+                continue
+            try:
+                values[f.name] = _parse(f.metadata["env"], raw, f.type, f.metadata["choices"])
+            except ValueError as e:
+                errors.append(str(e))
+        if errors:
+            raise ValueError("Cấu hình không hợp lệ:\n  " + "\n  ".join(errors))
+        return cls(**values)
+
+
+load_dotenv()
+settings = Settings.from_env()
@@ -1,45 +1,657 @@
+import asyncio
 import json
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
 
 import aiosqlite
 
-DB_PATH = "chat_history.db"
+from config import settings
+from metrics import STAGE_SECONDS
+
+DB_PATH = settings.db_path
+DB_READER_POOL_SIZE = settings.db_reader_pool_size
+# Write-behind: gom các lượt hội thoại trong bộ nhớ rồi ghi theo lô (mặc định tắt).
+DB_WRITE_BEHIND = settings.db_write_behind
+DB_FLUSH_INTERVAL_MS = settings.db_flush_interval_ms
+DB_FLUSH_MAX_ROWS = settings.db_flush_max_rows
+# Số id mỗi truy vấn ``get_citations`` (dưới giới hạn tham số của SQLite)
+_CITATION_CHUNK = 500
+
+_INSERT_MESSAGE_SQL = """
+    INSERT INTO chat_history (telegram_user_id, session_id, role, content, token_count)
+    VALUES (?, ?, ?, ?, ?)
+"""
+_INTERN_URL_SQL = "INSERT OR IGNORE INTO urls (url) VALUES (?)"
+_INSERT_CITATION_SQL = """
+    INSERT INTO message_citations (message_id, position, url_id)
+    SELECT ?, ?, id FROM urls WHERE url = ?
+"""
+# Trích dẫn của một tin nhắn dưới dạng mảng JSON (đúng thứ tự), cho các đường đọc
+# cần giữ định dạng cũ của cột ``citations`` (lưu trữ)
+_CITATIONS_JSON_SQL = """
+    (SELECT json_group_array(url)
+     FROM (SELECT u.url
+           FROM message_citations c
+                    JOIN urls u ON u.id = c.url_id
+           WHERE c.message_id = chat_history.id
+           ORDER BY c.position))
+"""
+
+# Pragma áp dụng cho mọi connection; journal_mode=WAL được đặt riêng trên writer
+# vì nó lưu vào file database, chỉ cần đặt một lần.
+_CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -16000",  # ~16 MB page cache mỗi connection
+    "PRAGMA mmap_size = 268435456",  # 256 MB memory-mapped I/O
+    "PRAGMA temp_store = MEMORY",
+)
+
+logger = logging.getLogger(__name__)
+
+
+class _ConnectionPool:
+    """Giữ các connection aiosqlite sống suốt vòng đời bot.
+
+    - Một writer duy nhất, mọi thao tác ghi được tuần tự hoá qua ``write_lock``.
+    - Nhiều reader (``query_only``) lấy ra/trả về qua một ``asyncio.Queue``;
+      nhờ WAL, reader không bị writer chặn.
+
+    Mỗi connection aiosqlite sở hữu một worker thread, nên việc mở một lần thay vì
+    connect-per-call loại bỏ chi phí tạo thread và mở lại file cho mỗi truy vấn.
+    """
+
+    def __init__(self, writer: aiosqlite.Connection, readers: list[aiosqlite.Connection]):
+        self.writer = writer
+        self.write_lock = asyncio.Lock()
+        self._all_readers = readers
+        self.readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        for conn in readers:
+            self.readers.put_nowait(conn)
+
+    async def close(self) -> None:
+        for conn in self._all_readers:
+            await conn.close()
+        await self.writer.close()
+
+
+class _WriteBehindBuffer:
+    """Gom các row ``chat_history`` và ghi chúng trong một transaction duy nhất.
+
+    Flush khi đủ ``max_rows`` row, sau ``interval`` giây kể từ row đầu tiên đang chờ,
+    trước mỗi lần đọc lịch sử và khi đóng database. Hai row của cùng một lượt hội thoại
+    luôn được thêm cùng lúc nên không bao giờ bị tách ra hai transaction.
+    """
+
+    def __init__(self, max_rows: int, interval: float):
+        self.max_rows = max(1, max_rows)
+        self.interval = interval
+        self.flushes = 0
+        self.rows_written = 0
+        self._rows: list[tuple] = []
+        self._timer: asyncio.Task | None = None
+        self._flush_tasks: set[asyncio.Task] = set()
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def add(self, rows: list[tuple]) -> None:
+        self._rows.extend(rows)
+        if len(self._rows) >= self.max_rows:
+            self._cancel_timer()
+            task = asyncio.create_task(self.flush())
+            self._flush_tasks.add(task)
+            task.add_done_callback(self._flush_done)
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def flush(self) -> None:
+        """Ghi mọi row đang chờ. Chờ cả lượt flush đang chạy dở, nên khi hàm trả về thì
+        mọi row đã ``add`` trước lúc gọi đều đã được commit."""
+        self._cancel_timer()
+        # Các lượt flush chạy lần lượt: row đã lấy ra khỏi ``_rows`` nhưng chưa commit
+        # vẫn được lượt sau chờ, và không lượt nào commit row mới hơn trước chúng.
+        async with self._flush_lock:
+            if not self._rows:
+                return
+            rows, self._rows = self._rows, []
+            try:
+                async with _writer() as db:
+                    await _write_messages(db, rows)
+            except BaseException:
+                # Chưa lượt nào khác ghi được row mới hơn: trả về đầu hàng đợi vẫn giữ đúng thứ tự
+                self._rows[:0] = rows
+                raise
+            self.flushes += 1
+            self.rows_written += len(rows)
+
+    def _flush_done(self, task: asyncio.Task) -> None:
+        self._flush_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Write-behind flush thất bại: %s, %d row đang chờ", task.exception(), len(self._rows))
+            if self._timer is None:
+                self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.interval)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Write-behind flush thất bại, %d row đang chờ", len(self._rows))
+            self._timer = asyncio.create_task(self._flush_later())
+
+    def _cancel_timer(self) -> None:
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        self._timer = None
+
+
+_pool: _ConnectionPool | None = None
+_write_behind: _WriteBehindBuffer | None = None
+# Cache session đang dùng của từng user; chỉ đổi qua new_session / switch_session
+_active_sessions: dict[int, int] = {}
+
+
+async def _open_connection(*, read_only: bool) -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(DB_PATH)
+    conn.row_factory = aiosqlite.Row
+    if not read_only:
+        # Chỉ có hiệu lực với database mới; database cũ được chuyển bằng VACUUM (maintenance.py)
+        await conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await conn.execute("PRAGMA journal_mode = WAL")
+    for pragma in _CONNECTION_PRAGMAS:
+        await conn.execute(pragma)
+    if read_only:
+        await conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+async def open_db() -> None:
+    """Mở writer + reader pool. Gọi một lần trong ``post_init``."""
+    global _pool, _write_behind
+    if _pool is not None:
+        return
+    # Writer trước (bật WAL cho file mới), rồi các reader song song: mỗi connection
+    # aiosqlite có thread riêng
+    writer = await _open_connection(read_only=False)
+    readers = list(await asyncio.gather(
+        *(_open_connection(read_only=True) for _ in range(max(1, DB_READER_POOL_SIZE)))
+    ))
+    _pool = _ConnectionPool(writer, readers)
+    logger.info("Đã mở connection pool SQLite | readers=%d", len(readers))
+    if DB_WRITE_BEHIND:
+        _write_behind = _WriteBehindBuffer(DB_FLUSH_MAX_ROWS, DB_FLUSH_INTERVAL_MS / 1000)
+        logger.info(
+            "Bật write-behind | max_rows=%d | interval=%dms", DB_FLUSH_MAX_ROWS, DB_FLUSH_INTERVAL_MS
+        )
+
+
+async def close_db() -> None:
+    """Ghi nốt các row write-behind rồi đóng toàn bộ connection. Gọi trong ``post_shutdown``."""
+    global _pool, _write_behind
+    if _pool is None:
+        return
+    if _write_behind is not None:
+        await _write_behind.flush()
+        logger.info(
+            "Write-behind: %d row trong %d lần flush",
+            _write_behind.rows_written, _write_behind.flushes,
+        )
+        _write_behind = None
+    pool, _pool = _pool, None
+    _active_sessions.clear()
+    await pool.close()
+    logger.info("Đã đóng connection pool SQLite.")
+
+
+def _get_pool() -> _ConnectionPool:
+    if _pool is None:
+        raise RuntimeError("Database chưa được mở — cần gọi open_db() trước.")
+    return _pool
+
+
+async def _flush_pending() -> None:
+    """Ghi các row write-behind đang chờ để lần đọc/xoá tiếp theo thấy chúng.
+
+    Luôn gọi ``flush`` kể cả khi buffer rỗng: row có thể đang nằm trong một lượt flush
+    của timer chưa commit xong.
+    """
+    if _write_behind is not None:
+        await _write_behind.flush()
+
+
+@asynccontextmanager
+async def _reader() -> AsyncIterator[aiosqlite.Connection]:
+    """Mượn một reader connection từ pool, trả lại khi xong."""
+    pool = _get_pool()
+    conn = await pool.readers.get()
+    try:
+        yield conn
+    finally:
+        pool.readers.put_nowait(conn)
+
+
+@asynccontextmanager
+async def _writer() -> AsyncIterator[aiosqlite.Connection]:
+    """Độc quyền writer connection; commit khi thành công, rollback khi lỗi."""
+    pool = _get_pool()
+    async with pool.write_lock:
+        with STAGE_SECONDS.time(stage="db_write"):
+            try:
+                yield pool.writer
+            except BaseException:
+                await pool.writer.rollback()
+                raise
+            await pool.writer.commit()
+
+
+# Migration schema, áp dụng theo thứ tự dựa trên ``PRAGMA user_version``.
+# Mỗi phần tử là (version, các câu lệnh); chỉ được thêm mới vào cuối, không sửa
+# migration đã phát hành. Version 1 dùng ``IF NOT EXISTS`` để nhận cả database
+# được tạo trước khi có cơ chế migration (user_version = 0).
+_MIGRATIONS: list[tuple[int, tuple[str, ...]]] = [
+    (1, (
+        """
+        CREATE TABLE IF NOT EXISTS chat_history
+        (
+            id               INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_user_id INTEGER NOT NULL,
+            role             TEXT    NOT NULL CHECK (role IN ('user', 'assistant')),
+            content          TEXT    NOT NULL,
+            citations        TEXT     DEFAULT '[]',
+            timestamp        DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_user_id ON chat_history (telegram_user_id)",
+        """
+        CREATE TABLE IF NOT EXISTS answer_cache
+        (
+            cache_key  TEXT PRIMARY KEY,
+            answer     TEXT NOT NULL,
+            citations  TEXT DEFAULT '[]',
+            expires_at REAL NOT NULL
+        )
+        """,
+    )),
+    # Truy vấn lịch sử lọc theo user và sắp xếp theo id: index (telegram_user_id, id)
+    # trả row theo đúng thứ tự cần, không phải sort toàn bộ lịch sử của user.
+    (2, (
+        "CREATE INDEX IF NOT EXISTS idx_chat_history_user_id ON chat_history (telegram_user_id, id)",
+        "DROP INDEX IF EXISTS idx_user_id",
+    )),
+    # Số token ước lượng của mỗi tin nhắn, tính một lần lúc ghi (cùng công thức với
+    # ``estimate_tokens``), và bản tóm tắt cuốn chiếu của phần lịch sử đã rơi khỏi context.
+    (3, (
+        "ALTER TABLE chat_history ADD COLUMN token_count INTEGER",
+        "UPDATE chat_history SET token_count = (length(CAST(content AS BLOB)) + 3) / 4",
+        """
+        CREATE TABLE IF NOT EXISTS conversation_summaries
+        (
+            telegram_user_id INTEGER PRIMARY KEY,
+            summary          TEXT    NOT NULL,
+            through_id       INTEGER NOT NULL,
+            token_count      INTEGER NOT NULL,
+            updated_at       DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    )),
+    # Phiên hội thoại: mỗi tin nhắn thuộc một session, mỗi user có một session đang
+    # dùng. Lịch sử cũ được gom vào một session cho mỗi user; tóm tắt chuyển sang
+    # khoá theo session.
+    (4, (
+        """
+        CREATE TABLE IF NOT EXISTS sessions
+        (
+            id               INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_user_id INTEGER NOT NULL,
+            title            TEXT,
+            created_at       DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_sessions_user_id ON sessions (telegram_user_id, id)",
+        """
+        CREATE TABLE IF NOT EXISTS active_sessions
+        (
+            telegram_user_id INTEGER PRIMARY KEY,
+            session_id       INTEGER NOT NULL
+        )
+        """,
+        "ALTER TABLE chat_history ADD COLUMN session_id INTEGER",
+        """
+        INSERT INTO sessions (telegram_user_id, created_at)
+        SELECT telegram_user_id, MIN(timestamp)
+        FROM chat_history
+        GROUP BY telegram_user_id
+        """,
+        """
+        UPDATE chat_history
+        SET session_id = (SELECT s.id FROM sessions s WHERE s.telegram_user_id = chat_history.telegram_user_id)
+        """,
+        "INSERT INTO active_sessions (telegram_user_id, session_id) SELECT telegram_user_id, id FROM sessions",
+        "CREATE INDEX IF NOT EXISTS idx_chat_history_session_id ON chat_history (session_id, id)",
+        """
+        CREATE TABLE IF NOT EXISTS session_summaries
+        (
+            session_id  INTEGER PRIMARY KEY,
+            summary     TEXT    NOT NULL,
+            through_id  INTEGER NOT NULL,
+            token_count INTEGER NOT NULL,
+            updated_at  DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        INSERT INTO session_summaries (session_id, summary, through_id, token_count, updated_at)
+        SELECT s.id, c.summary, c.through_id, c.token_count, c.updated_at
+        FROM conversation_summaries c
+                 JOIN sessions s ON s.telegram_user_id = c.telegram_user_id
+        """,
+        "DROP TABLE conversation_summaries",
+    )),
+    # Tìm kiếm toàn văn: bảng FTS5 external content trỏ vào chat_history (không lưu
+    # lại nội dung), đồng bộ bằng trigger; 'rebuild' đánh index cho dữ liệu cũ.
+    # remove_diacritics 2: "ha noi" khớp "Hà Nội".
+    (5, (
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS chat_history_fts USING fts5
+        (
+            content,
+            content = 'chat_history',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS chat_history_fts_insert AFTER INSERT ON chat_history
+        BEGIN
+            INSERT INTO chat_history_fts (rowid, content) VALUES (new.id, new.content);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS chat_history_fts_delete AFTER DELETE ON chat_history
+        BEGIN
+            INSERT INTO chat_history_fts (chat_history_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS chat_history_fts_update AFTER UPDATE OF content ON chat_history
+        BEGIN
+            INSERT INTO chat_history_fts (chat_history_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO chat_history_fts (rowid, content) VALUES (new.id, new.content);
+        END
+        """,
+        "INSERT INTO chat_history_fts (chat_history_fts) VALUES ('rebuild')",
+    )),
+    # Nhiều người dùng: danh sách được phép và vai trò, hạn mức riêng (NULL: mặc định),
+    # số câu hỏi mỗi ngày để áp hạn mức ngày cả khi bot khởi động lại.
+    (6, (
+        """
+        CREATE TABLE IF NOT EXISTS users
+        (
+            telegram_user_id INTEGER PRIMARY KEY,
+            role             TEXT NOT NULL DEFAULT 'user' CHECK (role IN ('admin', 'user')),
+            daily_quota      INTEGER,
+            added_by         INTEGER,
+            added_at         DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS usage_daily
+        (
+            telegram_user_id INTEGER NOT NULL,
+            day              TEXT    NOT NULL,
+            questions        INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (telegram_user_id, day)
+        ) WITHOUT ROWID
+        """,
+    )),
+    # Lưu trữ: tin nhắn quá hạn giữ lại (chế độ ARCHIVE_MODE=table) ngoài bảng nóng.
+    (7, (
+        """
+        CREATE TABLE IF NOT EXISTS chat_history_archive
+        (
+            id               INTEGER PRIMARY KEY,
+            telegram_user_id INTEGER NOT NULL,
+            session_id       INTEGER,
+            role             TEXT    NOT NULL,
+            content          TEXT    NOT NULL,
+            citations        TEXT,
+            token_count      INTEGER,
+            timestamp        DATETIME,
+            archived_at      DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_chat_history_archive_user_id ON chat_history_archive (telegram_user_id, id)",
+    )),
+    # Trích dẫn chuẩn hoá: mỗi URL lưu một lần trong ``urls``, tin nhắn trỏ tới nó qua
+    # ``message_citations`` (thứ tự theo ``position``). Đường đọc context không còn
+    # đọc hay parse JSON trích dẫn; export/tìm kiếm nạp chúng riêng khi cần.
+    # Dữ liệu cũ được chuyển từ cột JSON rồi bỏ cột (SQLite >= 3.35).
+    (8, (
+        """
+        CREATE TABLE IF NOT EXISTS urls
+        (
+            id  INTEGER PRIMARY KEY,
+            url TEXT NOT NULL UNIQUE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS message_citations
+        (
+            message_id INTEGER NOT NULL,
+            position   INTEGER NOT NULL,
+            url_id     INTEGER NOT NULL,
+            PRIMARY KEY (message_id, position)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS chat_history_citations_delete AFTER DELETE ON chat_history
+        BEGIN
+            DELETE FROM message_citations WHERE message_id = old.id;
+        END
+        """,
+        """
+        INSERT OR IGNORE INTO urls (url)
+        SELECT j.value
+        FROM chat_history h, json_each(h.citations) j
+        WHERE json_valid(h.citations) AND j.type = 'text'
+        ORDER BY h.id, j.key
+        """,
+        """
+        INSERT OR IGNORE INTO message_citations (message_id, position, url_id)
+        SELECT h.id, j.key, u.id
+        FROM chat_history h, json_each(h.citations) j
+                 JOIN urls u ON u.url = j.value
+        WHERE json_valid(h.citations) AND j.type = 'text'
+        """,
+        "ALTER TABLE chat_history DROP COLUMN citations",
+    )),
+    # Câu hỏi đã nhận nhưng chưa trả lời xong, khoá theo ``update_id`` của Telegram:
+    # khôi phục sau khi bot dừng giữa chừng, và bỏ qua update bị gửi lại (idempotency).
+    # Row đã xong được giữ vài ngày (không giữ nội dung) để vẫn nhận ra update trùng.
+    (9, (
+        """
+        CREATE TABLE IF NOT EXISTS pending_requests
+        (
+            update_id        INTEGER PRIMARY KEY,
+            telegram_user_id INTEGER NOT NULL,
+            chat_id          INTEGER NOT NULL,
+            message_id       INTEGER NOT NULL,
+            text             TEXT    NOT NULL,
+            status           TEXT    NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'done')),
+            attempts         INTEGER NOT NULL DEFAULT 0,
+            created_at       REAL    NOT NULL,
+            finished_at      REAL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_pending_requests_pending ON pending_requests (update_id)"
+        " WHERE status = 'pending'",
+    )),
+    # Cách trả lời câu hỏi (chat | deep), để câu hỏi /deep được khôi phục đúng chế độ.
+    (10, (
+        "ALTER TABLE pending_requests ADD COLUMN mode TEXT NOT NULL DEFAULT 'chat'",
+    )),
+]
+SCHEMA_VERSION = _MIGRATIONS[-1][0]
+
+
+def estimate_tokens(text: str) -> int:
+    """Ước lượng số token của một đoạn văn bản: ~4 byte UTF-8 mỗi token.
+
+    Không cần tokenizer thật: chữ Việt có dấu chiếm 2–3 byte nên được tính nặng hơn
+    chữ ASCII, gần với cách tokenizer BPE tách chúng. Migration 3 dùng cùng công thức
+    để điền ``token_count`` cho dữ liệu cũ.
+    """
+    return (len(text.encode("utf-8")) + 3) // 4
+
+
+async def _migrate() -> int:
+    """Đưa schema lên ``SCHEMA_VERSION``, mỗi migration trong một transaction riêng.
+
+    Schema đã mới nhất (trường hợp thường gặp khi khởi động lại) chỉ tốn một lần đọc
+    ``PRAGMA user_version``, không chạy câu DDL nào.
+
+    Returns:
+        Version của schema trước khi migrate.
+
+    Raises:
+        RuntimeError: Database được tạo bởi phiên bản bot mới hơn.
+    """
+    async with _writer() as db:
+        async with db.execute("PRAGMA user_version") as cursor:
+            current = (await cursor.fetchone())[0]
+        if current == SCHEMA_VERSION:
+            return current
+        if current > SCHEMA_VERSION:
+            raise RuntimeError(
+                f"Database {DB_PATH} có schema version {current}, mới hơn bản này hỗ trợ ({SCHEMA_VERSION})"
+            )
+
+    for version, statements in _MIGRATIONS:
+        if version <= current:
+            continue
+        async with _writer() as db:
+            await db.execute("BEGIN")
+            for statement in statements:
+                await db.execute(statement)
+            # user_version nằm trong header file nên được commit/rollback cùng migration.
+            await db.execute(f"PRAGMA user_version = {version}")
+        logger.info("Đã migrate database lên version %d", version)
+    return current
 
 
 async def init_db():
-    """Khởi tạo database và tạo bảng nếu chưa tồn tại."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-                         CREATE TABLE IF NOT EXISTS chat_history
-                         (
-                             id
-                             INTEGER
-                             PRIMARY
-                             KEY
-                             AUTOINCREMENT,
-                             telegram_user_id
-                             INTEGER
-                             NOT
-                             NULL,
-                             role
-                             TEXT
-                             NOT
-                             NULL
-                             CHECK (
-                             role
-                             IN
-                         (
-                             'user',
-                             'assistant'
-                         )),
-                             content TEXT NOT NULL,
-                             citations TEXT DEFAULT '[]',
-                             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                             )
-                         """)
+    """Mở connection pool, chạy các migration còn thiếu và dọn cache hết hạn."""
+    await open_db()
+    await _migrate()
+    await purge_expired_answers(time.time())
+
+
+async def _create_session(db: aiosqlite.Connection, telegram_user_id: int, title: str | None) -> int:
+    async with db.execute(
+            "INSERT INTO sessions (telegram_user_id, title) VALUES (?, ?)",
+            (telegram_user_id, title),
+    ) as cursor:
+        session_id = cursor.lastrowid
+    await db.execute(
+        "INSERT OR REPLACE INTO active_sessions (telegram_user_id, session_id) VALUES (?, ?)",
+        (telegram_user_id, session_id),
+    )
+    return session_id
+
+
+async def get_active_session(telegram_user_id: int) -> int:
+    """Trả về id session đang dùng của user, tạo session đầu tiên nếu chưa có."""
+    session_id = _active_sessions.get(telegram_user_id)
+    if session_id is not None:
+        return session_id
+    # Kiểm tra và tạo trong cùng writer lock để hai lời gọi đồng thời không tạo hai session
+    async with _writer() as db:
+        async with db.execute(
+                "SELECT session_id FROM active_sessions WHERE telegram_user_id = ?",
+                (telegram_user_id,),
+        ) as cursor:
+            row = await cursor.fetchone()
+        session_id = row[0] if row else await _create_session(db, telegram_user_id, None)
+    _active_sessions[telegram_user_id] = session_id
+    return session_id
+
+
+async def new_session(telegram_user_id: int, title: str | None = None) -> int:
+    """Mở một session mới và chuyển user sang đó. Lịch sử cũ được giữ nguyên.
+
+    Args:
+        telegram_user_id: ID của người dùng Telegram.
+        title: Tên session (tuỳ chọn; mặc định hiển thị câu hỏi đầu tiên).
+
+    Returns:
+        id của session mới.
+    """
+    async with _writer() as db:
+        session_id = await _create_session(db, telegram_user_id, title)
+    _active_sessions[telegram_user_id] = session_id
+    return session_id
+
+
+async def switch_session(telegram_user_id: int, session_id: int) -> bool:
+    """Chuyển user sang một session có sẵn của chính user đó.
+
+    Returns:
+        False nếu session không tồn tại hoặc thuộc user khác.
+    """
+    async with _writer() as db:
+        async with db.execute(
+                "SELECT 1 FROM sessions WHERE id = ? AND telegram_user_id = ?",
+                (session_id, telegram_user_id),
+        ) as cursor:
+            if await cursor.fetchone() is None:
+                return False
         await db.execute(
-            "CREATE INDEX IF NOT EXISTS idx_user_id ON chat_history (telegram_user_id)"
+            "INSERT OR REPLACE INTO active_sessions (telegram_user_id, session_id) VALUES (?, ?)",
+            (telegram_user_id, session_id),
         )
-        await db.commit()
+    _active_sessions[telegram_user_id] = session_id
+    return True
+
+
+async def list_sessions(telegram_user_id: int, limit: int = 10) -> list[dict]:
+    """Liệt kê các session gần nhất của user, mới nhất trước.
+
+    Returns:
+        Danh sách dict với các key: id, title, created_at, message_count,
+        first_message, last_at.
+    """
+    await _flush_pending()
+    async with _reader() as db:
+        async with db.execute(
+                """
+                SELECT s.id,
+                       s.title,
+                       s.created_at,
+                       (SELECT COUNT(*) FROM chat_history h WHERE h.session_id = s.id) AS message_count,
+                       (SELECT h.content
+                        FROM chat_history h
+                        WHERE h.session_id = s.id
+                        ORDER BY h.id
+                        LIMIT 1)                                                         AS first_message,
+                       (SELECT h.timestamp
+                        FROM chat_history h
+                        WHERE h.session_id = s.id
+                        ORDER BY h.id DESC
+                        LIMIT 1)                                                         AS last_at
+                FROM sessions s
+                WHERE s.telegram_user_id = ?
+                ORDER BY s.id DESC
+                LIMIT ?
+                """,
+                (telegram_user_id, limit),
+        ) as cursor:
+            rows = await cursor.fetchall()
+    return [dict(row) for row in rows]
 
 
 async def add_message(
@@ -47,6 +659,7 @@ async def add_message(
         role: str,
         content: str,
         citations: list[str] | None = None,
+        session_id: int | None = None,
 ):
     """Thêm một tin nhắn mới vào lịch sử chat.
 
@@ -55,17 +668,71 @@ async def add_message(
         role: 'user' hoặc 'assistant'.
         content: Nội dung tin nhắn.
         citations: Danh sách URL trích dẫn (chỉ dùng cho role='assistant').
+        session_id: Session chứa tin nhắn (mặc định: session đang dùng của user).
     """
-    citations_json = json.dumps(citations or [], ensure_ascii=False)
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """
-            INSERT INTO chat_history (telegram_user_id, role, content, citations)
-            VALUES (?, ?, ?, ?)
-            """,
-            (telegram_user_id, role, content, citations_json),
-        )
-        await db.commit()
+    if session_id is None:
+        session_id = await get_active_session(telegram_user_id)
+    await _insert_messages([
+        (telegram_user_id, session_id, role, content, estimate_tokens(content), citations),
+    ])
+
+
+async def add_turn(
+        telegram_user_id: int,
+        user_text: str,
+        answer: str,
+        citations: list[str] | None = None,
+        session_id: int | None = None,
+):
+    """Lưu một lượt hội thoại (câu hỏi + câu trả lời) trong cùng một transaction.
+
+    Không bao giờ có trường hợp chỉ câu hỏi được lưu mà thiếu câu trả lời:
+    cả hai row cùng được commit hoặc cùng không.
+
+    Args:
+        telegram_user_id: ID của người dùng Telegram.
+        user_text: Câu hỏi của user.
+        answer: Câu trả lời của assistant.
+        citations: Danh sách URL trích dẫn của câu trả lời.
+        session_id: Session của câu hỏi (mặc định: session đang dùng của user).
+    """
+    if session_id is None:
+        session_id = await get_active_session(telegram_user_id)
+    await _insert_messages([
+        (telegram_user_id, session_id, "user", user_text, estimate_tokens(user_text), None),
+        (telegram_user_id, session_id, "assistant", answer, estimate_tokens(answer), citations),
+    ])
+
+
+async def _insert_messages(rows: list[tuple]) -> None:
+    """Ghi ngay trong một transaction, hoặc đưa vào buffer khi bật write-behind."""
+    if _write_behind is not None:
+        _write_behind.add(rows)
+        return
+    async with _writer() as db:
+        await _write_messages(db, rows)
+
+
+async def _write_messages(db: aiosqlite.Connection, rows: list[tuple]) -> None:
+    """Ghi các row ``(user_id, session_id, role, content, token_count, citations)``.
+
+    Chạy trong transaction của writer: các row nhận id liên tiếp (chỉ một writer,
+    ``AUTOINCREMENT``), nên id của từng row suy ra từ ``last_insert_rowid()`` mà
+    không phải ghi từng row một. URL trích dẫn được intern vào ``urls`` rồi nối với
+    tin nhắn qua ``message_citations``; cả lô chỉ tốn vài lệnh ``executemany``.
+    """
+    await db.executemany(_INSERT_MESSAGE_SQL, [row[:5] for row in rows])
+    if not any(row[5] for row in rows):
+        return
+    async with db.execute("SELECT last_insert_rowid()") as cursor:
+        first_id = (await cursor.fetchone())[0] - len(rows) + 1
+    links = [
+        (message_id, position, url)
+        for message_id, row in enumerate(rows, first_id)
+        for position, url in enumerate(row[5] or ())
+    ]
+    await db.executemany(_INTERN_URL_SQL, [(url,) for _, _, url in links])
+    await db.executemany(_INSERT_CITATION_SQL, links)
 
 
 async def get_recent_messages(telegram_user_id: int, limit: int = 10) -> list[dict]:
@@ -76,18 +743,18 @@ async def get_recent_messages(telegram_user_id: int, limit: int = 10) -> list[di
         limit: Số lượng tin nhắn cần lấy (mặc định 10).
 
     Returns:
-        Danh sách dict với các key: id, role, content, citations, timestamp.
-        Được sắp xếp từ cũ đến mới (chronological order).
+        Danh sách dict với các key: id, role, content, timestamp (không kèm trích
+        dẫn, xem ``get_citations``). Được sắp xếp từ cũ đến mới (chronological order).
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    await _flush_pending()
+    async with _reader() as db:
         async with db.execute(
                 """
-                SELECT id, role, content, citations, timestamp
+                SELECT id, role, content, timestamp
                 FROM chat_history
                 WHERE telegram_user_id = ?
-                ORDER BY timestamp DESC
-                    LIMIT ?
+                ORDER BY id DESC
+                LIMIT ?
                 """,
                 (telegram_user_id, limit),
         ) as cursor:
@@ -100,14 +767,140 @@ async def get_recent_messages(telegram_user_id: int, limit: int = 10) -> list[di
             "id": row["id"],
             "role": row["role"],
             "content": row["content"],
-            "citations": json.loads(row["citations"]),
             "timestamp": row["timestamp"],
         })
     return messages
 
 
+async def get_context_messages(
+        session_id: int,
+        max_tokens: int,
+        after_id: int = 0,
+        max_messages: int = 40,
+        message_overhead: int = 4,
+) -> tuple[list[dict], int | None]:
+    """Lấy nhiều tin nhắn gần nhất nhất có thể trong ngân sách token.
+
+    Đọc từ mới đến cũ theo index ``(session_id, id)``, từng trang nhỏ, cộng dồn
+    ``token_count`` (+ ``message_overhead`` cho mỗi tin) và dừng ở tin đầu tiên làm vượt
+    ``max_tokens`` hoặc ``max_messages``. Chỉ xét các tin có ``id > after_id`` (phần đã
+    được tóm tắt thì bỏ qua).
+
+    Args:
+        session_id: Session cần lấy context.
+        max_tokens: Ngân sách token cho phần lịch sử.
+        after_id: Chỉ lấy tin nhắn có id lớn hơn giá trị này.
+        max_messages: Số tin nhắn tối đa.
+        message_overhead: Số token cộng thêm cho mỗi tin (role, phân cách).
+
+    Returns:
+        Tuple (messages, overflow_id):
+            - messages: Danh sách dict (id, role, content, timestamp, token_count)
+              từ cũ đến mới.
+            - overflow_id: id của tin mới nhất không vừa ngân sách, hoặc None nếu toàn
+              bộ lịch sử sau ``after_id`` đã nằm trong context.
+    """
+    await _flush_pending()
+    picked: list[dict] = []
+    used = 0
+    before_id = 2 ** 63 - 1  # INTEGER lớn nhất của SQLite
+    page_size = min(max(1, max_messages), 16) + 1
+    while True:
+        async with _reader() as db:
+            async with db.execute(
+                    """
+                    SELECT id, role, content, timestamp, token_count
+                    FROM chat_history
+                    WHERE session_id = ? AND id > ? AND id < ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                    """,
+                    (session_id, after_id, before_id, page_size),
+            ) as cursor:
+                rows = await cursor.fetchall()
+        for row in rows:
+            tokens = row["token_count"]
+            if tokens is None:
+                tokens = estimate_tokens(row["content"])
+            if len(picked) >= max_messages or used + tokens + message_overhead > max_tokens:
+                picked.reverse()
+                return picked, row["id"]
+            used += tokens + message_overhead
+            picked.append({
+                "id": row["id"],
+                "role": row["role"],
+                "content": row["content"],
+                "timestamp": row["timestamp"],
+                "token_count": tokens,
+            })
+        if len(rows) < page_size:
+            picked.reverse()
+            return picked, None
+        before_id = rows[-1]["id"]
+
+
+async def get_messages_range(
+        session_id: int, after_id: int, through_id: int, limit: int
+) -> list[dict]:
+    """Lấy tối đa ``limit`` tin nhắn có ``after_id < id <= through_id``, từ cũ đến mới."""
+    await _flush_pending()
+    async with _reader() as db:
+        async with db.execute(
+                """
+                SELECT id, role, content
+                FROM chat_history
+                WHERE session_id = ? AND id > ? AND id <= ?
+                ORDER BY id ASC
+                LIMIT ?
+                """,
+                (session_id, after_id, through_id, limit),
+        ) as cursor:
+            rows = await cursor.fetchall()
+    return [{"id": row["id"], "role": row["role"], "content": row["content"]} for row in rows]
+
+
+async def get_summary(session_id: int) -> dict | None:
+    """Đọc bản tóm tắt cuốn chiếu của một session.
+
+    Returns:
+        Dict với các key: summary, through_id, token_count; hoặc None nếu chưa có.
+    """
+    async with _reader() as db:
+        async with db.execute(
+                "SELECT summary, through_id, token_count FROM session_summaries WHERE session_id = ?",
+                (session_id,),
+        ) as cursor:
+            row = await cursor.fetchone()
+    if row is None:
+        return None
+    return {"summary": row["summary"], "through_id": row["through_id"], "token_count": row["token_count"]}
+
+
+async def save_summary(session_id: int, summary: str, through_id: int) -> None:
+    """Ghi bản tóm tắt bao phủ mọi tin nhắn có ``id <= through_id``.
+
+    Không ghi đè một bản tóm tắt đã bao phủ xa hơn (hai lần cập nhật chạy chồng nhau).
+    """
+    async with _writer() as db:
+        await db.execute(
+            """
+            INSERT INTO session_summaries (session_id, summary, through_id, token_count)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (session_id) DO UPDATE SET
+                summary = excluded.summary,
+                through_id = excluded.through_id,
+                token_count = excluded.token_count,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE excluded.through_id > session_summaries.through_id
+            """,
+            (session_id, summary, through_id, estimate_tokens(summary)),
+        )
+
+
 async def clear_history(telegram_user_id: int) -> int:
-    """Xóa toàn bộ lịch sử chat của một user.
+    """Xóa vĩnh viễn toàn bộ lịch sử chat, session và tóm tắt của một user.
+
+    ``/clear`` không dùng hàm này: nó chỉ mở session mới (``new_session``).
 
     Args:
         telegram_user_id: ID của người dùng Telegram.
@@ -115,45 +908,617 @@ async def clear_history(telegram_user_id: int) -> int:
     Returns:
         Số lượng bản ghi đã xóa.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    await _flush_pending()
+    async with _writer() as db:
         async with db.execute(
                 "DELETE FROM chat_history WHERE telegram_user_id = ?",
                 (telegram_user_id,),
         ) as cursor:
             deleted_count = cursor.rowcount
-        await db.commit()
+        await db.execute(
+            "DELETE FROM session_summaries"
+            " WHERE session_id IN (SELECT id FROM sessions WHERE telegram_user_id = ?)",
+            (telegram_user_id,),
+        )
+        await db.execute("DELETE FROM sessions WHERE telegram_user_id = ?", (telegram_user_id,))
+        await db.execute("DELETE FROM active_sessions WHERE telegram_user_id = ?", (telegram_user_id,))
+    _active_sessions.pop(telegram_user_id, None)
     return deleted_count
 
 
-async def get_all_messages(telegram_user_id: int) -> list[dict]:
+async def get_all_messages(telegram_user_id: int, with_citations: bool = False) -> list[dict]:
     """Lấy toàn bộ lịch sử chat của một user, sắp xếp từ cũ đến mới.
 
     Args:
         telegram_user_id: ID của người dùng Telegram.
+        with_citations: Nạp thêm trích dẫn của các câu trả lời (``get_citations``).
 
     Returns:
-        Danh sách dict với các key: id, role, content, citations, timestamp.
+        Danh sách dict với các key: id, role, content, timestamp, và citations nếu
+        ``with_citations``.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    await _flush_pending()
+    async with _reader() as db:
         async with db.execute(
                 """
-                SELECT id, role, content, citations, timestamp
+                SELECT id, role, content, timestamp
                 FROM chat_history
                 WHERE telegram_user_id = ?
-                ORDER BY timestamp ASC
+                ORDER BY id ASC
                 """,
                 (telegram_user_id,),
         ) as cursor:
             rows = await cursor.fetchall()
 
-    return [
+    messages = [
         {
             "id": row["id"],
             "role": row["role"],
             "content": row["content"],
-            "citations": json.loads(row["citations"]),
             "timestamp": row["timestamp"],
         }
         for row in rows
     ]
+    if with_citations:
+        await _attach_citations(messages)
+    return messages
+
+
+async def count_messages(telegram_user_id: int, session_id: int | None = None) -> int:
+    """Đếm số tin nhắn của một user, hoặc của một session của user (đếm trên index)."""
+    await _flush_pending()
+    query = "SELECT COUNT(*) FROM chat_history WHERE telegram_user_id = ?"
+    params: tuple = (telegram_user_id,)
+    if session_id is not None:
+        query += " AND session_id = ?"
+        params += (session_id,)
+    async with _reader() as db:
+        async with db.execute(query, params) as cursor:
+            return (await cursor.fetchone())[0]
+
+
+async def iter_messages(
+        telegram_user_id: int,
+        page_size: int = 500,
+        session_id: int | None = None,
+        with_citations: bool = False,
+) -> AsyncIterator[dict]:
+    """Duyệt lịch sử của một user (hoặc một session của user) theo từng trang, từ cũ đến mới.
+
+    Phân trang theo keyset (``id > id cuối của trang trước``) trên index
+    ``(telegram_user_id, id)`` hoặc ``(session_id, id)``: mỗi trang là một truy vấn
+    ngắn, reader được trả về pool giữa các trang và bộ nhớ chỉ giữ một trang, bất kể
+    lịch sử dài bao nhiêu.
+
+    Args:
+        telegram_user_id: ID của người dùng Telegram.
+        page_size: Số tin nhắn đọc mỗi trang.
+        session_id: Chỉ lấy tin nhắn của session này (mặc định: mọi session).
+        with_citations: Nạp trích dẫn cho từng trang bằng một truy vấn (dùng khi export).
+
+    Yields:
+        Dict với các key: id, session_id, role, content, timestamp, và citations nếu
+        ``with_citations``.
+    """
+    await _flush_pending()
+    query = """
+        SELECT id, session_id, role, content, timestamp
+        FROM chat_history
+        WHERE telegram_user_id = ? AND id > ?
+    """
+    scope: tuple = ()
+    if session_id is not None:
+        query += " AND session_id = ?"
+        scope = (session_id,)
+    query += " ORDER BY id ASC LIMIT ?"
+    last_id = 0
+    while True:
+        async with _reader() as db:
+            async with db.execute(query, (telegram_user_id, last_id, *scope, page_size)) as cursor:
+                rows = await cursor.fetchall()
+        messages = [
+            {
+                "id": row["id"],
+                "session_id": row["session_id"],
+                "role": row["role"],
+                "content": row["content"],
+                "timestamp": row["timestamp"],
+            }
+            for row in rows
+        ]
+        if with_citations:
+            await _attach_citations(messages)
+        for message in messages:
+            yield message
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1]["id"]
+
+
+async def get_citations(message_ids: list[int]) -> dict[int, list[str]]:
+    """Trích dẫn của các tin nhắn, theo đúng thứ tự lúc lưu.
+
+    Đọc theo khoá chính ``(message_id, position)`` của ``message_citations``, mỗi
+    ``_CITATION_CHUNK`` id một truy vấn.
+
+    Returns:
+        Dict ``message_id -> danh sách URL``; tin nhắn không có trích dẫn không có mặt.
+    """
+    citations: dict[int, list[str]] = {}
+    if not message_ids:
+        return citations
+    await _flush_pending()
+    async with _reader() as db:
+        for start in range(0, len(message_ids), _CITATION_CHUNK):
+            chunk = message_ids[start:start + _CITATION_CHUNK]
+            async with db.execute(
+                    f"""
+                    SELECT c.message_id, u.url
+                    FROM message_citations c
+                             JOIN urls u ON u.id = c.url_id
+                    WHERE c.message_id IN ({", ".join("?" * len(chunk))})
+                    ORDER BY c.message_id, c.position
+                    """,
+                    chunk,
+            ) as cursor:
+                for message_id, url in await cursor.fetchall():
+                    citations.setdefault(message_id, []).append(url)
+    return citations
+
+
+async def _attach_citations(messages: list[dict]) -> None:
+    """Gắn key ``citations`` (có thể rỗng) vào các dict tin nhắn; chỉ tra câu trả lời."""
+    citations = await get_citations([m["id"] for m in messages if m["role"] == "assistant"])
+    for message in messages:
+        message["citations"] = citations.get(message["id"], [])
+
+
+# Từ / cụm từ trong ngoặc kép của câu truy vấn, tuỳ chọn kết thúc bằng * (tìm theo tiền tố)
+_SEARCH_TERM_RE = re.compile(r'"([^"]+)"|(\S+)')
+# Ký tự đánh dấu phần khớp trong snippet; người gọi thay bằng định dạng riêng
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
+
+
+def _fts_query(query: str) -> str | None:
+    """Chuyển câu tìm kiếm của người dùng thành biểu thức MATCH an toàn của FTS5.
+
+    Mỗi từ (hoặc cụm trong ngoặc kép) thành một chuỗi FTS5 được quote, nối bằng AND
+    ngầm định, nên cú pháp FTS5 (``OR``, ``NEAR``, ``:``…) trong câu hỏi không bị
+    diễn giải. ``từ*`` tìm theo tiền tố. Trả về None nếu không còn từ nào.
+    """
+    terms = []
+    for phrase, word in _SEARCH_TERM_RE.findall(query):
+        text = phrase or word
+        prefix = not phrase and text.endswith("*")
+        text = text.rstrip("*") if prefix else text
+        if not any(ch.isalnum() for ch in text):
+            continue
+        terms.append('"' + text.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(terms) or None
+
+
+async def search_messages(
+        telegram_user_id: int, query: str, limit: int = 5, offset: int = 0
+) -> tuple[list[dict], bool]:
+    """Tìm tin nhắn của một user bằng FTS5, xếp theo độ liên quan (bm25).
+
+    FTS5 trả các tin nhắn khớp qua index (không quét ``content`` như ``LIKE``), lọc
+    theo user bằng khoá chính của ``chat_history``. Đo trong ``bench/bench_search.py``:
+    lọc sau JOIN nhanh hơn đưa user_id vào biểu thức MATCH, vì danh sách tin nhắn
+    của user dài hơn nhiều so với danh sách tin nhắn khớp từ khoá.
+
+    Args:
+        telegram_user_id: ID của người dùng Telegram.
+        query: Câu tìm kiếm của người dùng (xem ``_fts_query``).
+        limit: Số kết quả mỗi trang.
+        offset: Số kết quả bỏ qua (trang trước).
+
+    Returns:
+        Tuple (results, has_more). Mỗi kết quả là dict với các key: id, session_id,
+        role, timestamp, snippet (phần khớp nằm giữa ``SNIPPET_START``/``SNIPPET_END``).
+    """
+    match = _fts_query(query)
+    if match is None:
+        return [], False
+    await _flush_pending()
+    async with _reader() as db:
+        async with db.execute(
+                f"""
+                SELECT h.id, h.session_id, h.role, h.timestamp,
+                       snippet(chat_history_fts, 0, '{SNIPPET_START}', '{SNIPPET_END}', '…', 16) AS snippet
+                FROM chat_history_fts
+                         JOIN chat_history h ON h.id = chat_history_fts.rowid
+                WHERE chat_history_fts MATCH ?
+                  AND h.telegram_user_id = ?
+                ORDER BY bm25(chat_history_fts)
+                LIMIT ? OFFSET ?
+                """,
+                (match, telegram_user_id, limit + 1, offset),
+        ) as cursor:
+            rows = await cursor.fetchall()
+
+    results = [
+        {
+            "id": row["id"],
+            "session_id": row["session_id"],
+            "role": row["role"],
+            "timestamp": row["timestamp"],
+            "snippet": row["snippet"],
+        }
+        for row in rows[:limit]
+    ]
+    return results, len(rows) > limit
+
+
+async def list_users() -> list[dict]:
+    """Danh sách user được phép dùng bot, admin trước.
+
+    Returns:
+        Danh sách dict với các key: telegram_user_id, role, daily_quota, added_by, added_at.
+    """
+    async with _reader() as db:
+        async with db.execute(
+                """
+                SELECT telegram_user_id, role, daily_quota, added_by, added_at
+                FROM users
+                ORDER BY role = 'admin' DESC, added_at, telegram_user_id
+                """
+        ) as cursor:
+            return [dict(row) for row in await cursor.fetchall()]
+
+
+async def upsert_user(
+        telegram_user_id: int,
+        role: str = "user",
+        daily_quota: int | None = None,
+        added_by: int | None = None,
+) -> None:
+    """Thêm user vào danh sách được phép, hoặc cập nhật vai trò và hạn mức nếu đã có."""
+    async with _writer() as db:
+        await db.execute(
+            """
+            INSERT INTO users (telegram_user_id, role, daily_quota, added_by)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (telegram_user_id) DO UPDATE SET
+                role = excluded.role,
+                daily_quota = excluded.daily_quota
+            """,
+            (telegram_user_id, role, daily_quota, added_by),
+        )
+
+
+async def delete_user(telegram_user_id: int) -> bool:
+    """Bỏ user khỏi danh sách được phép (lịch sử chat vẫn giữ). Trả về False nếu không có."""
+    async with _writer() as db:
+        async with db.execute("DELETE FROM users WHERE telegram_user_id = ?", (telegram_user_id,)) as cursor:
+            return cursor.rowcount > 0
+
+
+async def take_daily_usage(telegram_user_id: int, day: str, limit: int) -> int | None:
+    """Tính thêm một câu hỏi vào ngày ``day`` (YYYY-MM-DD) nếu user chưa dùng hết ``limit``.
+
+    Kiểm tra và cộng trong cùng một câu lệnh, nên hai câu hỏi đến cùng lúc không thể
+    cùng lọt qua khi chỉ còn một lượt.
+
+    Returns:
+        Số câu hỏi trong ngày sau khi cộng, hoặc None nếu đã đủ ``limit``.
+    """
+    async with _writer() as db:
+        async with db.execute(
+                """
+                INSERT INTO usage_daily (telegram_user_id, day, questions)
+                VALUES (?, ?, 1)
+                ON CONFLICT (telegram_user_id, day) DO UPDATE SET questions = questions + 1
+                WHERE questions < ?
+                RETURNING questions
+                """,
+                (telegram_user_id, day, limit),
+        ) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else None
+
+
+async def refund_daily_usage(telegram_user_id: int, day: str) -> None:
+    """Trả lại một câu hỏi đã tính vào ngày ``day`` (câu hỏi không được trả lời)."""
+    async with _writer() as db:
+        await db.execute(
+            "UPDATE usage_daily SET questions = questions - 1 WHERE telegram_user_id = ? AND day = ? AND questions > 0",
+            (telegram_user_id, day),
+        )
+
+
+async def begin_request(
+        update_id: int,
+        telegram_user_id: int,
+        chat_id: int,
+        message_id: int,
+        text: str,
+        now: float,
+        mode: str = "chat",
+) -> bool:
+    """Ghi nhận một câu hỏi vừa nhận, trước khi xếp hàng hay gọi Perplexity.
+
+    Returns:
+        False nếu ``update_id`` đã được ghi nhận trước đó (Telegram gửi lại update
+        sau khi bot khởi động lại) — khi đó không được xử lý lần nữa.
+    """
+    async with _writer() as db:
+        async with db.execute(
+                """
+                INSERT OR IGNORE INTO pending_requests
+                    (update_id, telegram_user_id, chat_id, message_id, text, created_at, mode)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (update_id, telegram_user_id, chat_id, message_id, text, now, mode),
+        ) as cursor:
+            return cursor.rowcount > 0
+
+
+async def finish_requests(update_ids: list[int], now: float) -> None:
+    """Đánh dấu các câu hỏi đã xử lý xong; nội dung câu hỏi không còn cần giữ."""
+    if not update_ids:
+        return
+    async with _writer() as db:
+        await db.executemany(
+            "UPDATE pending_requests SET status = 'done', text = '', finished_at = ? WHERE update_id = ?",
+            [(now, update_id) for update_id in update_ids],
+        )
+
+
+async def get_pending_requests() -> list[dict]:
+    """Các câu hỏi chưa xử lý xong, theo thứ tự nhận.
+
+    Returns:
+        Danh sách dict với các key: update_id, telegram_user_id, chat_id, message_id,
+        text, attempts, created_at, mode.
+    """
+    async with _reader() as db:
+        async with db.execute(
+                """
+                SELECT update_id, telegram_user_id, chat_id, message_id, text, attempts, created_at, mode
+                FROM pending_requests
+                WHERE status = 'pending'
+                ORDER BY update_id
+                """
+        ) as cursor:
+            return [dict(row) for row in await cursor.fetchall()]
+
+
+async def count_pending_requests() -> int:
+    """Số câu hỏi chưa xử lý xong."""
+    async with _reader() as db:
+        async with db.execute("SELECT COUNT(*) FROM pending_requests WHERE status = 'pending'") as cursor:
+            return (await cursor.fetchone())[0]
+
+
+async def mark_request_attempt(update_id: int) -> None:
+    """Tăng số lần thử của một câu hỏi trước khi xử lý lại nó sau khi khởi động."""
+    async with _writer() as db:
+        await db.execute(
+            "UPDATE pending_requests SET attempts = attempts + 1 WHERE update_id = ?", (update_id,)
+        )
+
+
+# ----------------------------------------------------------------------------
+# Bảo trì (retention, lưu trữ, vacuum) — được gọi từ maintenance.py
+# ----------------------------------------------------------------------------
+
+async def find_first_id_since(timestamp: str) -> int | None:
+    """Id nhỏ nhất có ``timestamp >= timestamp`` (UTC, dạng ``YYYY-MM-DD HH:MM:SS``).
+
+    ``timestamp`` không có index, nhưng id tăng cùng thời gian ghi nên tìm nhị phân
+    trên khoá chính: mỗi bước một lần tra index, thay vì quét cả bảng.
+
+    Returns:
+        Id tìm được; ``max(id) + 1`` nếu mọi tin nhắn đều cũ hơn; None nếu bảng rỗng.
+    """
+    await _flush_pending()
+    async with _reader() as db:
+        async with db.execute("SELECT MIN(id), MAX(id) FROM chat_history") as cursor:
+            lo, hi = await cursor.fetchone()
+        if lo is None:
+            return None
+        hi += 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            async with db.execute(
+                    "SELECT id, timestamp FROM chat_history WHERE id >= ? ORDER BY id LIMIT 1", (mid,)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row is None or row["timestamp"] >= timestamp:
+                hi = mid
+            else:
+                lo = row["id"] + 1
+    return lo
+
+
+async def get_row_cap_cutoffs(max_rows: int) -> list[tuple[int, int]]:
+    """Các user có hơn ``max_rows`` tin nhắn, kèm id của tin nhắn cũ nhất được giữ lại.
+
+    Returns:
+        Danh sách (telegram_user_id, keep_from_id): tin nhắn có id nhỏ hơn là phần vượt hạn mức.
+    """
+    await _flush_pending()
+    async with _reader() as db:
+        async with db.execute(
+                "SELECT telegram_user_id FROM chat_history GROUP BY telegram_user_id HAVING COUNT(*) > ?",
+                (max_rows,),
+        ) as cursor:
+            users = [row[0] for row in await cursor.fetchall()]
+        cutoffs = []
+        for uid in users:
+            async with db.execute(
+                    "SELECT id FROM chat_history WHERE telegram_user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                    (uid, max_rows - 1),
+            ) as cursor:
+                cutoffs.append((uid, (await cursor.fetchone())[0]))
+    return cutoffs
+
+
+def _expired_filter(telegram_user_id: int | None) -> tuple[str, tuple]:
+    if telegram_user_id is None:
+        return "id < ?", ()
+    return "telegram_user_id = ? AND id < ?", (telegram_user_id,)
+
+
+async def get_messages_before(
+        before_id: int, telegram_user_id: int | None = None, limit: int = 1000
+) -> list[dict]:
+    """Đọc tối đa ``limit`` tin nhắn cũ nhất có id < ``before_id`` (mọi user hoặc một user)."""
+    where, scope = _expired_filter(telegram_user_id)
+    async with _reader() as db:
+        async with db.execute(
+                f"""
+                SELECT id, telegram_user_id, session_id, role, content,
+                       {_CITATIONS_JSON_SQL} AS citations, token_count, timestamp
+                FROM chat_history
+                WHERE {where}
+                ORDER BY id
+                LIMIT ?
+                """,
+                (*scope, before_id, limit),
+        ) as cursor:
+            return [dict(row) for row in await cursor.fetchall()]
+
+
+async def delete_messages_before(
+        before_id: int, telegram_user_id: int | None = None, limit: int = 1000, archive: bool = False
+) -> int:
+    """Xoá tối đa ``limit`` tin nhắn cũ nhất có id < ``before_id``, tuỳ chọn chép sang
+    ``chat_history_archive`` trong cùng transaction.
+
+    Xoá theo lô nhỏ để mỗi lần chỉ giữ writer trong thời gian ngắn; index FTS được
+    trigger cập nhật theo.
+
+    Returns:
+        Số tin nhắn đã xoá.
+    """
+    await _flush_pending()
+    where, scope = _expired_filter(telegram_user_id)
+    batch = f"SELECT id FROM chat_history WHERE {where} ORDER BY id LIMIT ?"
+    params = (*scope, before_id, limit)
+    async with _writer() as db:
+        if archive:
+            await db.execute(
+                f"""
+                INSERT OR IGNORE INTO chat_history_archive
+                    (id, telegram_user_id, session_id, role, content, citations, token_count, timestamp)
+                SELECT id, telegram_user_id, session_id, role, content,
+                       {_CITATIONS_JSON_SQL}, token_count, timestamp
+                FROM chat_history
+                WHERE id IN ({batch})
+                """,
+                params,
+            )
+        async with db.execute(f"DELETE FROM chat_history WHERE id IN ({batch})", params) as cursor:
+            return cursor.rowcount
+
+
+async def purge_unused_urls() -> int:
+    """Xoá các URL trong ``urls`` không còn tin nhắn nào trích dẫn (sau retention/xoá lịch sử).
+
+    Không có index trên ``message_citations.url_id`` (chỉ tốn chỗ cho một việc chạy
+    theo giờ): ``NOT IN`` quét bảng một lần để dựng index tạm.
+    """
+    async with _writer() as db:
+        async with db.execute(
+                "DELETE FROM urls WHERE id NOT IN (SELECT url_id FROM message_citations)"
+        ) as cursor:
+            return cursor.rowcount
+
+
+async def purge_finished_requests(before: float) -> int:
+    """Xoá các câu hỏi đã xong trước ``before`` (epoch giây) khỏi ``pending_requests``."""
+    async with _writer() as db:
+        async with db.execute(
+                "DELETE FROM pending_requests WHERE status = 'done' AND finished_at < ?", (before,)
+        ) as cursor:
+            return cursor.rowcount
+
+
+async def purge_daily_usage(before_day: str) -> int:
+    """Xoá bộ đếm câu hỏi của các ngày trước ``before_day`` (YYYY-MM-DD)."""
+    async with _writer() as db:
+        async with db.execute("DELETE FROM usage_daily WHERE day < ?", (before_day,)) as cursor:
+            return cursor.rowcount
+
+
+async def storage_stats() -> dict:
+    """Kích thước database theo page: page_size, page_count, freelist_count, auto_vacuum."""
+    async with _reader() as db:
+        stats = {}
+        for pragma in ("page_size", "page_count", "freelist_count", "auto_vacuum"):
+            async with db.execute(f"PRAGMA {pragma}") as cursor:
+                stats[pragma] = (await cursor.fetchone())[0]
+    return stats
+
+
+async def incremental_vacuum(pages: int) -> None:
+    """Trả tối đa ``pages`` page trống về hệ điều hành (cần ``auto_vacuum = INCREMENTAL``)."""
+    async with _writer() as db:
+        # incremental_vacuum trả về một row cho mỗi page; phải đọc hết để lệnh chạy xong
+        async with db.execute(f"PRAGMA incremental_vacuum({int(pages)})") as cursor:
+            await cursor.fetchall()
+
+
+async def vacuum() -> None:
+    """VACUUM toàn bộ database (chạy ngoài transaction, giữ writer tới khi xong).
+
+    Dùng một lần để chuyển database cũ sang ``auto_vacuum = INCREMENTAL``.
+    """
+    pool = _get_pool()
+    async with pool.write_lock:
+        await pool.writer.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await pool.writer.execute("VACUUM")
+
+
+async def optimize() -> None:
+    """``PRAGMA optimize``: cập nhật thống kê cho query planner khi cần."""
+    async with _writer() as db:
+        await db.execute("PRAGMA optimize")
+
+
+async def get_cached_answer(cache_key: str, now: float) -> tuple[str, list[str], float] | None:
+    """Đọc một câu trả lời còn hạn từ tầng cache SQLite.
+
+    Args:
+        cache_key: Key do ``answer_cache.make_key`` sinh ra.
+        now: Thời điểm hiện tại (epoch giây) để so với ``expires_at``.
+
+    Returns:
+        Tuple (answer, citations, expires_at) hoặc None nếu không có / đã hết hạn.
+    """
+    async with _reader() as db:
+        async with db.execute(
+                "SELECT answer, citations, expires_at FROM answer_cache WHERE cache_key = ? AND expires_at > ?",
+                (cache_key, now),
+        ) as cursor:
+            row = await cursor.fetchone()
+    if row is None:
+        return None
+    return row["answer"], json.loads(row["citations"]), row["expires_at"]
+
+
+async def put_cached_answer(
+        cache_key: str, answer: str, citations: list[str], expires_at: float
+) -> None:
+    """Ghi (hoặc ghi đè) một câu trả lời vào tầng cache SQLite."""
+    citations_json = json.dumps(citations, ensure_ascii=False)
+    async with _writer() as db:
+        await db.execute(
+            """
+            INSERT OR REPLACE INTO answer_cache (cache_key, answer, citations, expires_at)
+            VALUES (?, ?, ?, ?)
+            """,
+            (cache_key, answer, citations_json, expires_at),
+        )
+
+
+async def purge_expired_answers(now: float) -> int:
+    """Xoá các entry cache đã hết hạn, trả về số bản ghi bị xoá."""
+    async with _writer() as db:
+        async with db.execute(
+                "DELETE FROM answer_cache WHERE expires_at <= ?", (now,)
+        ) as cursor:
+            return cursor.rowcount
@@ -0,0 +1,200 @@
+import asyncio
+import html
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import AsyncIterable, AsyncIterator, Callable
+
+from config import settings
+from database import iter_messages
+from telegram_html import render_markdown
+
+# Số tin nhắn đọc từ database mỗi trang và lượng văn bản gom lại trước mỗi lần ghi file
+EXPORT_PAGE_SIZE = settings.export_page_size
+_WRITE_CHUNK = 64 * 1024
+
+FORMATS = ("md", "jsonl", "html")
+
+_FOOTER = "Được tạo bởi Perplexity Telegram Bot"
+
+
+def _fmt_timestamp(ts: str) -> str:
+    """Chuyển chuỗi timestamp SQLite sang định dạng dd/mm/yyyy HH:MM."""
+    try:
+        dt = datetime.fromisoformat(ts)
+        return dt.strftime("%d/%m/%Y %H:%M")
+    except (ValueError, TypeError):
+        return ts
+
+
+async def render_md(username: str, total: int, messages: AsyncIterable[dict]) -> AsyncIterator[str]:
+    """Sinh file Markdown theo từng lượt hội thoại (user + câu trả lời ngay sau nó)."""
+    exported_at = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    yield "\n".join([
+        "# Lịch sử hội thoại — Perplexity Bot",
+        f"> Người dùng : {username}",
+        f"> Xuất lúc   : {exported_at}",
+        f"> Tổng số    : {total} tin nhắn",
+        "",
+    ]) + "\n"
+
+    turn = 0
+    prev_role = None
+    session_id = None
+    async for msg in messages:
+        ts = _fmt_timestamp(msg["timestamp"])
+        lines = ["---", ""]
+        if msg["session_id"] != session_id:
+            # Đầu mỗi phiên: tiêu đề phiên, đánh số lượt lại từ 1
+            session_id = msg["session_id"]
+            turn = 0
+            prev_role = None
+            lines += [f"## Phiên #{session_id}", ""]
+        if msg["role"] == "user":
+            turn += 1
+            lines += [f"### Lượt {turn}", "", f"**[{ts}] Bạn**", "", msg["content"], ""]
+        else:
+            # Câu trả lời đi liền sau câu hỏi thuộc cùng lượt; đứng riêng thì mở khối mới
+            if prev_role == "user":
+                lines = []
+            lines += [f"**[{ts}] Trợ lý**", "", msg["content"], ""]
+            if msg["citations"]:
+                lines.append("**Nguồn tham khảo:**")
+                lines += [f"[{idx}] {url}" for idx, url in enumerate(msg["citations"], 1)]
+                lines.append("")
+        prev_role = msg["role"]
+        yield "\n".join(lines) + "\n"
+
+    yield f"---\n\n*{_FOOTER}*"
+
+
+async def render_jsonl(username: str, total: int, messages: AsyncIterable[dict]) -> AsyncIterator[str]:
+    """Sinh một object JSON mỗi dòng cho mỗi tin nhắn."""
+    async for msg in messages:
+        yield json.dumps(msg, ensure_ascii=False) + "\n"
+
+
+_HTML_HEAD = """<!DOCTYPE html>
+<html lang="vi">
+<head>
+<meta charset="utf-8">
+<title>Lịch sử hội thoại — {username}</title>
+<style>
+body {{ font-family: sans-serif; max-width: 48rem; margin: 2rem auto; line-height: 1.5; }}
+.msg {{ white-space: pre-wrap; margin: 0 0 1rem; }}
+.meta {{ color: #666; font-size: .9em; }}
+.assistant {{ border-left: 3px solid #20808d; padding-left: .75rem; }}
+pre {{ background: #f4f4f4; padding: .5rem; overflow-x: auto; }}
+</style>
+</head>
+<body>
+<h1>Lịch sử hội thoại — Perplexity Bot</h1>
+<p class="meta">Người dùng: {username}<br>Xuất lúc: {exported_at}<br>Tổng số: {total} tin nhắn</p>
+"""
+
+
+async def render_html(username: str, total: int, messages: AsyncIterable[dict]) -> AsyncIterator[str]:
+    """Sinh trang HTML độc lập; nội dung câu trả lời được render từ Markdown."""
+    yield _HTML_HEAD.format(
+        username=html.escape(username),
+        exported_at=datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+        total=total,
+    )
+    turn = 0
+    session_id = None
+    async for msg in messages:
+        ts = html.escape(_fmt_timestamp(msg["timestamp"]))
+        if msg["session_id"] != session_id:
+            session_id = msg["session_id"]
+            turn = 0
+            yield f"<h2>Phiên #{session_id}</h2>\n"
+        if msg["role"] == "user":
+            turn += 1
+            yield (
+                f"<hr>\n<h3>Lượt {turn}</h3>\n<p class=\"meta\">[{ts}] Bạn</p>\n"
+                f"<div class=\"msg user\">{html.escape(msg['content'])}</div>\n"
+            )
+            continue
+        parts = [
+            f"<p class=\"meta\">[{ts}] Trợ lý</p>\n",
+            f"<div class=\"msg assistant\">{render_markdown(msg['content'])}</div>\n",
+        ]
+        if msg["citations"]:
+            parts.append("<p><b>Nguồn tham khảo:</b></p>\n<ol>\n")
+            for url in msg["citations"]:
+                safe = html.escape(url)
+                parts.append(f"<li><a href=\"{safe}\">{safe}</a></li>\n")
+            parts.append("</ol>\n")
+        yield "".join(parts)
+    yield f"<hr>\n<p class=\"meta\"><i>{_FOOTER}</i></p>\n</body>\n</html>\n"
+
+
+_RENDERERS: dict[str, Callable[[str, int, AsyncIterable[dict]], AsyncIterator[str]]] = {
+    "md": render_md,
+    "jsonl": render_jsonl,
+    "html": render_html,
+}
+
+
+async def export_history(
+        telegram_user_id: int,
+        username: str,
+        total: int,
+        fmt: str = "md",
+        compress: bool = False,
+        session_id: int | None = None,
+) -> Path:
+    """Ghi lịch sử chat của một user ra file tạm, trả về đường dẫn file.
+
+    Tin nhắn được đọc theo trang (``iter_messages``), render bằng generator và ghi
+    theo từng khối ``_WRITE_CHUNK`` trong thread riêng (kể cả nén gzip), nên bộ nhớ
+    không phụ thuộc độ dài lịch sử và event loop không bị chặn bởi I/O file.
+    Người gọi chịu trách nhiệm xoá file sau khi dùng.
+
+    Args:
+        telegram_user_id: ID của người dùng Telegram.
+        username: Tên hiển thị trong phần đầu file.
+        total: Tổng số tin nhắn (hiển thị trong phần đầu file).
+        fmt: Một trong ``FORMATS``.
+        compress: Nén gzip (thêm đuôi ``.gz``).
+        session_id: Chỉ xuất một session (mặc định: toàn bộ lịch sử).
+    """
+    # Import muộn: chỉ /export cần, không làm chậm lúc khởi động bot
+    import gzip
+    import tempfile
+
+    render = _RENDERERS[fmt]
+    suffix = f".{fmt}.gz" if compress else f".{fmt}"
+    fd, name = tempfile.mkstemp(suffix=suffix, prefix=f"history_{telegram_user_id}_")
+    os.close(fd)
+    path = Path(name)
+
+    def _open():
+        if compress:
+            return gzip.open(path, "wt", encoding="utf-8")
+        return path.open("w", encoding="utf-8")
+
+    try:
+        f = await asyncio.to_thread(_open)
+        try:
+            buffer: list[str] = []
+            size = 0
+            messages = iter_messages(
+                telegram_user_id, page_size=EXPORT_PAGE_SIZE, session_id=session_id, with_citations=True
+            )
+            async for chunk in render(username, total, messages):
+                buffer.append(chunk)
+                size += len(chunk)
+                if size >= _WRITE_CHUNK:
+                    await asyncio.to_thread(f.write, "".join(buffer))
+                    buffer.clear()
+                    size = 0
+            if buffer:
+                await asyncio.to_thread(f.write, "".join(buffer))
+        finally:
+            await asyncio.to_thread(f.close)
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return path
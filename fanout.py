@@ -0,0 +1,245 @@
+import asyncio
+import contextlib
+import json
+import logging
+import re
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator
+
+from answer_cache import answer_cache, make_key
+from config import settings
+from metrics import STAGE_SECONDS
+from perplexity_client import complete, error_message, stream_completion
+from prompts import DECOMPOSE_PROMPT, SYNTHESIS_PROMPT, SYNTHESIS_REQUEST, SYSTEM_PROMPT
+from router import SONAR, ModelProfile
+
+logger = logging.getLogger(__name__)
+
+# Số truy vấn con tối đa mỗi câu hỏi /deep, số truy vấn chạy cùng lúc (vẫn chịu thêm
+# giới hạn chung PERPLEXITY_MAX_CONCURRENCY) và deadline chung cho cả lượt tìm kiếm (giây)
+DEEP_MAX_SUBQUERIES = settings.deep_max_subqueries
+DEEP_MAX_CONCURRENCY = settings.deep_max_concurrency
+DEEP_DEADLINE = settings.deep_deadline
+# Truy vấn con là tra cứu ngắn: model nhanh nhất; tổng hợp chỉ viết lại từ kết quả có sẵn
+SUBQUERY_PROFILE: ModelProfile = SONAR
+SYNTHESIS_PROFILE: ModelProfile = SONAR
+_DECOMPOSE_TIMEOUT = 10.0
+_DECOMPOSE_MAX_TOKENS = 300
+# Cắt bớt mỗi câu trả lời con khi đưa vào prompt tổng hợp
+_FINDING_CHARS = 4000
+
+_COMPARE_RE = re.compile(
+    r"^\s*(?:hãy\s+)?(?:so sánh|compare)\s+(?:giữa\s+|between\s+)?(?P<body>.+)$", re.IGNORECASE | re.DOTALL
+)
+# Phần sau danh sách đối tượng là khía cạnh cần so sánh: "A, B và C về hiệu năng"
+_ASPECT_RE = re.compile(r"\s+(?:về|theo|trên|in terms of|regarding|on|for)\s+", re.IGNORECASE)
+_LIST_SEP_RE = re.compile(
+    r"\s*(?:,|;|\bvà\b|\bvới\b|\bhay\b|\bhoặc\b|\band\b|\bor\b|\bvs\.?|\bversus\b)\s*", re.IGNORECASE
+)
+_BULLET_RE = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s*")
+_REF_RE = re.compile(r"\[(\d+)\]")
+
+
+@dataclass
+class SubAnswer:
+    index: int  # vị trí trong danh sách truy vấn con
+    query: str
+    answer: str
+    citations: list[str]
+    ok: bool
+    seconds: float  # thời gian gọi API (0 nếu lấy từ cache)
+
+
+def split_question(question: str, limit: int = DEEP_MAX_SUBQUERIES) -> list[str]:
+    """Tách câu hỏi bằng heuristic, không gọi API.
+
+    - "so sánh A, B và C [về X]" → một truy vấn cho mỗi đối tượng (kèm khía cạnh X);
+    - nhiều câu hỏi trong một tin nhắn → mỗi câu một truy vấn.
+
+    Returns:
+        Các truy vấn con; rỗng nếu không tách được thành 2..``limit`` phần.
+    """
+    text = question.strip().rstrip("?.! ")
+    match = _COMPARE_RE.match(text)
+    if match:
+        subjects, *rest = _ASPECT_RE.split(match["body"], maxsplit=1)
+        aspect = rest[0].strip() if rest else ""
+        items = [item.strip() for item in _LIST_SEP_RE.split(subjects) if item and item.strip()]
+        if 2 <= len(items) <= limit:
+            return [f"{item}: {aspect}" if aspect else f"{item}: đặc điểm chính, ưu và nhược điểm" for item in items]
+
+    questions = [q.strip() for q in re.findall(r"[^?\n]+\?", question) if len(q.strip()) > 3]
+    if 2 <= len(questions) <= limit:
+        return questions
+    return []
+
+
+def _parse_subqueries(text: str, limit: int) -> list[str]:
+    """Đọc danh sách truy vấn từ phản hồi của model: mảng JSON, hoặc danh sách gạch đầu dòng."""
+    items: list = []
+    start, end = text.find("["), text.rfind("]")
+    if 0 <= start < end:
+        try:
+            items = json.loads(text[start:end + 1])
+        except json.JSONDecodeError:
+            items = []
+    if not isinstance(items, list) or not items:
+        items = [_BULLET_RE.sub("", line) for line in text.splitlines() if _BULLET_RE.match(line)]
+    queries: list[str] = []
+    for item in items:
+        if isinstance(item, str) and item.strip() and item.strip().casefold() not in {q.casefold() for q in queries}:
+            queries.append(item.strip()[:300])
+    return queries[:limit]
+
+
+async def decompose(question: str, limit: int = DEEP_MAX_SUBQUERIES) -> tuple[list[str], str]:
+    """Chia câu hỏi thành các truy vấn con.
+
+    Heuristic trước (miễn phí, không thêm độ trễ); không tách được thì nhờ model,
+    giới hạn ``_DECOMPOSE_TIMEOUT`` giây. Model lỗi hoặc chỉ trả một truy vấn thì
+    giữ nguyên câu hỏi.
+
+    Returns:
+        Tuple (truy vấn con, cách tách: "heuristic" | "llm" | "none").
+    """
+    queries = split_question(question, limit)
+    if queries:
+        return queries, "heuristic"
+    try:
+        with STAGE_SECONDS.time(stage="deep_decompose"):
+            text, _ = await asyncio.wait_for(
+                complete(
+                    [
+                        {"role": "system", "content": DECOMPOSE_PROMPT.format(limit=limit)},
+                        {"role": "user", "content": question},
+                    ],
+                    SUBQUERY_PROFILE,
+                    max_tokens=_DECOMPOSE_MAX_TOKENS,
+                ),
+                _DECOMPOSE_TIMEOUT,
+            )
+        queries = _parse_subqueries(text, limit)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning("Không tách được câu hỏi bằng model: %s: %s", type(e).__name__, e)
+        queries = []
+    if len(queries) >= 2:
+        return queries, "llm"
+    return [question], "none"
+
+
+async def _ask_subquery(index: int, query: str, slots: asyncio.Semaphore) -> SubAnswer:
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": query}]
+    cache_key = make_key(SUBQUERY_PROFILE.name, messages)
+    cached = await answer_cache.get(cache_key)
+    if cached is not None:
+        return SubAnswer(index, query, cached[0], cached[1], True, 0.0)
+    async with slots:
+        # Chỉ tính thời gian gọi API, không tính lúc chờ slot
+        started = time.monotonic()
+        try:
+            answer, citations = await complete(messages, SUBQUERY_PROFILE)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            return SubAnswer(index, query, error_message(e), [], False, time.monotonic() - started)
+    await answer_cache.put(cache_key, answer, citations)
+    return SubAnswer(index, query, answer, citations, True, time.monotonic() - started)
+
+
+async def fan_out(
+        queries: list[str],
+        deadline: float = DEEP_DEADLINE,
+        concurrency: int = DEEP_MAX_CONCURRENCY,
+) -> AsyncIterator[SubAnswer]:
+    """Gọi các truy vấn con song song, yield từng kết quả ngay khi nó xong.
+
+    Tối đa ``concurrency`` truy vấn chạy cùng lúc; cả lượt dùng chung ``deadline``
+    giây. Hết giờ thì huỷ phần còn lại và yield chúng với ``ok=False``, nên thời
+    gian tổng xấp xỉ truy vấn chậm nhất (khi ``concurrency`` ≥ số truy vấn) và
+    không bao giờ vượt ``deadline``.
+    """
+    slots = asyncio.Semaphore(max(1, concurrency))
+    tasks = [asyncio.create_task(_ask_subquery(i, q, slots)) for i, q in enumerate(queries)]
+    finished: set[int] = set()
+    try:
+        for next_done in asyncio.as_completed(tasks, timeout=deadline):
+            try:
+                result = await next_done
+            except asyncio.TimeoutError:
+                break
+            finished.add(result.index)
+            yield result
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for index, query in enumerate(queries):
+        if index not in finished:
+            logger.warning("Truy vấn con quá deadline %.0fs: %s", deadline, query[:80])
+            yield SubAnswer(index, query, "Hết thời gian chờ cho phần này.", [], False, deadline)
+
+
+def _citation_key(url: str) -> str:
+    # Cùng một trang: bỏ fragment và "/" cuối khi so trùng
+    return url.split("#", 1)[0].rstrip("/")
+
+
+class CitationIndex:
+    """Danh sách trích dẫn chung của các câu trả lời con, không trùng URL.
+
+    Mỗi câu trả lời con đánh số [1], [2]... theo trích dẫn của riêng nó; ``add``
+    đánh số lại theo danh sách chung để mọi phần và câu trả lời tổng hợp dùng
+    cùng một bảng nguồn.
+    """
+
+    def __init__(self):
+        self.urls: list[str] = []
+        self._numbers: dict[str, int] = {}
+
+    def add(self, text: str, citations: list[str]) -> str:
+        """Gộp ``citations`` vào danh sách chung, trả về ``text`` đã đánh số lại."""
+        mapping: dict[int, int] = {}
+        for local, url in enumerate(citations, 1):
+            key = _citation_key(url)
+            if key not in self._numbers:
+                self.urls.append(url)
+                self._numbers[key] = len(self.urls)
+            mapping[local] = self._numbers[key]
+        return _REF_RE.sub(lambda m: f"[{mapping[int(m[1])]}]" if int(m[1]) in mapping else m[0], text)
+
+
+def combine(answers: list[SubAnswer]) -> str:
+    """Ghép các câu trả lời con theo thứ tự truy vấn (dùng khi không tổng hợp được)."""
+    return "\n\n".join(f"**{a.query}**\n\n{a.answer}" for a in sorted(answers, key=lambda a: a.index))
+
+
+async def synthesize(question: str, answers: list[SubAnswer]) -> AsyncIterator[str]:
+    """Stream câu trả lời tổng hợp từ các câu trả lời con (đã đánh số lại trích dẫn).
+
+    Trích dẫn của chính lượt tổng hợp bị bỏ qua: nó chỉ được dùng lại các số [n] có
+    sẵn. Lỗi trước khi có chữ nào thì yield bản ghép ``combine``; lỗi giữa chừng
+    thì nối thông báo lỗi vào cuối.
+    """
+    findings = "\n\n".join(
+        f"## {a.query}\n{a.answer[:_FINDING_CHARS]}" for a in sorted(answers, key=lambda a: a.index)
+    )
+    messages = [
+        {"role": "system", "content": SYNTHESIS_PROMPT},
+        {"role": "user", "content": SYNTHESIS_REQUEST.format(question=question, findings=findings)},
+    ]
+    started = False
+    try:
+        with STAGE_SECONDS.time(stage="deep_synthesis"):
+            async with contextlib.aclosing(stream_completion(messages, SYNTHESIS_PROFILE)) as stream:
+                async for delta, _ in stream:
+                    started = True
+                    yield delta
+    except Exception as e:
+        message = error_message(e)
+        yield f"\n\n{message}" if started else combine(answers)
+        return
+    if not started:
+        yield combine(answers)
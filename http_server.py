@@ -0,0 +1,147 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import AsyncIterable, Awaitable, Callable
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    401: "Unauthorized",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    408: "Request Timeout",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+@dataclass
+class Request:
+    method: str
+    path: str
+    query: dict[str, str]
+    headers: dict[str, str]  # tên header viết thường
+    body: bytes = b""
+
+
+@dataclass
+class Response:
+    status: int = 200
+    # AsyncIterable: body được stream từng khối (không có Content-Length, kết thúc khi đóng connection)
+    body: bytes | str | AsyncIterable[bytes] = b""
+    content_type: str = "text/plain; charset=utf-8"
+    headers: dict[str, str] = field(default_factory=dict)
+
+
+Handler = Callable[[Request], Awaitable[Response]]
+
+
+class HttpServer:
+    """HTTP/1.1 tối giản trên ``asyncio.start_server`` cho các endpoint nội bộ.
+
+    Chỉ đủ cho metrics, health check và webhook: mỗi connection một request
+    (``Connection: close``), body đọc theo ``Content-Length`` và giới hạn ``max_body``.
+    Không dùng để phục vụ traffic web tổng quát.
+    """
+
+    def __init__(self, host: str, port: int, max_body: int = 1 << 20, read_timeout: float = 10.0):
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self.read_timeout = read_timeout
+        self._routes: dict[tuple[str, str], Handler] = {}
+        self._server: asyncio.Server | None = None
+
+    def route(self, method: str, path: str, handler: Handler) -> None:
+        self._routes[(method.upper(), path)] = handler
+
+    async def start(self) -> None:
+        if self._server is not None:
+            return
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        paths = ", ".join(sorted({path for _, path in self._routes}))
+        logger.info("HTTP server lắng nghe tại %s:%d | %s", self.host, self.port, paths)
+
+    async def stop(self) -> None:
+        if self._server is None:
+            return
+        server, self._server = self._server, None
+        server.close()
+        await server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            try:
+                request = await asyncio.wait_for(self._read_request(reader), self.read_timeout)
+            except asyncio.TimeoutError:
+                response = Response(408)
+            except ValueError as e:
+                response = Response(413 if "too large" in str(e) else 400)
+            else:
+                response = await self._dispatch(request) if request else None
+            if response is not None:
+                writer.write(self._encode(response))
+                await writer.drain()
+                if not isinstance(response.body, (bytes, str)):
+                    async for chunk in response.body:
+                        writer.write(chunk)
+                        await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Request | None:
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise ValueError("malformed request line")
+        headers: dict[str, str] = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        if length > self.max_body:
+            raise ValueError("body too large")
+        body = await reader.readexactly(length) if length else b""
+        url = urlsplit(target)
+        return Request(method.upper(), url.path, dict(parse_qsl(url.query)), headers, body)
+
+    async def _dispatch(self, request: Request) -> Response:
+        handler = self._routes.get((request.method, request.path))
+        if handler is None:
+            known = any(path == request.path for _, path in self._routes)
+            return Response(405 if known else 404)
+        try:
+            return await handler(request)
+        except Exception:
+            logger.exception("Lỗi khi xử lý %s %s", request.method, request.path)
+            return Response(500)
+
+    @staticmethod
+    def _encode(response: Response) -> bytes:
+        body = response.body.encode("utf-8") if isinstance(response.body, str) else response.body
+        streamed = not isinstance(body, bytes)
+        lines = [
+            f"HTTP/1.1 {response.status} {_REASONS.get(response.status, '')}",
+            f"Content-Type: {response.content_type}",
+            *([] if streamed else [f"Content-Length: {len(body)}"]),
+            "Connection: close",
+            *(f"{k}: {v}" for k, v in response.headers.items()),
+        ]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (b"" if streamed else body)
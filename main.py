@@ -1,21 +1,52 @@
+import asyncio
 import logging
-import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import Collection
 
-from dotenv import load_dotenv
 from telegram import Update
-from telegram.ext import Application, filters, CommandHandler, MessageHandler
+from telegram.ext import Application, filters, CallbackQueryHandler, CommandHandler, MessageHandler
+from telegram.request import HTTPXRequest
 
-from command_handlers import cmd_start, cmd_export, cmd_clear
-from database import init_db
-from utils import handle_message, _handle_unauthorized
-
-load_dotenv()
+from access import admin_users, allowed_users, load_users
+from command_handlers import (
+    cmd_adduser,
+    cmd_clear,
+    cmd_deep,
+    cmd_export,
+    cmd_model,
+    cmd_new,
+    cmd_removeuser,
+    cmd_search,
+    cmd_sessions,
+    cmd_start,
+    cmd_switch,
+    cmd_users,
+    on_search_page,
+)
+from config import settings
+from database import close_db, count_pending_requests, init_db
+from maintenance import start_maintenance, stop_maintenance
+from metrics import start_metrics, stop_metrics
+from perplexity_client import close_client, open_client, ssl_context
+from recovery import recover_pending
+from utils import handle_message, scheduler, _handle_unauthorized
 
-TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+TELEGRAM_TOKEN = settings.telegram_token
 TELEGRAM_MSG_LIMIT = 4096  # Giới hạn ký tự mỗi tin nhắn của Telegram
 
-_raw_uid = os.getenv("ALLOWED_USER_ID", "")
-ALLOWED_USER_ID: int | None = int(_raw_uid) if _raw_uid.strip().lstrip("-").isdigit() else None
+ALLOWED_USER_ID = settings.allowed_user_id
+
+# "polling" (mặc định) hoặc "webhook"
+BOT_MODE = settings.bot_mode
+WEBHOOK_URL = settings.webhook_url  # URL công khai, vd. https://bot.example.com/telegram
+WEBHOOK_LISTEN = settings.webhook_listen
+WEBHOOK_PORT = settings.webhook_port
+WEBHOOK_PATH = settings.webhook_path
+WEBHOOK_SECRET = settings.webhook_secret
+# Thời gian tối đa chờ các câu hỏi đang xử lý khi dừng bot (giây)
+SHUTDOWN_DRAIN_TIMEOUT = settings.shutdown_drain_timeout
 
 logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
@@ -24,40 +55,204 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+# (bước, giây) của lần khởi động gần nhất, cho log và --startup-profile
+_startup_steps: list[tuple[str, float]] = []
+
+
+@contextmanager
+def _startup_step(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _startup_steps.append((name, time.perf_counter() - started))
+
+
 async def post_init(application: Application) -> None:
-    """Khởi tạo database khi bot khởi động."""
-    await init_db()
+    """Khởi tạo database và HTTP client khi bot khởi động."""
+    with _startup_step("init_db"):
+        await init_db()
     logger.info("Database đã sẵn sàng.")
+    with _startup_step("load_users"):
+        await load_users(application.bot_data.get("admin_user_ids", ()))
+    with _startup_step("open_client"):
+        await open_client()
+    with _startup_step("start_metrics"):
+        # Chế độ webhook: /metrics dùng chung cổng với webhook
+        await start_metrics(application.bot_data.get("http_server"))
+    if application.bot_data.get("recover_pending", True):
+        with _startup_step("recover_pending"):
+            # Câu hỏi chưa trả lời xong khi bot dừng lần trước: trả lời lại hoặc báo user
+            await recover_pending(application.bot)
+    # Vacuum chỉ chạy khi không có câu hỏi nào đang được xử lý
+    start_maintenance(application, lambda: scheduler.in_flight() == 0)
+    logger.info("post_init: %s", ", ".join(f"{name} {sec * 1000:.1f}ms" for name, sec in _startup_steps))
 
 
-def main() -> None:
-    if not TELEGRAM_TOKEN:
-        raise ValueError("TELEGRAM_TOKEN chưa được thiết lập trong file .env")
-    if ALLOWED_USER_ID is None:
-        raise ValueError("ALLOWED_USER_ID chưa được thiết lập hoặc không hợp lệ trong file .env")
+async def post_stop(application: Application) -> None:
+    """Chờ các câu hỏi đang xử lý xong trong khi bot vẫn còn gửi được tin nhắn.
+
+    Hết ``SHUTDOWN_DRAIN_TIMEOUT`` thì huỷ phần còn lại; các câu hỏi đó vẫn nằm trong
+    ``pending_requests`` và được ``recover_pending`` xử lý ở lần khởi động sau.
+    """
+    if not await scheduler.drain(SHUTDOWN_DRAIN_TIMEOUT):
+        logger.warning(
+            "%d câu hỏi chưa trả lời xong, sẽ được xử lý lại khi bot khởi động", await count_pending_requests()
+        )
+
 
-    # Filter cấp framework: chỉ xử lý update từ đúng user_id
-    allowed = filters.User(user_id=ALLOWED_USER_ID)
+async def post_shutdown(application: Application) -> None:
+    """Giải phóng tài nguyên dùng chung khi bot dừng."""
+    await scheduler.close()
+    await stop_maintenance()
+    await stop_metrics()
+    await close_client()
+    await close_db()
 
-    app = (
+
+def build_application(
+        token: str,
+        admin_user_ids: Collection[int],
+        base_url: str | None = None,
+) -> Application:
+    """Tạo ``Application`` với đầy đủ handler, chưa khởi động.
+
+    Args:
+        token: Token bot Telegram.
+        admin_user_ids: Các user_id luôn là admin (``ALLOWED_USER_ID``); các user khác
+            được admin thêm bằng /adduser và lưu trong database.
+        base_url: Địa chỉ Bot API thay cho ``https://api.telegram.org/bot``
+            (vd. server giả lập trong ``bench/loadtest.py``).
+    """
+    # Filter cấp framework: tập user_id nạp từ database trong post_init, cập nhật
+    # tại chỗ khi admin thêm/bớt user
+    allowed = allowed_users
+
+    # Hai client httpx của PTB (gọi Bot API, getUpdates) dùng chung SSLContext với client
+    # Perplexity thay vì mỗi client tự nạp lại chứng chỉ CA
+    httpx_kwargs = {"verify": ssl_context()}
+    builder = (
         Application.builder()
-        .token(TELEGRAM_TOKEN)
+        .token(token)
+        .request(HTTPXRequest(connection_pool_size=256, httpx_kwargs=httpx_kwargs))
+        .get_updates_request(HTTPXRequest(connection_pool_size=1, httpx_kwargs=httpx_kwargs))
         .post_init(post_init)
-        .build()
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        # handle_message chỉ xếp hàng rồi trả về; thứ tự theo user do scheduler đảm bảo
+        .concurrent_updates(True)
     )
+    if base_url:
+        builder = builder.base_url(base_url)
+    app = builder.build()
+    app.bot_data["admin_user_ids"] = list(admin_user_ids)
 
     app.add_handler(CommandHandler("start", cmd_start, filters=allowed))
     app.add_handler(CommandHandler("export", cmd_export, filters=allowed))
     app.add_handler(CommandHandler("clear", cmd_clear, filters=allowed))
+    app.add_handler(CommandHandler("new", cmd_new, filters=allowed))
+    app.add_handler(CommandHandler("sessions", cmd_sessions, filters=allowed))
+    app.add_handler(CommandHandler("switch", cmd_switch, filters=allowed))
+    app.add_handler(CommandHandler("model", cmd_model, filters=allowed))
+    app.add_handler(CommandHandler("search", cmd_search, filters=allowed))
+    app.add_handler(CommandHandler("deep", cmd_deep, filters=allowed))
+    app.add_handler(CommandHandler("users", cmd_users, filters=admin_users))
+    app.add_handler(CommandHandler("adduser", cmd_adduser, filters=admin_users))
+    app.add_handler(CommandHandler("removeuser", cmd_removeuser, filters=admin_users))
+    # CallbackQueryHandler không nhận filters: on_search_page chỉ đọc user_data và lịch sử của người bấm
+    app.add_handler(CallbackQueryHandler(on_search_page, pattern=r"^search:\d+:\d+$"))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & allowed, handle_message))
 
     app.add_handler(
         MessageHandler(filters.ALL & ~allowed, _handle_unauthorized),
         group=1,
     )
+    return app
+
+
+def _import_breakdown(top: int = 12) -> tuple[float, list[tuple[str, float]]]:
+    """Import ``main`` trong tiến trình con với ``-X importtime``.
+
+    Returns:
+        Tuple (tổng giây, [(gói cấp cao nhất, giây tự thân cộng dồn)] giảm dần).
+    """
+    import subprocess  # chỉ --startup-profile cần
+    from pathlib import Path
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=Path(__file__).resolve().parent, capture_output=True, text=True, check=True,
+    )
+    by_package: dict[str, float] = {}
+    total = 0.0
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[0].startswith("import time:") or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        package = name.split(".")[0]
+        by_package[package] = by_package.get(package, 0.0) + int(parts[0].split(":")[1]) / 1e6
+        if name == "main":
+            total = int(parts[1]) / 1e6
+    return total, sorted(by_package.items(), key=lambda item: item[1], reverse=True)[:top]
+
+
+async def _init_breakdown() -> list[tuple[str, float]]:
+    """Chạy ``build_application`` + ``post_init`` + ``post_shutdown`` trên DB_PATH thật.
+
+    Không gọi Telegram (bỏ qua ``Application.initialize``, tức ``getMe``, và bước khôi
+    phục câu hỏi dở dang vì nó gửi tin nhắn).
+    """
+    with _startup_step("build_application"):
+        app = build_application(TELEGRAM_TOKEN or "0:startup-profile", [ALLOWED_USER_ID or 0])
+    app.bot_data["recover_pending"] = False
+    await post_init(app)
+    with _startup_step("post_shutdown"):
+        await post_shutdown(app)
+    return list(_startup_steps)
+
+
+def profile_startup() -> None:
+    """``python main.py --startup-profile``: in thời gian import và khởi tạo rồi thoát."""
+    logging.getLogger().setLevel(logging.WARNING)
+    total, packages = _import_breakdown()
+    print(f"Import main: {total * 1000:7.1f} ms (tự thân theo gói, tiến trình con -X importtime)")
+    for package, seconds in packages:
+        print(f"  {package:24s} {seconds * 1000:7.1f} ms")
+    steps = asyncio.run(_init_breakdown())
+    print(f"Khởi tạo: {sum(sec for _, sec in steps) * 1000:7.1f} ms")
+    for name, seconds in steps:
+        print(f"  {name:24s} {seconds * 1000:7.1f} ms")
+
+
+def main() -> None:
+    if "--startup-profile" in sys.argv[1:]:
+        profile_startup()
+        return
+    if not TELEGRAM_TOKEN:
+        raise ValueError("TELEGRAM_TOKEN chưa được thiết lập trong file .env")
+    if ALLOWED_USER_ID is None:
+        raise ValueError("ALLOWED_USER_ID chưa được thiết lập trong file .env")
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        raise ValueError("WEBHOOK_SECRET chưa được thiết lập trong file .env (bắt buộc với BOT_MODE=webhook)")
+
+    app = build_application(TELEGRAM_TOKEN, [ALLOWED_USER_ID])
+
+    logger.info("Bot đang chạy (%s) — admin user_id=%d", BOT_MODE, ALLOWED_USER_ID)
+    if BOT_MODE == "webhook":
+        from webhook import run_webhook  # chỉ chế độ webhook cần
 
-    logger.info("Bot đang chạy — chỉ chấp nhận user_id=%d", ALLOWED_USER_ID)
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+        asyncio.run(run_webhook(
+            app,
+            host=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            secret=WEBHOOK_SECRET,
+            url=WEBHOOK_URL or None,
+            allowed_updates=Update.ALL_TYPES,
+        ))
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import logging
+import time
+import warnings
+from pathlib import Path
+from typing import Callable
+
+from telegram.ext import Application, ContextTypes
+from telegram.warnings import PTBUserWarning
+
+from config import settings
+from database import (
+    delete_messages_before,
+    find_first_id_since,
+    get_messages_before,
+    get_row_cap_cutoffs,
+    incremental_vacuum,
+    optimize,
+    purge_daily_usage,
+    purge_finished_requests,
+    purge_unused_urls,
+    storage_stats,
+    vacuum,
+)
+
+logger = logging.getLogger(__name__)
+
+# Chu kỳ bảo trì (giây); 0 để tắt. Lần đầu chạy sau MAINTENANCE_FIRST_DELAY giây
+MAINTENANCE_INTERVAL = settings.maintenance_interval
+MAINTENANCE_FIRST_DELAY = settings.maintenance_first_delay
+# Retention: tin nhắn cũ hơn RETENTION_DAYS ngày, và phần vượt RETENTION_MAX_ROWS tin nhắn
+# mỗi user (giữ phần mới nhất); 0 để tắt từng điều kiện
+RETENTION_DAYS = settings.retention_days
+RETENTION_MAX_ROWS = settings.retention_max_rows
+# Tin nhắn bị loại khỏi bảng nóng đi đâu: table (chat_history_archive), file (jsonl.gz
+# trong ARCHIVE_DIR) hoặc delete (xoá hẳn)
+ARCHIVE_MODE = settings.archive_mode
+ARCHIVE_DIR = settings.archive_dir
+# Số tin nhắn mỗi transaction xoá/lưu trữ và số page mỗi bước incremental_vacuum
+_BATCH_ROWS = 1000
+_VACUUM_STEP_PAGES = 1024
+# Bộ đếm hạn mức ngày giữ lại bao nhiêu ngày
+_USAGE_KEEP_DAYS = 35
+# Khoá idempotency của câu hỏi đã xong giữ bao lâu (giây) — Telegram chỉ giữ update
+# chưa được xác nhận tối đa 24 giờ
+_REQUEST_KEEP_SECONDS = 2 * 86400
+
+_task: asyncio.Task | None = None
+
+
+def _archive_path() -> Path:
+    return ARCHIVE_DIR / f"chat_history_{time.strftime('%Y%m%d_%H%M%S')}.jsonl.gz"
+
+
+def _append_archive(path: Path, rows: list[dict]) -> None:
+    import gzip  # chỉ ARCHIVE_MODE=file cần
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Mỗi lô là một gzip member; gzip/zcat đọc file nhiều member như một luồng liền
+    with gzip.open(path, "at", encoding="utf-8") as f:
+        f.writelines(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+
+
+async def _expire(before_id: int, telegram_user_id: int | None, archive_file: Path | None) -> int:
+    """Đưa mọi tin nhắn có id < ``before_id`` ra khỏi bảng nóng, theo lô."""
+    total = 0
+    while True:
+        if archive_file is not None:
+            # Ghi file trước rồi mới xoá: crash giữa chừng chỉ có thể lặp row trong archive
+            rows = await get_messages_before(before_id, telegram_user_id, _BATCH_ROWS)
+            if not rows:
+                return total
+            await asyncio.to_thread(_append_archive, archive_file, rows)
+            deleted = await delete_messages_before(rows[-1]["id"] + 1, telegram_user_id, _BATCH_ROWS)
+        else:
+            deleted = await delete_messages_before(
+                before_id, telegram_user_id, _BATCH_ROWS, archive=ARCHIVE_MODE == "table"
+            )
+        total += deleted
+        if deleted < _BATCH_ROWS:
+            return total
+        # Nhường writer cho các lượt hội thoại đang chờ ghi
+        await asyncio.sleep(0)
+
+
+async def run_maintenance(is_idle: Callable[[], bool] = lambda: True) -> dict:
+    """Một lượt bảo trì: retention + lưu trữ, rồi vacuum và ``PRAGMA optimize`` khi rảnh.
+
+    Retention chạy theo lô nhỏ nên không chặn bot lâu. Vacuum chỉ chạy khi
+    ``is_idle()`` (không có câu hỏi đang xử lý) và dừng giữa chừng nếu bot bận
+    trở lại; phần page trống còn lại được trả ở lượt sau.
+
+    Returns:
+        Báo cáo: số tin nhắn đã loại theo tuổi / theo hạn mức, số URL trích dẫn
+        không còn dùng đã xoá, byte trước và sau, page trống còn lại, thời gian chạy.
+    """
+    started = time.monotonic()
+    before = await storage_stats()
+    archive_file = _archive_path() if ARCHIVE_MODE == "file" else None
+    report = {"expired_by_age": 0, "expired_by_cap": 0}
+
+    if RETENTION_DAYS > 0:
+        cutoff = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - RETENTION_DAYS * 86400))
+        first_kept = await find_first_id_since(cutoff)
+        if first_kept is not None:
+            report["expired_by_age"] = await _expire(first_kept, None, archive_file)
+    if RETENTION_MAX_ROWS > 0:
+        for uid, keep_from in await get_row_cap_cutoffs(RETENTION_MAX_ROWS):
+            report["expired_by_cap"] += await _expire(keep_from, uid, archive_file)
+    report["unused_urls"] = await purge_unused_urls()
+    await purge_finished_requests(time.time() - _REQUEST_KEEP_SECONDS)
+    await purge_daily_usage(time.strftime("%Y-%m-%d", time.localtime(time.time() - _USAGE_KEEP_DAYS * 86400)))
+
+    if is_idle():
+        stats = await storage_stats()
+        if stats["auto_vacuum"] != 2:
+            # Database tạo trước khi bật auto_vacuum: một lần VACUUM đầy đủ để chuyển sang INCREMENTAL
+            logger.info("Bảo trì: chuyển database sang auto_vacuum=INCREMENTAL (VACUUM một lần)...")
+            await vacuum()
+        else:
+            while stats["freelist_count"] and is_idle():
+                await incremental_vacuum(_VACUUM_STEP_PAGES)
+                stats = await storage_stats()
+        await optimize()
+
+    after = await storage_stats()
+    report.update({
+        "bytes_before": before["page_count"] * before["page_size"],
+        "bytes_after": after["page_count"] * after["page_size"],
+        "free_pages": after["freelist_count"],
+        "archive_file": str(archive_file) if archive_file and archive_file.exists() else None,
+        "seconds": round(time.monotonic() - started, 3),
+    })
+    reclaimed = report["bytes_before"] - report["bytes_after"]
+    logger.info(
+        "Bảo trì xong | loại %d tin (tuổi) + %d tin (hạn mức) → %s | %d URL không dùng"
+        " | %.1f → %.1f MiB (thu hồi %.1f MiB) | page trống còn %d | %.2fs",
+        report["expired_by_age"], report["expired_by_cap"], report["archive_file"] or ARCHIVE_MODE,
+        report["unused_urls"],
+        report["bytes_before"] / 2 ** 20, report["bytes_after"] / 2 ** 20, reclaimed / 2 ** 20,
+        report["free_pages"], report["seconds"],
+    )
+    return report
+
+
+async def _run_safely(is_idle: Callable[[], bool]) -> None:
+    try:
+        await run_maintenance(is_idle)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception("Bảo trì database thất bại")
+
+
+async def _loop(is_idle: Callable[[], bool]) -> None:
+    await asyncio.sleep(MAINTENANCE_FIRST_DELAY)
+    while True:
+        await _run_safely(is_idle)
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+
+
+def start_maintenance(application: Application, is_idle: Callable[[], bool]) -> None:
+    """Lên lịch bảo trì định kỳ. Gọi trong ``post_init``.
+
+    Dùng ``application.job_queue`` nếu có (cần ``python-telegram-bot[job-queue]``),
+    ngược lại chạy một task asyncio riêng.
+    """
+    global _task
+    if MAINTENANCE_INTERVAL <= 0:
+        return
+
+    # Thiếu extra job-queue là cấu hình bình thường của repo: PTB cảnh báo mỗi lần đọc
+    # ``job_queue`` khi nó là None, nên đọc trong catch_warnings để log khởi động sạch
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", PTBUserWarning)
+        job_queue = application.job_queue
+    if job_queue is not None:
+        async def job(context: ContextTypes.DEFAULT_TYPE) -> None:
+            await _run_safely(is_idle)
+
+        job_queue.run_repeating(
+            job, interval=MAINTENANCE_INTERVAL, first=MAINTENANCE_FIRST_DELAY, name="db_maintenance"
+        )
+    else:
+        _task = asyncio.create_task(_loop(is_idle))
+    logger.info(
+        "Bảo trì database mỗi %.0fs | retention: %s ngày, %s tin/user | lưu trữ: %s",
+        MAINTENANCE_INTERVAL, RETENTION_DAYS or "∞", RETENTION_MAX_ROWS or "∞", ARCHIVE_MODE,
+    )
+
+
+async def stop_maintenance() -> None:
+    """Huỷ task bảo trì (nếu không dùng job queue). Gọi trong ``post_shutdown`` trước ``close_db``."""
+    global _task
+    if _task is None:
+        return
+    task, _task = _task, None
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
@@ -0,0 +1,269 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from typing import Callable
+
+from config import settings
+from http_server import HttpServer, Request, Response
+
+logger = logging.getLogger(__name__)
+
+# Tắt mặc định: mọi lời gọi inc/observe/time khi đó chỉ là một phép kiểm tra cờ
+METRICS_ENABLED = settings.metrics_enabled
+METRICS_HOST = settings.metrics_host
+METRICS_PORT = settings.metrics_port  # 0: không mở endpoint HTTP
+METRICS_LOG_INTERVAL = settings.metrics_log_interval  # giây, 0: không ghi log định kỳ
+
+# Bucket (giây) đủ rộng cho cả thao tác nhỏ (render, DB) lẫn gọi API dài
+_DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+_NULL_TIMER = nullcontext()
+
+_registry: list["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _labels(self, key: tuple[str, ...], extra: str = "") -> str:
+        parts = [f'{n}="{_escape(v)}"' for n, v in zip(self.labelnames, key)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        lines += [f"{self.name}{self._labels(k)} {v:g}" for k, v in self._values.items()]
+        return lines
+
+    def summary(self) -> str:
+        return ", ".join(f"{','.join(k) or 'total'}={v:g}" for k, v in self._values.items())
+
+
+class Gauge(_Metric):
+    """Gauge đặt trực tiếp bằng ``set`` hoặc đọc từ một hàm khi render (không tốn gì trên hot path)."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+        self._fn: Callable[[], float] | None = None
+
+    def set(self, value: float, **labels) -> None:
+        if not METRICS_ENABLED:
+            return
+        self._values[self._key(labels)] = value
+
+    def set_function(self, fn: Callable[[], float]) -> None:
+        self._fn = fn
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        if self._fn is not None:
+            lines.append(f"{self.name} {self._fn():g}")
+        lines += [f"{self.name}{self._labels(k)} {v:g}" for k, v in self._values.items()]
+        return lines
+
+    def summary(self) -> str:
+        if self._fn is not None:
+            return f"{self._fn():g}"
+        return ", ".join(f"{','.join(k)}={v:g}" for k, v in self._values.items())
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_labels", "_start")
+
+    def __init__(self, histogram: "Histogram", labels: dict):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start, **self._labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            help_text: str,
+            labelnames: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = _DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [số mẫu theo bucket (không cộng dồn, thêm một ô +Inf), tổng, số mẫu]
+        self._values: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def time(self, **labels):
+        """Context manager đo thời gian khối lệnh; no-op khi metrics tắt."""
+        if not METRICS_ENABLED:
+            return _NULL_TIMER
+        return _Timer(self, labels)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = self._labels(key, 'le="%g"' % bound)
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = self._labels(key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {total:g}")
+            lines.append(f"{self.name}_count{self._labels(key)} {count}")
+        return lines
+
+    def summary(self) -> str:
+        parts = []
+        for key, (counts, total, count) in self._values.items():
+            parts.append(
+                f"{','.join(key) or 'all'}: n={count} avg={total / count * 1000:.1f}ms "
+                f"p95≤{self._quantile(counts, count, 0.95)}"
+            )
+        return "; ".join(parts)
+
+    def _quantile(self, counts: list[int], count: int, q: float) -> str:
+        """Cận trên của bucket chứa phân vị ``q`` (ước lượng từ histogram)."""
+        target = q * count
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            if cumulative >= target:
+                return f"{bound * 1000:g}ms"
+        return "+Inf"
+
+
+def render() -> str:
+    """Toàn bộ metrics theo định dạng text của Prometheus (version 0.0.4)."""
+    lines: list[str] = []
+    for metric in _registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+# ----------------------------------------------------------------------------
+# Metrics của bot
+# ----------------------------------------------------------------------------
+
+STAGE_SECONDS = Histogram(
+    "bot_stage_seconds",
+    "Thời gian từng bước xử lý tin nhắn (history_fetch, api_call, api_first_token, render, split, telegram_send, db_write, deep_*).",
+    ("stage",),
+)
+MESSAGE_SECONDS = Histogram("bot_message_seconds", "Thời gian xử lý trọn một tin nhắn.")
+API_SECONDS = Histogram("bot_api_seconds", "Độ trễ request Perplexity thành công theo model.", ("model",))
+ERRORS = Counter("bot_errors_total", "Số lỗi theo loại exception.", ("type",))
+CACHE_LOOKUPS = Counter("bot_answer_cache_lookups_total", "Số lần tra answer cache theo kết quả.", ("result",))
+TOKENS = Counter("bot_tokens_total", "Số token Perplexity đã dùng.", ("model", "kind"))
+COST_USD = Counter("bot_api_cost_usd_total", "Chi phí Perplexity ước lượng (USD).", ("model",))
+UNAUTHORIZED = Counter("bot_unauthorized_updates_total", "Số update từ user không được phép.")
+RATE_LIMITED = Counter("bot_rate_limited_total", "Số câu hỏi bị từ chối theo lý do (rate, quota).", ("reason",))
+DUPLICATE_UPDATES = Counter("bot_duplicate_updates_total", "Số update Telegram gửi lại đã bị bỏ qua.")
+RECOVERED = Counter(
+    "bot_recovered_requests_total", "Số câu hỏi dở dang khi khởi động theo cách xử lý (reissued, notified).",
+    ("action",),
+)
+QUEUE_DEPTH = Gauge("bot_queue_depth", "Số câu hỏi đang chờ trong hàng đợi của mọi user.")
+IN_FLIGHT = Gauge("bot_in_flight_users", "Số user đang có câu hỏi được xử lý.")
+BREAKER_OPEN = Gauge("bot_circuit_open", "1 nếu circuit breaker Perplexity đang mở.")
+
+_server: HttpServer | None = None
+_log_task: asyncio.Task | None = None
+
+
+async def _handle_metrics(request: Request) -> Response:
+    return Response(body=render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def register_routes(server: HttpServer) -> None:
+    """Gắn ``GET /metrics`` vào một HTTP server có sẵn."""
+    server.route("GET", "/metrics", _handle_metrics)
+
+
+async def _log_loop(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        for metric in _registry:
+            text = metric.summary()
+            if text:
+                logger.info("metrics %s | %s", metric.name, text)
+
+
+async def start_metrics(server: HttpServer | None = None) -> None:
+    """Bật endpoint ``/metrics`` và log định kỳ theo cấu hình. Gọi trong ``post_init``.
+
+    Nếu truyền ``server`` (HTTP server dùng chung), ``/metrics`` được gắn vào đó thay
+    vì mở cổng riêng.
+    """
+    global _server, _log_task
+    if not METRICS_ENABLED:
+        return
+    if server is not None:
+        register_routes(server)
+    elif METRICS_PORT:
+        _server = HttpServer(METRICS_HOST, METRICS_PORT)
+        register_routes(_server)
+        await _server.start()
+    if METRICS_LOG_INTERVAL > 0:
+        _log_task = asyncio.create_task(_log_loop(METRICS_LOG_INTERVAL))
+
+
+async def stop_metrics() -> None:
+    """Dừng endpoint riêng và log định kỳ. Gọi trong ``post_shutdown``."""
+    global _server, _log_task
+    if _log_task is not None:
+        _log_task.cancel()
+        _log_task = None
+    if _server is not None:
+        await _server.stop()
+        _server = None
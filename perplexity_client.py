@@ -1,98 +1,598 @@
-import os
 import asyncio
+import contextlib
+import functools
+import json
 import logging
-import requests
-from dotenv import load_dotenv
+import re
+import ssl
+import time
+from importlib.util import find_spec
+from typing import AsyncIterator
 
-from database import get_recent_messages
-from prompts import SYSTEM_PROMPT
+import httpx
+
+from answer_cache import answer_cache, make_key
+from config import settings
+from database import (
+    get_active_session,
+    get_context_messages,
+    get_messages_range,
+    get_summary,
+    save_summary,
+)
+from prompts import SUMMARY_CONTEXT_PREFIX, SUMMARY_PROMPT, SUMMARY_REQUEST, SYSTEM_PROMPT
+from resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    Deadline,
+    DeadlineExceeded,
+    RetryPolicy,
+    RetryStats,
+    call_with_retry,
+)
+from metrics import BREAKER_OPEN, ERRORS, STAGE_SECONDS
+from router import DEFAULT_PROFILE, ModelProfile, record_usage
 
 logger = logging.getLogger(__name__)
 
-load_dotenv()
+PERPLEXITY_API_KEY = settings.perplexity_api_key
+PERPLEXITY_API_URL = settings.perplexity_api_url
+MODEL = DEFAULT_PROFILE.name  # Model mặc định; router chọn model cho từng câu hỏi
+
+# Ngân sách token cho lịch sử gửi kèm (gồm cả bản tóm tắt) với model mặc định, nhân theo
+# ``context_factor`` của model được chọn, và số tin nhắn tối đa
+CONTEXT_TOKEN_BUDGET = settings.context_token_budget
+CONTEXT_MAX_MESSAGES = settings.context_max_messages
+# Tóm tắt cuốn chiếu phần lịch sử không còn vừa ngân sách (gọi API chạy nền)
+CONTEXT_SUMMARY = settings.context_summary
+SUMMARY_MODEL = settings.summary_model or MODEL
+SUMMARY_MAX_TOKENS = settings.summary_max_tokens
+SUMMARY_BATCH_MESSAGES = 20  # Số tin nhắn tối đa gộp vào bản tóm tắt mỗi lần
+_SUMMARY_MESSAGE_CHARS = 2000  # Cắt bớt tin nhắn quá dài khi đưa vào prompt tóm tắt
+
+# Cấu hình HTTP client dùng chung (keep-alive, connection pool)
+HTTP_MAX_CONNECTIONS = settings.http_max_connections
+HTTP_MAX_KEEPALIVE = settings.http_max_keepalive
+HTTP_KEEPALIVE_EXPIRY = settings.http_keepalive_expiry
+HTTP_CONNECT_TIMEOUT = settings.http_connect_timeout
+HTTP_READ_TIMEOUT = settings.http_read_timeout
+HTTP_POOL_TIMEOUT = settings.http_pool_timeout
+
+# Số request Perplexity chạy đồng thời tối đa (toàn bot) — chặn burst vượt rate limit
+PERPLEXITY_MAX_CONCURRENCY = settings.perplexity_max_concurrency
+
+# Retry / deadline / circuit breaker
+PERPLEXITY_MAX_ATTEMPTS = settings.perplexity_max_attempts
+PERPLEXITY_RETRY_BASE_DELAY = settings.perplexity_retry_base_delay
+PERPLEXITY_RETRY_MAX_DELAY = settings.perplexity_retry_max_delay
+PERPLEXITY_DEADLINE = settings.perplexity_deadline  # giây cho mỗi câu hỏi
+PERPLEXITY_BREAKER_THRESHOLD = settings.perplexity_breaker_threshold
+PERPLEXITY_BREAKER_RESET = settings.perplexity_breaker_reset
+
+_client: httpx.AsyncClient | None = None
+_api_slots = asyncio.Semaphore(PERPLEXITY_MAX_CONCURRENCY)
+_retry_policy = RetryPolicy(
+    max_attempts=PERPLEXITY_MAX_ATTEMPTS,
+    base_delay=PERPLEXITY_RETRY_BASE_DELAY,
+    max_delay=PERPLEXITY_RETRY_MAX_DELAY,
+)
+_retry_stats = RetryStats()
+_summary_tasks: dict[int, asyncio.Task] = {}
+breaker = CircuitBreaker(
+    "perplexity",
+    failure_threshold=PERPLEXITY_BREAKER_THRESHOLD,
+    reset_timeout=PERPLEXITY_BREAKER_RESET,
+)
+BREAKER_OPEN.set_function(lambda: float(breaker.state != "closed"))
+
+
+@functools.cache
+def ssl_context() -> ssl.SSLContext:
+    """SSLContext (CA của certifi) dùng chung cho client Perplexity và các client của PTB.
+
+    Nạp chứng chỉ CA tốn ~30 ms mỗi context; mỗi ``httpx.AsyncClient`` mặc định tự tạo
+    một cái, nên dùng chung giúp bot khởi động nhanh hơn.
+    """
+    return httpx.create_ssl_context()
+
+
+async def open_client() -> None:
+    """Tạo AsyncClient dùng chung. Gọi một lần trong ``post_init``.
+
+    HTTP/2 bật mặc định nhờ dependency ``httpx[http2]``; nếu môi trường thiếu gói ``h2``
+    thì lùi về HTTP/1.1 thay vì lỗi khi khởi động.
+    """
+    global _client
+    if _client is not None:
+        return
+    http2 = find_spec("h2") is not None
+    _client = httpx.AsyncClient(
+        http2=http2,
+        verify=ssl_context(),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            connect=HTTP_CONNECT_TIMEOUT,
+            read=HTTP_READ_TIMEOUT,
+            write=HTTP_CONNECT_TIMEOUT,
+            pool=HTTP_POOL_TIMEOUT,
+        ),
+        headers={
+            "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        },
+    )
+    logger.info(
+        "Đã tạo HTTP client Perplexity | http2=%s | max_connections=%d",
+        http2, HTTP_MAX_CONNECTIONS,
+    )
 
-PERPLEXITY_API_KEY = os.getenv("PERPLEXITY_API_KEY")
-PERPLEXITY_API_URL = "https://api.perplexity.ai/chat/completions"
-MODEL = "sonar"
-CONTEXT_LIMIT = 4  # Số tin nhắn lịch sử gửi kèm để tiết kiệm token
+
+async def close_client() -> None:
+    """Huỷ các lần cập nhật tóm tắt đang chạy và đóng AsyncClient. Gọi trong ``post_shutdown``."""
+    global _client
+    for task in list(_summary_tasks.values()):
+        task.cancel()
+    if _client is None:
+        return
+    client, _client = _client, None
+    await client.aclose()
+
+
+def _get_client() -> httpx.AsyncClient:
+    if _client is None:
+        raise RuntimeError("HTTP client chưa được tạo — cần gọi open_client() trước.")
+    return _client
+
+
+def resilience_snapshot() -> dict:
+    """Trạng thái breaker và bộ đếm retry, phục vụ log / metrics."""
+    return {"breaker": breaker.snapshot(), "retries": vars(_retry_stats).copy()}
+
+
+def _attempt_timeout(remaining: float, timeout_factor: float = 1.0) -> httpx.Timeout:
+    """Timeout của một lần thử, không vượt quá phần còn lại của deadline.
+
+    Read timeout được nhân ``timeout_factor`` cho các model chậm (reasoning).
+    """
+    return httpx.Timeout(
+        connect=min(HTTP_CONNECT_TIMEOUT, remaining),
+        read=min(HTTP_READ_TIMEOUT * timeout_factor, remaining),
+        write=min(HTTP_CONNECT_TIMEOUT, remaining),
+        pool=min(HTTP_POOL_TIMEOUT, remaining),
+    )
+
+
+async def _post_with_retry(payload: dict, timeout_factor: float = 1.0) -> dict:
+    """POST payload với retry/backoff, breaker và deadline ``PERPLEXITY_DEADLINE`` (× ``timeout_factor``)."""
+
+    async def attempt(remaining: float) -> dict:
+        async with _api_slots:
+            response = await asyncio.wait_for(
+                _get_client().post(
+                    PERPLEXITY_API_URL, json=payload, timeout=_attempt_timeout(remaining, timeout_factor)
+                ),
+                timeout=remaining,
+            )
+        response.raise_for_status()
+        return response.json()
+
+    return await call_with_retry(
+        attempt,
+        policy=_retry_policy,
+        breaker=breaker,
+        deadline=Deadline(PERPLEXITY_DEADLINE * timeout_factor),
+        stats=_retry_stats,
+    )
+
+
+async def _open_stream_with_retry(payload: dict, timeout_factor: float = 1.0) -> httpx.Response:
+    """Mở response stream (đã kiểm tra status) với retry trước khi nhận byte đầu tiên.
+
+    Giữ một slot của ``_api_slots`` cho tới khi caller gọi ``_close_stream``.
+    """
+
+    async def attempt(remaining: float) -> httpx.Response:
+        await _api_slots.acquire()
+        try:
+            client = _get_client()
+            request = client.build_request(
+                "POST",
+                PERPLEXITY_API_URL,
+                json=payload,
+                headers={"Accept": "text/event-stream"},
+                timeout=_attempt_timeout(remaining, timeout_factor),
+            )
+            response = await asyncio.wait_for(client.send(request, stream=True), timeout=remaining)
+            if response.is_error:
+                await response.aread()
+                await response.aclose()
+            response.raise_for_status()
+            return response
+        except BaseException:
+            _api_slots.release()
+            raise
+
+    return await call_with_retry(
+        attempt,
+        policy=_retry_policy,
+        breaker=breaker,
+        deadline=Deadline(PERPLEXITY_DEADLINE * timeout_factor),
+        stats=_retry_stats,
+    )
+
+
+async def _close_stream(response: httpx.Response) -> None:
+    try:
+        await response.aclose()
+    finally:
+        _api_slots.release()
+
+
+class _ThinkFilter:
+    """Bỏ khối ``<think>…</think>`` (suy luận của model reasoning) khỏi chuỗi delta.
+
+    Thẻ có thể bị cắt giữa hai delta nên phần đuôi có thể là đầu thẻ được giữ lại
+    chờ delta sau. Khoảng trắng ngay sau khối suy luận cũng bị bỏ.
+    """
+
+    _OPEN = "<think>"
+    _CLOSE = "</think>"
+
+    def __init__(self):
+        self._buf = ""
+        self._inside = False
+        self._started = False
+
+    def feed(self, delta: str) -> str:
+        buf = self._buf + delta
+        out: list[str] = []
+        while True:
+            tag = self._CLOSE if self._inside else self._OPEN
+            i = buf.find(tag)
+            if i < 0:
+                break
+            if not self._inside:
+                out.append(buf[:i])
+            buf = buf[i + len(tag):]
+            self._inside = not self._inside
+        # Giữ lại phần đuôi có thể là đầu của thẻ tiếp theo
+        keep = next((k for k in range(min(len(tag), len(buf)), 0, -1) if tag.startswith(buf[-k:])), 0)
+        if not self._inside:
+            out.append(buf[:len(buf) - keep])
+        self._buf = buf[len(buf) - keep:]
+        return self._visible("".join(out))
+
+    def finish(self) -> str:
+        rest = "" if self._inside else self._buf
+        self._buf = ""
+        return self._visible(rest)
+
+    def _visible(self, text: str) -> str:
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        return text
+
+
+async def complete(
+        messages: list[dict],
+        profile: ModelProfile = DEFAULT_PROFILE,
+        max_tokens: int | None = None,
+) -> tuple[str, list[str]]:
+    """Một lượt gọi Perplexity không stream với ``messages`` dựng sẵn (không đọc lịch sử, không cache).
+
+    Returns:
+        Tuple (answer, citations), đã bỏ khối ``<think>``.
+
+    Raises:
+        Lỗi mạng/HTTP/breaker/deadline sau khi hết retry, ``KeyError``/``IndexError`` nếu
+        phản hồi sai định dạng — caller chuyển thành thông báo bằng ``error_message``.
+    """
+    payload = {
+        "model": profile.name,
+        "messages": messages,
+    }
+    if max_tokens:
+        payload["max_tokens"] = max_tokens
+    logger.info("Gửi request Perplexity | model=%s | messages=%d", profile.name, len(messages))
+
+    started = time.monotonic()
+    data = await _post_with_retry(payload, profile.timeout_factor)
+    try:
+        content = data["choices"][0]["message"]["content"]
+    except (KeyError, IndexError):
+        logger.error("Perplexity phản hồi sai định dạng | data: %s", data)
+        raise
+    think = _ThinkFilter()
+    answer = think.feed(content) + think.finish()
+    citations: list[str] = data.get("citations", [])
+    record_usage(profile.name, data.get("usage"), time.monotonic() - started)
+    logger.info("Perplexity OK | model=%s | citations=%d", profile.name, len(citations))
+    return answer, citations
+
+
+async def stream_completion(
+        messages: list[dict],
+        profile: ModelProfile = DEFAULT_PROFILE,
+) -> AsyncIterator[tuple[str, list[str]]]:
+    """Như ``complete`` nhưng nhận câu trả lời dạng stream (SSE).
+
+    Yields:
+        Tuple (delta, citations) — đoạn văn bản mới và danh sách trích dẫn tính đến lúc đó.
+        Stream rỗng thì không yield gì.
+
+    Raises:
+        Như ``complete``; lỗi giữa chừng được raise sau các delta đã yield.
+    """
+    payload = {
+        "model": profile.name,
+        "messages": messages,
+        "stream": True,
+    }
+    logger.info("Gửi request Perplexity (stream) | model=%s | messages=%d", profile.name, len(messages))
+
+    citations: list[str] = []
+    chars = 0
+    usage: dict | None = None
+    think = _ThinkFilter()
+    started = time.monotonic()
+    response = await _open_stream_with_retry(payload, profile.timeout_factor)
+    try:
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            citations = chunk.get("citations") or citations
+            usage = chunk.get("usage") or usage
+            choices = chunk.get("choices") or []
+            if not choices:
+                continue
+            delta = think.feed((choices[0].get("delta") or {}).get("content") or "")
+            if delta:
+                if not chars:
+                    STAGE_SECONDS.observe(time.monotonic() - started, stage="api_first_token")
+                chars += len(delta)
+                yield delta, citations
+    finally:
+        await _close_stream(response)
+    tail = think.finish()
+    if tail:
+        chars += len(tail)
+        yield tail, citations
+    if not chars:
+        return
+
+    latency = time.monotonic() - started
+    STAGE_SECONDS.observe(latency, stage="api_call")
+    record_usage(profile.name, usage, latency)
+    logger.info(
+        "Perplexity stream OK | model=%s | chars=%d | citations=%d",
+        profile.name, chars, len(citations),
+    )
 
 
 async def ask_perplexity(
-        user_id: int, current_message: str
+        user_id: int,
+        current_message: str,
+        session_id: int | None = None,
+        profile: ModelProfile = DEFAULT_PROFILE,
 ) -> tuple[str, list[str]]:
     """Gửi câu hỏi đến Perplexity API kèm lịch sử chat gần nhất.
 
     Args:
         user_id: Telegram user ID để tra cứu lịch sử.
         current_message: Tin nhắn hiện tại của người dùng.
+        session_id: Session lấy context (mặc định: session đang dùng của user).
+        profile: Model do ``router.route`` chọn (quyết định timeout và ngân sách context).
 
     Returns:
         Tuple (answer, citations):
             - answer: Chuỗi trả lời từ AI.
             - citations: Danh sách URL trích dẫn (có thể rỗng).
     """
-    # Lấy lịch sử gần nhất, sau đó sanitize để đảm bảo xen kẽ user/assistant
-    raw_history = await get_recent_messages(user_id, limit=CONTEXT_LIMIT)
+    with STAGE_SECONDS.time(stage="history_fetch"):
+        messages = await _build_messages(
+            user_id, current_message, session_id, int(CONTEXT_TOKEN_BUDGET * profile.context_factor)
+        )
+    cache_key = make_key(profile.name, messages)
+    cached = await answer_cache.get(cache_key)
+    if cached is not None:
+        logger.info("Perplexity cache hit | %s", answer_cache.stats())
+        return cached
+
+    try:
+        with STAGE_SECONDS.time(stage="api_call"):
+            answer, citations = await complete(messages, profile)
+    except Exception as e:
+        return error_message(e), []
+    await answer_cache.put(cache_key, answer, citations)
+    return answer, citations
+
+
+async def stream_perplexity(
+        user_id: int,
+        current_message: str,
+        session_id: int | None = None,
+        profile: ModelProfile = DEFAULT_PROFILE,
+) -> AsyncIterator[tuple[str, list[str]]]:
+    """Giống ``ask_perplexity`` nhưng nhận câu trả lời dạng stream (SSE).
+
+    Yields:
+        Tuple (delta, citations):
+            - delta: Đoạn văn bản mới nhận được (nối lại theo thứ tự để có câu trả lời).
+            - citations: Danh sách URL trích dẫn tính đến thời điểm hiện tại.
+
+    Lỗi không được raise ra ngoài: thông báo lỗi được yield như một delta cuối cùng,
+    tương tự cách ``ask_perplexity`` trả về chuỗi lỗi.
+    """
+    with STAGE_SECONDS.time(stage="history_fetch"):
+        messages = await _build_messages(
+            user_id, current_message, session_id, int(CONTEXT_TOKEN_BUDGET * profile.context_factor)
+        )
+    cache_key = make_key(profile.name, messages)
+    cached = await answer_cache.get(cache_key)
+    if cached is not None:
+        logger.info("Perplexity cache hit | %s", answer_cache.stats())
+        yield cached
+        return
+
+    citations: list[str] = []
+    chunks: list[str] = []
+    try:
+        # aclosing: trả slot ``_api_slots`` ngay cả khi caller ngừng đọc giữa chừng
+        async with contextlib.aclosing(stream_completion(messages, profile)) as stream:
+            async for delta, citations in stream:
+                chunks.append(delta)
+                yield delta, citations
+    except Exception as e:
+        message = error_message(e)
+        # Lỗi giữa chừng: giữ phần đã nhận, nối thông báo lỗi vào cuối
+        yield (f"\n\n{message}" if chunks else message), citations
+        return
+
+    if not chunks:
+        logger.error("Perplexity stream rỗng")
+        yield "Phản hồi từ API không đúng định dạng mong đợi.", citations
+        return
+
+    await answer_cache.put(cache_key, "".join(chunks), citations)
+
+
+async def _build_messages(
+        user_id: int,
+        current_message: str,
+        session_id: int | None = None,
+        token_budget: int = CONTEXT_TOKEN_BUDGET,
+) -> list[dict]:
+    """Xây dựng danh sách messages theo format OpenAI-compatible.
+
+    Chỉ đọc lịch sử của một session (mặc định session đang dùng). Lịch sử gần nhất
+    được xếp vào ``token_budget`` theo ``token_count`` đã lưu trong DB; phần cũ hơn
+    được đại diện bởi bản tóm tắt cuốn chiếu trong system prompt. Khi có tin nhắn vừa rơi khỏi ngân sách mà chưa được tóm tắt, bản tóm tắt được cập
+    nhật ở nền — request hiện tại không phải chờ.
+    """
+    if session_id is None:
+        session_id = await get_active_session(user_id)
+    summary = await get_summary(session_id) if CONTEXT_SUMMARY else None
+    budget = token_budget - (summary["token_count"] if summary else 0)
+    raw_history, overflow_id = await get_context_messages(
+        session_id,
+        max(0, budget),
+        after_id=summary["through_id"] if summary else 0,
+        max_messages=CONTEXT_MAX_MESSAGES,
+    )
+    # Sanitize để đảm bảo xen kẽ user/assistant
     history = _sanitize_history(raw_history)
 
-    # Xây dựng danh sách messages theo format OpenAI-compatible
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    system = SYSTEM_PROMPT
+    if summary:
+        system += "\n\n" + SUMMARY_CONTEXT_PREFIX + summary["summary"]
+    messages = [{"role": "system", "content": system}]
     for msg in history:
         messages.append({"role": msg["role"], "content": msg["content"]})
     messages.append({"role": "user", "content": current_message})
 
-    payload = {
-        "model": MODEL,
-        "messages": messages,
-    }
-    headers = {
-        "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }
-    logger.info("Number of messages in context: %d", len(messages))
-    logger.info("Gửi request Perplexity | model=%s | messages=%d", MODEL, len(messages))
+    logger.info(
+        "Context | session=%d | messages=%d | history_tokens≈%d | summary=%s",
+        session_id, len(history), sum(m["token_count"] for m in history), summary is not None,
+    )
+    if CONTEXT_SUMMARY and overflow_id is not None:
+        _schedule_summary(session_id, summary, overflow_id)
+    return messages
+
+
+def _schedule_summary(session_id: int, summary: dict | None, through_id: int) -> None:
+    """Chạy nền một lần cập nhật tóm tắt cho session, nếu chưa có lần nào đang chạy."""
+    if session_id in _summary_tasks:
+        return
+    task = asyncio.create_task(_refresh_summary(session_id, summary, through_id))
+    _summary_tasks[session_id] = task
+    task.add_done_callback(lambda _: _summary_tasks.pop(session_id, None))
 
+
+async def _refresh_summary(session_id: int, summary: dict | None, through_id: int) -> None:
+    """Gộp các tin nhắn ``(summary.through_id, through_id]`` vào bản tóm tắt hiện có.
+
+    Mỗi lần gộp tối đa ``SUMMARY_BATCH_MESSAGES`` tin; phần còn lại được gộp ở các
+    câu hỏi sau. Lỗi chỉ được ghi log — context khi đó đơn giản là thiếu phần cũ.
+    """
+    after_id = summary["through_id"] if summary else 0
     try:
-        # Chạy requests (sync) trong thread pool để không block event loop
-        def _call_api() -> dict:
-            response = requests.post(
-                PERPLEXITY_API_URL,
-                headers=headers,
-                json=payload,
-                timeout=30,
-            )
-            response.raise_for_status()
-            return response.json()
+        rows = await get_messages_range(session_id, after_id, through_id, SUMMARY_BATCH_MESSAGES)
+        if not rows:
+            return
+        transcript = "\n\n".join(
+            f"{'Người dùng' if row['role'] == 'user' else 'Trợ lý'}: "
+            f"{row['content'][:_SUMMARY_MESSAGE_CHARS]}"
+            for row in rows
+        )
+        payload = {
+            "model": SUMMARY_MODEL,
+            "max_tokens": SUMMARY_MAX_TOKENS,
+            "messages": [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": SUMMARY_REQUEST.format(
+                    summary=summary["summary"] if summary else "(chưa có)",
+                    transcript=transcript,
+                )},
+            ],
+        }
+        started = time.monotonic()
+        data = await _post_with_retry(payload)
+        record_usage(SUMMARY_MODEL, data.get("usage"), time.monotonic() - started)
+        # Model tìm kiếm có thể chèn chỉ số trích dẫn [1], [2]... — vô nghĩa trong tóm tắt
+        text = re.sub(r" ?\[\d+\]", "", data["choices"][0]["message"]["content"]).strip()
+        if not text:
+            return
+        await save_summary(session_id, text, rows[-1]["id"])
+        logger.info(
+            "Đã cập nhật tóm tắt | session=%d | through_id=%d | messages=%d",
+            session_id, rows[-1]["id"], len(rows),
+        )
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning("Cập nhật tóm tắt thất bại | session=%d | %s: %s", session_id, type(e).__name__, e)
 
-        data = await asyncio.to_thread(_call_api)
 
-        answer: str = data["choices"][0]["message"]["content"]
-        citations: list[str] = data.get("citations", [])
-        logger.info("Perplexity OK | citations=%d", len(citations))
-        return answer, citations
+def error_message(e: Exception) -> str:
+    """Ghi log và chuyển exception khi gọi API thành thông báo thân thiện."""
+    ERRORS.inc(type=type(e).__name__)
+    if isinstance(e, CircuitOpenError):
+        logger.error("Perplexity circuit open | %s", breaker.snapshot())
+        return (
+            "Perplexity đang gặp sự cố, bot tạm ngừng gửi yêu cầu. "
+            f"Vui lòng thử lại sau khoảng {max(1, round(e.retry_in))} giây."
+        )
 
-    except requests.exceptions.Timeout:
+    if isinstance(e, (httpx.TimeoutException, asyncio.TimeoutError, DeadlineExceeded)):
         logger.error("Perplexity timeout")
-        return "Yêu cầu bị timeout. Vui lòng thử lại sau.", []
+        return "Yêu cầu bị timeout. Vui lòng thử lại sau."
 
-    except requests.exceptions.HTTPError as e:
-        status = e.response.status_code if e.response is not None else "?"
-        body = e.response.text if e.response is not None else ""
+    if isinstance(e, httpx.HTTPStatusError):
+        status = e.response.status_code
+        body = e.response.text
         logger.error("Perplexity HTTPError %s | body: %s", status, body)
         if status == 401:
-            return "Lỗi xác thực: PERPLEXITY_API_KEY không hợp lệ.", []
+            return "Lỗi xác thực: PERPLEXITY_API_KEY không hợp lệ."
         if status == 429:
-            return "Đã vượt quá giới hạn request. Vui lòng thử lại sau ít phút.", []
-        return f"Perplexity API trả về lỗi HTTP {status}.", []
+            return "Đã vượt quá giới hạn request. Vui lòng thử lại sau ít phút."
+        return f"Perplexity API trả về lỗi HTTP {status}."
 
-    except (KeyError, IndexError) as e:
-        logger.error("Perplexity parse error: %s | data: %s", e, data)
-        return "Phản hồi từ API không đúng định dạng mong đợi.", []
+    if isinstance(e, (json.JSONDecodeError, KeyError, IndexError)):
+        logger.error("Perplexity parse error: %s", e)
+        return "Phản hồi từ API không đúng định dạng mong đợi."
 
-    except Exception as e:
-        logger.error("Perplexity unknown error: %s", e, exc_info=True)
-        return f"Đã xảy ra lỗi khi gọi API: {e}", []
+    logger.error("Perplexity unknown error: %s", e, exc_info=True)
+    return f"Đã xảy ra lỗi khi gọi API: {e}"
 
 
 def _sanitize_history(history: list[dict]) -> list[dict]:
@@ -1,4 +1,40 @@
 SYSTEM_PROMPT = (
     "Bạn là trợ lý nghiên cứu bằng tiếng Việt. "
     "Trả lời ngắn gọn, súc tích, định dạng dễ đọc."
-)
\ No newline at end of file
+)
+# Tiền tố gắn bản tóm tắt cuốn chiếu vào system prompt
+SUMMARY_CONTEXT_PREFIX = "Tóm tắt phần hội thoại trước đó với người dùng:\n"
+
+SUMMARY_PROMPT = (
+    "Bạn tóm tắt hội thoại giữa người dùng và trợ lý để dùng làm ngữ cảnh cho các câu hỏi sau. "
+    "Giữ lại chủ đề, sự kiện, số liệu, tên riêng, quyết định và sở thích của người dùng; "
+    "bỏ lời chào, lặp lại và trích dẫn nguồn. Viết bằng tiếng Việt, tối đa 150 từ, "
+    "không tìm kiếm thêm thông tin, chỉ trả về bản tóm tắt."
+)
+
+SUMMARY_REQUEST = (
+    "Bản tóm tắt hiện có:\n{summary}\n\n"
+    "Các tin nhắn mới cần gộp vào:\n{transcript}\n\n"
+    "Viết lại bản tóm tắt đã cập nhật."
+)
+
+# /deep: tách câu hỏi thành các truy vấn con độc lập để tìm kiếm song song
+DECOMPOSE_PROMPT = (
+    "Bạn tách một câu hỏi phức tạp thành các truy vấn tìm kiếm con độc lập, mỗi truy vấn "
+    "tự đủ nghĩa và có thể tìm kiếm riêng (vd. mỗi đối tượng cần so sánh một truy vấn). "
+    "Không tìm kiếm, không trả lời câu hỏi. Chỉ trả về một mảng JSON các chuỗi, tối đa {limit} phần tử."
+)
+
+# /deep: gộp các câu trả lời con thành một câu trả lời
+SYNTHESIS_PROMPT = (
+    "Bạn là trợ lý nghiên cứu bằng tiếng Việt. Viết câu trả lời cuối cùng cho câu hỏi của "
+    "người dùng chỉ dựa trên các kết quả nghiên cứu được cung cấp: so sánh, đối chiếu, nêu "
+    "điểm giống và khác, kết luận ngắn gọn. Giữ nguyên các chỉ số trích dẫn [n] đã có, không "
+    "thêm trích dẫn mới, không tìm kiếm thêm."
+)
+
+SYNTHESIS_REQUEST = (
+    "Câu hỏi: {question}\n\n"
+    "Kết quả nghiên cứu:\n\n{findings}\n\n"
+    "Viết câu trả lời tổng hợp."
+)
@@ -0,0 +1,82 @@
+import logging
+import time
+
+from telegram import Bot, ReplyParameters
+from telegram.error import TelegramError
+
+from access import get_user, refund_request
+from config import settings
+from database import finish_requests, get_pending_requests, mark_request_attempt
+from metrics import RECOVERED
+from scheduler import Job
+from utils import scheduler
+
+logger = logging.getLogger(__name__)
+
+# Câu hỏi dở dang nhận trong vòng RECOVERY_MAX_AGE giây được trả lời lại khi khởi động;
+# cũ hơn thì chỉ báo cho user gửi lại. 0: không bao giờ tự gọi lại Perplexity
+RECOVERY_MAX_AGE = settings.recovery_max_age
+# Số lần khởi động tối đa một câu hỏi được xử lý lại (tránh vòng lặp nếu chính nó làm bot dừng)
+_MAX_ATTEMPTS = 2
+
+_REISSUE_TEXT = "Bot vừa khởi động lại trước khi trả lời xong — đang trả lời lại câu hỏi này."
+_NOTIFY_TEXT = "Bot đã khởi động lại trước khi trả lời câu hỏi này. Vui lòng gửi lại nếu bạn vẫn cần câu trả lời."
+
+
+async def _notify(bot: Bot, request: dict, text: str) -> None:
+    try:
+        await bot.send_message(
+            request["chat_id"],
+            text,
+            reply_parameters=ReplyParameters(request["message_id"], allow_sending_without_reply=True),
+        )
+    except TelegramError as e:
+        # User đã chặn bot, chat bị xoá...: vẫn coi như đã xử lý để không lặp lại mỗi lần khởi động
+        logger.warning("Không báo được cho user %d về câu hỏi dở dang: %s", request["telegram_user_id"], e)
+
+
+async def recover_pending(bot: Bot) -> dict:
+    """Xử lý các câu hỏi đã nhận nhưng chưa trả lời xong ở lần chạy trước. Gọi trong ``post_init``.
+
+    Câu hỏi còn mới (≤ ``RECOVERY_MAX_AGE`` giây) và chưa thử quá ``_MAX_ATTEMPTS``
+    lần được xếp lại vào scheduler theo đúng thứ tự nhận; câu hỏi khác chỉ được báo
+    cho user. Câu hỏi của user không còn trong danh sách được phép bị bỏ qua.
+
+    Returns:
+        Số câu hỏi theo cách xử lý: reissued, notified, skipped.
+    """
+    report = {"reissued": 0, "notified": 0, "skipped": 0}
+    requests = await get_pending_requests()
+    if not requests:
+        return report
+
+    now = time.time()
+    for request in requests:
+        user_id = request["telegram_user_id"]
+        if get_user(user_id) is None:
+            await finish_requests([request["update_id"]], now)
+            report["skipped"] += 1
+            continue
+        reissue = request["attempts"] < _MAX_ATTEMPTS and now - request["created_at"] <= RECOVERY_MAX_AGE
+        if reissue:
+            await mark_request_attempt(request["update_id"])
+            # Không kiểm tra lại rate limit / hạn mức: câu hỏi đã được tính khi nhận lần đầu
+            job = Job(bot, user_id, request["chat_id"], request["text"], [request["update_id"]], request["mode"])
+            status, _ = scheduler.submit(user_id, job)
+            reissue = status != "dropped"
+        if reissue:
+            await _notify(bot, request, _REISSUE_TEXT)
+        else:
+            await _notify(bot, request, _NOTIFY_TEXT)
+            # User được yêu cầu gửi lại: trả lượt hạn mức đã tính cho câu hỏi chưa được trả lời
+            await refund_request(user_id, time.strftime("%Y-%m-%d", time.localtime(request["created_at"])))
+            await finish_requests([request["update_id"]], now)
+        action = "reissued" if reissue else "notified"
+        report[action] += 1
+        RECOVERED.inc(action=action)
+
+    logger.info(
+        "Khôi phục câu hỏi dở dang: %d trả lời lại, %d báo user gửi lại, %d bỏ qua",
+        report["reissued"], report["notified"], report["skipped"],
+    )
+    return report
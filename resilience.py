@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, TypeVar
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Breaker đang mở: không gửi request, trả lỗi ngay."""
+
+    def __init__(self, retry_in: float):
+        super().__init__(f"circuit open, retry in {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+
+class DeadlineExceeded(Exception):
+    """Hết ngân sách thời gian của một yêu cầu trước khi có kết quả."""
+
+
+class Deadline:
+    """Ngân sách thời gian cho một câu hỏi, dùng chung cho mọi lần retry."""
+
+    def __init__(self, budget: float):
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+
+class CircuitBreaker:
+    """Circuit breaker ba trạng thái cho upstream.
+
+    - closed: cho request đi qua, đếm lỗi liên tiếp;
+    - open: sau ``failure_threshold`` lỗi liên tiếp, từ chối ngay trong ``reset_timeout`` giây;
+    - half_open: hết thời gian chờ, cho đúng một request thử; thành công thì đóng lại,
+      thất bại thì mở tiếp.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._trial_in_flight = False
+
+    def before_call(self) -> None:
+        """Raise ``CircuitOpenError`` nếu request không được phép đi qua."""
+        if self.state == STATE_OPEN:
+            waited = time.monotonic() - self.opened_at
+            if waited < self.reset_timeout:
+                self.rejected += 1
+                raise CircuitOpenError(self.reset_timeout - waited)
+            self._transition(STATE_HALF_OPEN)
+        if self.state == STATE_HALF_OPEN:
+            if self._trial_in_flight:
+                self.rejected += 1
+                raise CircuitOpenError(0)
+            self._trial_in_flight = True
+
+    def record_success(self) -> None:
+        self._trial_in_flight = False
+        self.consecutive_failures = 0
+        if self.state != STATE_CLOSED:
+            self._transition(STATE_CLOSED)
+
+    def record_failure(self) -> None:
+        self._trial_in_flight = False
+        self.consecutive_failures += 1
+        if self.state == STATE_HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self.times_opened += 1
+            self._transition(STATE_OPEN)
+
+    def release(self) -> None:
+        """Kết thúc một request không được tính là thành công hay thất bại (vd. lỗi 4xx)."""
+        self._trial_in_flight = False
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+    def _transition(self, state: str) -> None:
+        logger.warning("Circuit breaker %s: %s → %s", self.name, self.state, state)
+        self.state = state
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """Retry có giới hạn với exponential backoff + full jitter."""
+
+    max_attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 8.0
+
+    def backoff(self, attempt: int) -> float:
+        """Thời gian chờ trước lần thử thứ ``attempt + 1`` (attempt bắt đầu từ 1)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+@dataclass
+class RetryStats:
+    calls: int = 0
+    attempts: int = 0
+    retries: int = 0
+    gave_up: int = 0
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Đọc header ``Retry-After`` (số giây hoặc HTTP-date) thành số giây cần chờ."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def is_retryable(exc: Exception) -> bool:
+    """Timeout, lỗi kết nối, 429 và 5xx đáng để thử lại; các lỗi 4xx khác thì không."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(exc, (httpx.TimeoutException, httpx.TransportError))
+
+
+def _counts_as_outage(exc: Exception) -> bool:
+    """Lỗi cho thấy upstream đang có sự cố (429 chỉ là rate limit, không tính).
+
+    ``asyncio.TimeoutError`` là ``wait_for`` theo deadline bên trong ``attempt_fn`` hết
+    giờ: upstream nhận kết nối nhưng không trả lời, cũng là sự cố.
+    """
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, (httpx.TimeoutException, httpx.TransportError, asyncio.TimeoutError))
+
+
+async def call_with_retry(
+        attempt_fn: Callable[[float], Awaitable[T]],
+        *,
+        policy: RetryPolicy,
+        breaker: CircuitBreaker,
+        deadline: Deadline,
+        stats: RetryStats,
+) -> T:
+    """Gọi ``attempt_fn(timeout)`` với retry, breaker và deadline chung.
+
+    ``attempt_fn`` nhận số giây còn lại của deadline để giới hạn timeout của chính nó.
+    Lỗi cuối cùng (hoặc ``CircuitOpenError`` / ``DeadlineExceeded``) được raise ra ngoài.
+    """
+    stats.calls += 1
+    attempt = 0
+    while True:
+        attempt += 1
+        remaining = deadline.remaining()
+        if remaining <= 0:
+            stats.gave_up += 1
+            raise DeadlineExceeded()
+        breaker.before_call()
+        stats.attempts += 1
+        try:
+            result = await attempt_fn(remaining)
+        except Exception as e:
+            if _counts_as_outage(e):
+                breaker.record_failure()
+            else:
+                breaker.release()
+            if not is_retryable(e) or attempt >= policy.max_attempts:
+                stats.gave_up += 1
+                raise
+
+            delay = policy.backoff(attempt)
+            if isinstance(e, httpx.HTTPStatusError):
+                retry_after = parse_retry_after(e.response.headers.get("Retry-After"))
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+            if delay >= deadline.remaining():
+                stats.gave_up += 1
+                raise
+            stats.retries += 1
+            logger.warning(
+                "%s lỗi (%s), thử lại lần %d sau %.2fs",
+                breaker.name, type(e).__name__, attempt + 1, delay,
+            )
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            # Bị huỷ (deadline, shutdown...): không tính thành công hay thất bại, nhưng phải
+            # trả lại lượt thử half-open, nếu không breaker kẹt ở half_open mãi
+            breaker.release()
+            raise
+        breaker.record_success()
+        return result
@@ -0,0 +1,183 @@
+import logging
+import re
+import unicodedata
+from dataclasses import dataclass
+
+from config import settings
+from metrics import API_SECONDS, COST_USD, TOKENS
+
+logger = logging.getLogger(__name__)
+
+# Ngưỡng số từ để đẩy câu hỏi lên model nặng hơn
+ROUTER_PRO_WORDS = settings.router_pro_words
+ROUTER_REASONING_WORDS = settings.router_reasoning_words
+
+
+@dataclass(frozen=True)
+class ModelProfile:
+    """Cấu hình một model Perplexity.
+
+    ``timeout_factor`` và ``context_factor`` nhân với timeout/deadline và ngân sách
+    context mặc định của ``perplexity_client``. Giá (USD) là giá tham khảo để ước
+    lượng chi phí, chỉnh theo bảng giá hiện hành.
+    """
+
+    name: str
+    alias: str
+    timeout_factor: float
+    context_factor: float
+    input_price: float  # USD / 1M token prompt
+    output_price: float  # USD / 1M token trả lời
+    request_price: float  # USD / request (phí tìm kiếm)
+
+
+SONAR = ModelProfile("sonar", "fast", 1.0, 1.0, 1.0, 1.0, 0.005)
+SONAR_PRO = ModelProfile("sonar-pro", "pro", 2.0, 2.0, 3.0, 15.0, 0.006)
+SONAR_REASONING_PRO = ModelProfile("sonar-reasoning-pro", "reason", 3.0, 3.0, 2.0, 8.0, 0.006)
+
+PROFILES: dict[str, ModelProfile] = {p.name: p for p in (SONAR, SONAR_PRO, SONAR_REASONING_PRO)}
+ALIASES: dict[str, ModelProfile] = {p.alias: p for p in PROFILES.values()}
+DEFAULT_PROFILE = SONAR
+
+# Tiền tố trong tin nhắn để chọn model cho riêng câu hỏi đó, vd. "!pro so sánh A và B"
+_PREFIX_RE = re.compile(r"^\s*!(fast|pro|reason)\b\s*", re.IGNORECASE)
+
+# Từ khoá gợi ý câu hỏi cần phân tích / lập luận (so khớp trên văn bản đã casefold).
+# So khớp trọn từ ("why" không khớp trong "whyte"); từ khoá kết thúc bằng "*" là gốc từ
+# và khớp mọi từ bắt đầu bằng nó ("analy*": analyse, analysis, analytics...)
+_ANALYSIS_KEYWORDS = (
+    "phân tích", "so sánh", "đánh giá", "ưu nhược", "ưu điểm", "nhược điểm", "tại sao",
+    "vì sao", "giải thích", "nghiên cứu", "tổng quan", "khác nhau", "chiến lược",
+    "kế hoạch", "đề xuất", "compar*", "analy*", "evaluat*", "explain*", "why", "pros and cons",
+    "trade-off*", "tradeoff*", "research*", "overview*",
+)
+_REASONING_KEYWORDS = (
+    "chứng minh", "từng bước", "suy luận", "lập luận", "tính toán", "thiết kế", "tối ưu",
+    "prove", "step by step", "reason", "reasoning", "derive", "design*", "optimi*",
+)
+
+
+def _keyword_re(keywords: tuple[str, ...]) -> re.Pattern:
+    parts = (re.escape(k[:-1]) + r"\w*" if k.endswith("*") else re.escape(k) + r"(?!\w)" for k in keywords)
+    return re.compile(r"(?<!\w)(?:" + "|".join(parts) + ")")
+
+
+_ANALYSIS_RE = _keyword_re(_ANALYSIS_KEYWORDS)
+_REASONING_RE = _keyword_re(_REASONING_KEYWORDS)
+
+# Model người dùng chọn qua /model (chỉ giữ trong bộ nhớ, mất khi restart)
+_overrides: dict[int, ModelProfile] = {}
+
+
+@dataclass(frozen=True)
+class Route:
+    profile: ModelProfile
+    text: str  # câu hỏi sau khi bỏ tiền tố chọn model
+    reason: str
+
+
+def set_override(user_id: int, alias: str) -> ModelProfile | None:
+    """Ghim model cho user (``fast``/``pro``/``reason`` hoặc tên model); ``auto`` để bỏ ghim."""
+    alias = alias.lower()
+    if alias == "auto":
+        _overrides.pop(user_id, None)
+        return None
+    profile = ALIASES.get(alias) or PROFILES.get(alias)
+    if profile is None:
+        raise ValueError(alias)
+    _overrides[user_id] = profile
+    return profile
+
+
+def get_override(user_id: int) -> ModelProfile | None:
+    return _overrides.get(user_id)
+
+
+def classify(text: str) -> tuple[ModelProfile, str]:
+    """Chọn model bằng heuristic rẻ: độ dài, số câu hỏi, từ khoá phân tích/lập luận."""
+    folded = unicodedata.normalize("NFC", text).casefold()
+    words = len(folded.split())
+    questions = folded.count("?")
+    analysis_match = _ANALYSIS_RE.search(folded)
+    reasoning_match = _REASONING_RE.search(folded)
+    analysis = analysis_match.group() if analysis_match else None
+    reasoning = reasoning_match.group() if reasoning_match else None
+
+    if words >= ROUTER_REASONING_WORDS or (reasoning and (analysis or words >= ROUTER_PRO_WORDS)):
+        return SONAR_REASONING_PRO, f"words={words} reasoning={reasoning!r} analysis={analysis!r}"
+    if words >= ROUTER_PRO_WORDS or analysis or reasoning or questions >= 2:
+        return SONAR_PRO, f"words={words} questions={questions} analysis={analysis!r} reasoning={reasoning!r}"
+    return SONAR, f"words={words} questions={questions}"
+
+
+def route(user_id: int, text: str) -> Route:
+    """Chọn model cho một câu hỏi: tiền tố ``!fast``/``!pro``/``!reason`` > /model > heuristic."""
+    match = _PREFIX_RE.match(text)
+    if match and match.end() < len(text):
+        decision = Route(ALIASES[match.group(1).lower()], text[match.end():], "prefix")
+    elif user_id in _overrides:
+        decision = Route(_overrides[user_id], text, "override")
+    else:
+        profile, reason = classify(text)
+        decision = Route(profile, text, reason)
+    logger.info("Route | user_id=%d | model=%s | %s", user_id, decision.profile.name, decision.reason)
+    return decision
+
+
+@dataclass
+class ModelStats:
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost_usd: float = 0.0
+    latency_total: float = 0.0
+    latency_max: float = 0.0
+
+
+_stats: dict[str, ModelStats] = {}
+
+
+def record_usage(model: str, usage: dict | None, latency: float) -> float:
+    """Cộng dồn token, chi phí ước lượng và độ trễ của một request; trả về chi phí (USD)."""
+    profile = PROFILES.get(model)
+    usage = usage or {}
+    prompt_tokens = int(usage.get("prompt_tokens") or 0)
+    completion_tokens = int(usage.get("completion_tokens") or 0)
+    cost = 0.0
+    if profile is not None:
+        cost = (
+                profile.request_price
+                + prompt_tokens * profile.input_price / 1e6
+                + completion_tokens * profile.output_price / 1e6
+        )
+    stats = _stats.setdefault(model, ModelStats())
+    stats.requests += 1
+    stats.prompt_tokens += prompt_tokens
+    stats.completion_tokens += completion_tokens
+    stats.cost_usd += cost
+    stats.latency_total += latency
+    stats.latency_max = max(stats.latency_max, latency)
+    API_SECONDS.observe(latency, model=model)
+    TOKENS.inc(prompt_tokens, model=model, kind="prompt")
+    TOKENS.inc(completion_tokens, model=model, kind="completion")
+    COST_USD.inc(cost, model=model)
+    logger.info(
+        "Usage | model=%s | latency=%.2fs | prompt_tokens=%d | completion_tokens=%d | cost≈$%.5f",
+        model, latency, prompt_tokens, completion_tokens, cost,
+    )
+    return cost
+
+
+def usage_snapshot() -> dict[str, dict]:
+    """Tổng hợp theo model: số request, token, chi phí ước lượng, độ trễ trung bình/tối đa."""
+    return {
+        model: {
+            "requests": s.requests,
+            "prompt_tokens": s.prompt_tokens,
+            "completion_tokens": s.completion_tokens,
+            "cost_usd": round(s.cost_usd, 5),
+            "latency_avg": round(s.latency_total / s.requests, 3) if s.requests else 0.0,
+            "latency_max": round(s.latency_max, 3),
+        }
+        for model, s in _stats.items()
+    }
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from telegram import Bot
+
+from metrics import ERRORS
+
+logger = logging.getLogger(__name__)
+
+POLICY_DROP = "drop"
+POLICY_MERGE = "merge"
+
+# Cách trả lời một câu hỏi: chat thường, hoặc /deep (tách truy vấn, gọi song song, tổng hợp)
+MODE_CHAT = "chat"
+MODE_DEEP = "deep"
+
+
+@dataclass
+class Job:
+    """Một câu hỏi cần trả lời.
+
+    Chỉ giữ dữ liệu thuần (không giữ ``Update``) để dựng lại được từ
+    ``pending_requests`` khi khôi phục sau khởi động lại. ``update_ids`` là các
+    update đã gộp vào job này; tất cả được đánh dấu xong cùng lúc.
+    """
+    bot: Bot
+    user_id: int
+    chat_id: int
+    text: str
+    update_ids: list[int] = field(default_factory=list)
+    mode: str = MODE_CHAT
+
+
+class UserScheduler:
+    """Xử lý tin nhắn tuần tự theo từng user.
+
+    Mỗi user có một hàng đợi riêng và tối đa một worker đang chạy, nên lịch sử
+    đọc cho câu hỏi sau luôn đã chứa câu trả lời của câu hỏi trước. Worker được
+    tạo khi có việc và tự kết thúc khi hàng đợi rỗng.
+
+    Khi hàng đợi đầy (``max_queue`` job đang chờ):
+      - ``drop``: từ chối tin nhắn mới;
+      - ``merge``: gộp tin nhắn mới vào job cuối cùng đang chờ (cùng ``mode``;
+        khác ``mode`` thì từ chối như ``drop``).
+    """
+
+    def __init__(
+            self,
+            process: Callable[[Job], Awaitable[None]],
+            max_queue: int = 3,
+            policy: str = POLICY_MERGE,
+    ):
+        if policy not in (POLICY_DROP, POLICY_MERGE):
+            raise ValueError(f"USER_QUEUE_POLICY không hợp lệ: {policy!r}")
+        self._process = process
+        self.max_queue = max_queue
+        self.policy = policy
+        self._queues: dict[int, deque[Job]] = {}
+        self._workers: dict[int, asyncio.Task] = {}
+
+    def submit(self, user_id: int, job: Job) -> tuple[str, int]:
+        """Đưa một câu hỏi vào hàng đợi của user.
+
+        Returns:
+            Tuple (status, position):
+                - status: "started", "queued", "merged" hoặc "dropped".
+                - position: số job đứng trước (0 nếu được xử lý ngay).
+        """
+        queue = self._queues.setdefault(user_id, deque())
+        if user_id not in self._workers:
+            self._workers[user_id] = asyncio.create_task(self._run(user_id, job))
+            return "started", 0
+
+        position = len(queue) + 1  # +1: job đang chạy
+        if len(queue) >= self.max_queue:
+            if self.policy == POLICY_MERGE and queue and queue[-1].mode == job.mode:
+                queue[-1].text = f"{queue[-1].text}\n\n{job.text}"
+                queue[-1].update_ids.extend(job.update_ids)
+                return "merged", position - 1
+            return "dropped", position
+
+        queue.append(job)
+        return "queued", position
+
+    def depth(self) -> int:
+        """Tổng số job đang chờ (không tính job đang chạy) của mọi user."""
+        return sum(len(q) for q in self._queues.values())
+
+    def in_flight(self) -> int:
+        """Số user đang có job chạy."""
+        return len(self._workers)
+
+    async def drain(self, timeout: float) -> bool:
+        """Chờ mọi job đang chạy và đang chờ hoàn tất, tối đa ``timeout`` giây.
+
+        Hết thời gian thì huỷ phần còn lại như ``close``.
+
+        Returns:
+            True nếu mọi job đã xong trước khi hết giờ.
+        """
+        workers = list(self._workers.values())
+        if not workers:
+            return True
+        logger.info("Đang chờ %d user xử lý xong (%d câu hỏi đang chờ)", len(workers), self.depth())
+        _, pending = await asyncio.wait(workers, timeout=timeout)
+        if pending:
+            logger.warning("Hết %.0fs chờ, huỷ %d worker còn lại", timeout, len(pending))
+            await self.close()
+            return False
+        return True
+
+    async def close(self) -> None:
+        """Huỷ mọi worker và bỏ các job đang chờ. Gọi khi bot dừng.
+
+        Câu hỏi bị bỏ vẫn ở trạng thái pending trong database và được khôi phục
+        ở lần khởi động sau (xem ``recovery``).
+        """
+        workers = list(self._workers.values())
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._queues.clear()
+
+    async def _run(self, user_id: int, job: Job) -> None:
+        queue = self._queues[user_id]
+        try:
+            while True:
+                try:
+                    await self._process(job)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    ERRORS.inc(type=type(e).__name__)
+                    logger.exception("Lỗi khi xử lý tin nhắn của user_id=%d", user_id)
+                if not queue:
+                    break
+                job = queue.popleft()
+        finally:
+            del self._workers[user_id]
+            if not queue:
+                self._queues.pop(user_id, None)
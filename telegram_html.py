@@ -0,0 +1,398 @@
+import html
+import re
+
+# Đoạn chữ không chứa ký tự mở đầu token inline (* ` [ __) và không xuống dòng
+_PLAIN_SPAN = r"(?:[^*`\[\n_]++|_(?!_))++"
+
+# Một regex duy nhất (compile một lần) cho mọi token: block ở đầu dòng và inline.
+# Token block bắt đầu bằng chính ký tự newline đứng trước dòng (thay vì ``^``), và mọi
+# nhánh ở mức ngoài cùng mở đầu bằng một ký tự cố định, nằm *ngoài* group có tên: chỉ
+# khi đó ``re`` mới dựng được tập ký tự đầu (\n ` [ * _) để bỏ qua rất nhanh phần văn
+# bản thường, vốn chỉ cần escape theo khối. Group có tên bao ngoài các group con nên
+# ``lastgroup`` vẫn là loại token.
+_TOKEN_RE = re.compile(
+    r"\n(?:(?P<fence>[ \t]*```[ \t]*(?P<lang>[\w+#.-]*)[ \t]*$)"
+    r"|#{1,6}[ \t]+(?:(?P<title>[^*`\[_\n]*+)$|(?P<heading>))"
+    r"|(?P<bullet>(?P<indent>[ \t]*)[-*+][ \t]+))"
+    r"|`(?:``(?P<code3>(?P<c3>[^\n]+?))```|(?P<code>(?P<c1>[^`\n]+))`)"
+    # URL được chứa cặp ngoặc cân bằng, vd. https://en.wikipedia.org/wiki/Mercury_(planet)
+    r"|\[(?P<link>(?P<label>[^\]\n]+)\]\((?P<url>https?://(?:[^\s()]|\([^\s()]*\))+)\))"
+    # Cặp marker không chứa token nào khác ("**x**", "*x*", "__x__") được khớp trọn
+    # trong một lần tìm; còn lại đi qua stack từng marker một
+    rf"|\*(?:\*(?=[^\s*])(?P<bold>{_PLAIN_SPAN})(?<=\S)\*\*(?!\*)"
+    r"|(?P<triple>\*\*)|(?P<strong>\*)"
+    rf"|(?=[^\s*])(?P<italic>{_PLAIN_SPAN})(?<=\S)\*(?!\*)"
+    r"|(?P<em>))"
+    rf"|_(?:_(?=[^\s_])(?P<ubold>{_PLAIN_SPAN})(?<=\S)__(?!_)|(?P<under>_))",
+    re.MULTILINE,
+)
+_MARKER_KINDS = frozenset({"strong", "em", "under", "triple", "bold", "italic", "ubold"})
+_FENCE_CLOSE_RE = re.compile(r"^[ \t]*```[ \t]*$", re.MULTILINE)
+
+
+def _escape(text: str) -> str:
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+
+class MarkdownRenderer:
+    """Chuyển Markdown (Perplexity trả về) sang HTML hợp lệ cho Telegram trong một lượt.
+
+    Hỗ trợ code fence, inline code, bold/italic, heading, link và danh sách.
+    Cặp ``**``/``*`` được ghép bằng một stack trong phạm vi một dòng; marker
+    không có cặp (hoặc bị cắt chéo bởi marker khác) được giữ nguyên dạng chữ,
+    nên tag luôn cân bằng.
+
+    Có thể nạp dần qua ``feed`` (phù hợp với output đang stream); ``peek`` trả về
+    bản render tạm của phần chưa hoàn chỉnh mà không thay đổi trạng thái,
+    ``finish`` kết thúc và đóng code block còn mở.
+    """
+
+    def __init__(self) -> None:
+        self._pending = ""  # dòng cuối chưa có ký tự xuống dòng
+        self._in_fence = False
+        self._code_sep = ""  # newline bị hoãn trong code block (bỏ newline cuối trước fence đóng)
+
+    def feed(self, text: str) -> str:
+        """Nạp thêm văn bản; trả về HTML của các dòng đã hoàn chỉnh."""
+        self._pending += text
+        cut = self._pending.rfind("\n")
+        if cut == -1:
+            return ""
+        complete, self._pending = self._pending[:cut + 1], self._pending[cut + 1:]
+        return self._render(complete)
+
+    def peek(self) -> str:
+        """HTML của phần còn lại nếu văn bản kết thúc ngay bây giờ (không đổi trạng thái)."""
+        state = self._in_fence, self._code_sep
+        try:
+            return self._render_tail()
+        finally:
+            self._in_fence, self._code_sep = state
+
+    def finish(self) -> str:
+        """Render phần còn lại và đóng code block đang mở."""
+        out = self._render_tail()
+        self._pending = ""
+        return out
+
+    def _render_tail(self) -> str:
+        out = self._render(self._pending) if self._pending else ""
+        if self._in_fence:
+            out += "</code></pre>"
+            self._in_fence = False
+        return out
+
+    def _render(self, text: str) -> str:
+        # Escape cả khối một lần trước khi tìm token: không token nào chứa & < >, nên
+        # vị trí và cách khớp không đổi. Thêm newline ở đầu để token block của dòng đầu
+        # tiên cũng khớp được
+        text = "\n" + _escape(text)
+        out: list[str] = []
+        n = len(text)
+        if self._in_fence:
+            pos = self._consume_code(text, 1, out)
+            skip = 0
+        else:
+            pos = 0
+            skip = 1  # bỏ newline đã thêm khỏi output
+        stack: list[tuple[str, int]] = []  # (marker, vị trí placeholder trong out)
+        heading = False
+        # Hàm hay dùng gán vào biến local: vòng lặp chạy một lần cho mỗi token
+        finditer = _TOKEN_RE.finditer
+        find = text.find
+        append = out.append
+        # Cuối dòng đang có heading hoặc marker mở; chỉ tính khi trạng thái đó bắt đầu
+        line_end = n
+        # Tạo lại iterator khi ``pos`` nhảy khỏi chỗ regex dừng (sau code block, hoặc khi
+        # chỉ dùng một phần của token)
+        tokens = finditer(text, pos)
+
+        while True:
+            m = next(tokens, None)
+            start = m.start() if m else n
+
+            # Văn bản thường tới token kế tiếp được escape theo khối; vượt qua newline
+            # nghĩa là dòng có heading/marker mở đã kết thúc
+            if (heading or stack) and line_end <= start:
+                if heading:
+                    append(text[pos:line_end])
+                    append("</b>")
+                    heading = False
+                    pos = line_end
+                stack.clear()  # marker chưa đóng của dòng trước giữ dạng chữ
+
+            if pos < start:
+                append(text[pos:start])
+            if m is None:
+                if heading:
+                    append("</b>")
+                break
+            pos = m.end()
+            kind = m.lastgroup
+
+            # Marker in đậm/nghiêng là token hay gặp nhất nên được xét trước
+            if kind in _MARKER_KINDS:
+                if kind == "bold" or kind == "ubold" or kind == "italic":
+                    marker = "*" if kind == "italic" else text[start:start + 2]
+                    # Cặp trọn vẹn chỉ dùng được khi không có marker cùng loại đang mở
+                    # (marker đầu khi đó sẽ đóng marker đang mở); ngược lại xử lý như marker lẻ
+                    if not stack or not any(opened == marker for opened, _ in stack):
+                        if kind == "italic":
+                            append(f"<i>{m.group(kind)}</i>")
+                        elif heading:
+                            append(m.group(kind))  # Heading đã in đậm
+                        else:
+                            append(f"<b>{m.group(kind)}</b>")
+                        continue
+                    kind = "em" if kind == "italic" else "strong"
+                    pos = start + len(marker)
+                    tokens = finditer(text, pos)
+                else:
+                    marker = m.group()
+                before = text[start - 1]  # start ≥ 1: text luôn mở đầu bằng "\n"
+                if kind == "triple":
+                    # "***": đóng cả hai nếu hai marker mở trên cùng là "*" và "**" (theo
+                    # thứ tự lồng nhau); ngược lại coi như "**" rồi "*" ở token kế tiếp
+                    if (
+                            len(stack) >= 2 and not before.isspace() and not heading
+                            and {stack[-1][0], stack[-2][0]} == {"*", "**"}
+                    ):
+                        for opener_marker, at in (stack.pop(), stack.pop()):
+                            tag = "i" if opener_marker == "*" else "b"
+                            out[at] = f"<{tag}>"
+                            append(f"</{tag}>")
+                        continue
+                    marker = "**"
+                    pos = start + 2
+                    tokens = finditer(text, pos)
+                tag = "i" if kind == "em" else "b"
+                if tag == "b" and heading:
+                    continue  # Heading đã in đậm — bỏ marker để không lồng <b> trong <b>
+
+                after = text[pos] if pos < n else " "
+                opener = None
+                for i in range(len(stack) - 1, -1, -1):
+                    if stack[i][0] == marker:
+                        opener = i
+                        break
+
+                if opener is not None and not before.isspace():
+                    # Đóng cặp; các marker mở phía trên bị bỏ lại ở dạng chữ
+                    out[stack[opener][1]] = f"<{tag}>"
+                    del stack[opener:]
+                    append(f"</{tag}>")
+                else:
+                    if not after.isspace():
+                        if not stack and not heading:
+                            line_end = find("\n", pos)
+                            if line_end == -1:
+                                line_end = n
+                        stack.append((marker, len(out)))
+                    append(marker)
+            elif kind == "fence":
+                lang = m.group("lang")
+                append(f'\n<pre><code class="language-{lang}">' if lang else "\n<pre><code>")
+                self._in_fence = True
+                self._code_sep = ""
+                if pos < n:
+                    pos += 1  # newline sau dòng mở fence
+                pos = self._consume_code(text, pos, out)
+                tokens = finditer(text, pos)
+            elif kind == "title":
+                append(f"\n<b>{m.group(kind)}</b>")  # heading không có token inline nào
+            elif kind == "heading":
+                append("\n<b>")
+                heading = True
+                line_end = find("\n", pos)
+                if line_end == -1:
+                    line_end = n
+            elif kind == "bullet":
+                append(f"\n{m.group('indent')}• ")
+            elif kind == "code3" or kind == "code":
+                append(f"<code>{m.group('c3') if kind == 'code3' else m.group('c1')}</code>")
+            elif kind == "link":
+                # & < > đã được escape cùng cả khối, chỉ còn dấu nháy trong thuộc tính
+                url = m.group("url").replace('"', "&quot;").replace("'", "&#x27;")
+                append(f'<a href="{url}">{m.group("label")}</a>')
+        return "".join(out)[skip:]
+
+    def _consume_code(self, text: str, pos: int, out: list[str]) -> int:
+        """Chép nguyên khối nội dung code block (đã escape), trả về vị trí sau fence đóng (nếu có)."""
+        close = _FENCE_CLOSE_RE.search(text, pos)
+        body = text[pos:close.start() if close else len(text)]
+        if body:
+            # Newline cuối được hoãn lại: nếu ngay sau đó là fence đóng thì bỏ hẳn
+            trailing_newline = body.endswith("\n")
+            if trailing_newline:
+                body = body[:-1]
+            out.append(self._code_sep + body)
+            self._code_sep = "\n" if trailing_newline else ""
+        if close is None:
+            return len(text)
+        out.append("</code></pre>")
+        self._in_fence = False
+        return close.end()
+
+
+def render_markdown(text: str) -> str:
+    """Render toàn bộ một đoạn Markdown sang HTML cho Telegram."""
+    renderer = MarkdownRenderer()
+    return renderer.feed(text) + renderer.finish()
+
+
+# Tag và entity trong HTML đã render; phần còn lại giữa chúng là văn bản thường
+_HTML_TOKEN_RE = re.compile(
+    r"<(?P<close>/?)(?P<name>[a-zA-Z][a-zA-Z0-9-]*)[^>]*>"
+    r"|&(?:#\d+|#x[0-9a-fA-F]+|[a-zA-Z]+);"
+)
+_BREAKS = ("\n\n", "\n", " ")  # thứ tự ưu tiên điểm cắt
+
+
+def utf16_len(text: str) -> int:
+    """Độ dài theo UTF-16 code unit — đơn vị Telegram dùng để đo giới hạn tin nhắn."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _utf16_prefix(text: str, units: int) -> str:
+    """Phần đầu dài nhất của ``text`` có độ dài UTF-16 ≤ ``units`` (không cắt đôi surrogate pair)."""
+    encoded = text.encode("utf-16-le")
+    if len(encoded) == 2 * len(text):
+        return text[:units]
+    head = encoded[:2 * units]
+    if head and 0xD8 <= head[-1] <= 0xDB:
+        head = head[:-2]  # high surrogate không có cặp
+    return head.decode("utf-16-le")
+
+
+def _tokenize_html(text: str) -> list[tuple[str, str]]:
+    """Tách HTML thành (loại, nguyên văn) với loại là "open", "close", "entity" hoặc "text"."""
+    tokens: list[tuple[str, str]] = []
+    pos = 0
+    for m in _HTML_TOKEN_RE.finditer(text):
+        if m.start() > pos:
+            tokens.append(("text", text[pos:m.start()]))
+        if m.group("name"):
+            tokens.append(("close" if m.group("close") else "open", m.group()))
+        else:
+            tokens.append(("entity", m.group()))
+        pos = m.end()
+    if pos < len(text):
+        tokens.append(("text", text[pos:]))
+    return tokens
+
+
+def _tag_name(raw: str) -> str:
+    return _HTML_TOKEN_RE.match(raw).group("name").lower()
+
+
+def split_html(text: str, limit: int) -> list[str]:
+    """Cắt HTML (output của ``MarkdownRenderer``) thành các phần ≤ ``limit`` ký tự hiển thị.
+
+    - Độ dài đo như Telegram: sau khi bỏ tag, entity tính là một ký tự, đếm theo
+      UTF-16 code unit.
+    - Ưu tiên cắt tại dòng trống, sau đó tại xuống dòng, tại khoảng trắng, cuối cùng
+      mới cắt cứng.
+    - Tag đang mở tại điểm cắt được đóng ở cuối phần trước và mở lại (giữ nguyên
+      thuộc tính) ở đầu phần sau, nên mỗi phần đều là HTML hợp lệ.
+
+    Duyệt một lượt theo token (tag, entity, đoạn văn bản); điểm cắt được tìm bằng
+    ``rfind`` lùi trong phần đang dựng, và chỉ phần nằm sau điểm cắt (ít hơn một
+    phần) được duyệt lại.
+    """
+    if utf16_len(text) <= limit:
+        return [text]
+
+    tokens = _tokenize_html(text)
+    tokens.reverse()  # dùng như stack: pop() lấy token kế tiếp, append() để trả lại
+
+    parts: list[str] = []
+    # Token của phần đang dựng: (loại, nguyên văn, các tag đang mở trước token, độ dài trước token)
+    cur: list[tuple[str, str, tuple[str, ...], int]] = []
+    stack: list[str] = []  # nguyên văn các tag đang mở
+    size = 0
+
+    def emit(body: list[str], open_tags: tuple[str, ...]) -> None:
+        chunk = "".join(body).rstrip("\n")
+        closers = "".join(f"</{_tag_name(raw)}>" for raw in reversed(open_tags))
+        parts.append(chunk + closers)
+
+    def restart(open_tags: tuple[str, ...], rest: list[tuple[str, str]]) -> None:
+        nonlocal size
+        # Trả lại phần sau điểm cắt, đứng sau các tag được mở lại
+        tokens.extend(reversed(rest))
+        tokens.extend(("open", raw) for raw in reversed(open_tags))
+        cur.clear()
+        stack.clear()
+        size = 0
+
+    def cut_at_break(tail: str) -> bool:
+        """Cắt tại điểm ngắt tốt nhất trong ``cur`` + ``tail``; False nếu không có."""
+        for sep in _BREAKS:
+            at = tail.rfind(sep)
+            if at > 0 or (at == 0 and size > 0):
+                emit([item[1] for item in cur] + [tail[:at]], tuple(stack))
+                restart(tuple(stack), [("text", tail[at + len(sep):])])
+                return True
+            for idx in range(len(cur) - 1, -1, -1):
+                kind, raw, open_tags, before = cur[idx]
+                at = raw.rfind(sep) if kind == "text" else -1
+                if at == -1 or (at == 0 and before == 0):
+                    continue
+                emit([item[1] for item in cur[:idx]] + [raw[:at]], open_tags)
+                rest = [("text", raw[at + len(sep):])] + [(item[0], item[1]) for item in cur[idx + 1:]]
+                if tail:
+                    rest.append(("text", tail))
+                restart(open_tags, rest)
+                return True
+        return False
+
+    while tokens:
+        kind, raw = tokens.pop()
+
+        if kind == "open":
+            cur.append((kind, raw, tuple(stack), size))
+            stack.append(raw)
+            continue
+        if kind == "close":
+            name = _tag_name(raw)
+            for i in range(len(stack) - 1, -1, -1):
+                if _tag_name(stack[i]) == name:
+                    del stack[i:]
+                    break
+            cur.append((kind, raw, tuple(stack), size))
+            continue
+
+        if kind == "text" and size == 0:
+            raw = raw.lstrip("\n")  # bỏ newline ở đầu phần, giống strip()
+            if not raw:
+                continue
+
+        units = utf16_len(html.unescape(raw)) if kind == "entity" else utf16_len(raw)
+        if size + units <= limit:
+            cur.append((kind, raw, tuple(stack), size))
+            size += units
+            continue
+
+        # Vượt giới hạn: lấy phần vừa với giới hạn của token hiện tại, trả lại phần dư
+        head = _utf16_prefix(raw, limit - size) if kind == "text" else ""
+        if not head and size == 0:
+            # Token đơn lẻ dài hơn cả limit (entity, ký tự ngoài BMP khi limit = 1)
+            head = raw if kind == "entity" else raw[0]
+        if raw[len(head):]:
+            tokens.append((kind, raw[len(head):]))
+        if cut_at_break(head):
+            continue
+
+        # Không có điểm ngắt: cắt cứng
+        emit([item[1] for item in cur] + [head], tuple(stack))
+        restart(tuple(stack), [])
+
+    if size:
+        emit([item[1] for item in cur], tuple(stack))
+    return parts
@@ -0,0 +1,52 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import access  # noqa: E402
+import database  # noqa: E402
+
+
+@pytest.fixture
+def quota_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    monkeypatch.setattr(database, "DB_WRITE_BEHIND", False)
+    monkeypatch.setattr(access, "DAILY_QUOTA", 2)
+    monkeypatch.setattr(access, "RATE_LIMIT_PER_MINUTE", 0)
+    access._daily.clear()
+    yield
+    access._daily.clear()
+
+
+def test_concurrent_requests_cannot_exceed_quota(quota_db):
+    async def scenario():
+        await database.init_db()
+        try:
+            results = await asyncio.gather(*(access.check_request(7) for _ in range(5)))
+            assert sum(r is None for r in results) == 2
+            # Bộ đếm trong bộ nhớ bị xoá (vd. khởi động lại): database vẫn chặn
+            access._daily.clear()
+            assert await access.check_request(7) is not None
+        finally:
+            await database.close_db()
+
+    asyncio.run(scenario())
+
+
+def test_refund_returns_quota(quota_db):
+    async def scenario():
+        await database.init_db()
+        try:
+            assert await access.check_request(7) is None
+            assert await access.check_request(7) is None
+            assert await access.check_request(7) is not None
+            await access.refund_request(7)
+            assert await access.check_request(7) is None
+            assert await access.check_request(7) is not None
+        finally:
+            await database.close_db()
+
+    asyncio.run(scenario())
@@ -0,0 +1,76 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import database  # noqa: E402
+
+
+@pytest.fixture
+def write_behind_db(tmp_path, monkeypatch):
+    """Database tạm với write-behind bật; timer đủ ngắn để chạy trong lúc test giữ writer lock."""
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "test.db"))
+    monkeypatch.setattr(database, "DB_WRITE_BEHIND", True)
+    monkeypatch.setattr(database, "DB_FLUSH_INTERVAL_MS", 10)
+    monkeypatch.setattr(database, "DB_FLUSH_MAX_ROWS", 1000)
+    yield
+    database._active_sessions.clear()
+
+
+def test_read_waits_for_in_flight_flush(write_behind_db):
+    async def scenario():
+        await database.init_db()
+        try:
+            session_id = await database.get_active_session(1)
+            pool = database._get_pool()
+            async with pool.write_lock:
+                await database.add_turn(1, "hỏi", "đáp", session_id=session_id)
+                await asyncio.sleep(0.05)  # timer flush đã lấy row ra khỏi buffer, đang chờ lock
+                assert len(database._write_behind) == 0
+                read = asyncio.create_task(database.get_context_messages(session_id, 10_000))
+                await asyncio.sleep(0.05)
+                assert not read.done()  # lần đọc phải chờ lượt flush đang dở
+            messages, _ = await read
+            assert [m["content"] for m in messages] == ["hỏi", "đáp"]
+        finally:
+            await database.close_db()
+
+    asyncio.run(scenario())
+
+
+def test_failed_flush_keeps_order(write_behind_db, monkeypatch):
+    async def scenario():
+        await database.init_db()
+        try:
+            session_id = await database.get_active_session(1)
+            buffer = database._write_behind
+            real_write = database._write_messages
+            calls = 0
+            second: list[asyncio.Task] = []
+
+            async def flaky_write(db, rows):
+                nonlocal calls
+                calls += 1
+                if calls == 1:
+                    # Lượt hỏi khác đến và được flush trong lúc lượt đầu đang ghi, rồi lượt đầu lỗi
+                    await database.add_turn(1, "q2", "a2", session_id=session_id)
+                    second.append(asyncio.create_task(buffer.flush()))
+                    await asyncio.sleep(0)
+                    raise RuntimeError("disk full")
+                await real_write(db, rows)
+
+            monkeypatch.setattr(database, "_write_messages", flaky_write)
+            await database.add_turn(1, "q1", "a1", session_id=session_id)
+            with pytest.raises(RuntimeError):
+                await buffer.flush()
+            await second[0]
+            await buffer.flush()
+            messages, _ = await database.get_context_messages(session_id, 10_000)
+            assert [m["content"] for m in messages] == ["q1", "a1", "q2", "a2"]
+        finally:
+            await database.close_db()
+
+    asyncio.run(scenario())
@@ -0,0 +1,112 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import httpx
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from resilience import (  # noqa: E402
+    STATE_CLOSED,
+    STATE_HALF_OPEN,
+    STATE_OPEN,
+    CircuitBreaker,
+    Deadline,
+    RetryPolicy,
+    RetryStats,
+    call_with_retry,
+)
+
+
+def _half_open_breaker() -> CircuitBreaker:
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0.0)
+    breaker.record_failure()  # mở ngay, reset_timeout=0 nên lần gọi sau là lượt thử half-open
+    return breaker
+
+
+async def _call(breaker: CircuitBreaker, attempt_fn):
+    return await call_with_retry(
+        attempt_fn,
+        policy=RetryPolicy(max_attempts=1),
+        breaker=breaker,
+        deadline=Deadline(5.0),
+        stats=RetryStats(),
+    )
+
+
+def test_cancelled_half_open_trial_releases_breaker():
+    async def scenario():
+        breaker = _half_open_breaker()
+        started = asyncio.Event()
+
+        async def hang(timeout: float) -> str:
+            started.set()
+            await asyncio.sleep(60)
+            return "never"
+
+        task = asyncio.create_task(_call(breaker, hang))
+        await started.wait()
+        assert breaker.state == STATE_HALF_OPEN
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        async def ok(timeout: float) -> str:
+            return "ok"
+
+        # Lượt thử bị huỷ không được giữ chỗ: lần gọi tiếp theo vẫn đi qua và đóng breaker
+        assert await _call(breaker, ok) == "ok"
+        assert breaker.state == STATE_CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_timed_out_half_open_trial_releases_breaker():
+    async def scenario():
+        breaker = _half_open_breaker()
+
+        async def hang(timeout: float) -> str:
+            await asyncio.sleep(60)
+            return "never"
+
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(_call(breaker, hang), 0.05)
+
+        async def ok(timeout: float) -> str:
+            return "ok"
+
+        assert await _call(breaker, ok) == "ok"
+
+    asyncio.run(scenario())
+
+
+def test_failed_half_open_trial_reopens_breaker():
+    async def scenario():
+        breaker = _half_open_breaker()
+        request = httpx.Request("POST", "http://upstream")
+
+        async def fail(timeout: float) -> str:
+            raise httpx.ConnectError("down", request=request)
+
+        with pytest.raises(httpx.ConnectError):
+            await _call(breaker, fail)
+        assert breaker.times_opened == 2
+
+    asyncio.run(scenario())
+
+
+def test_attempt_timeout_counts_as_outage():
+    async def scenario():
+        breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=60.0)
+
+        async def silent(timeout: float) -> str:
+            # Như perplexity_client: wait_for theo deadline còn lại, upstream không trả lời
+            return await asyncio.wait_for(asyncio.sleep(60), 0.01)
+
+        for _ in range(2):
+            with pytest.raises(asyncio.TimeoutError):
+                await _call(breaker, silent)
+        assert breaker.state == STATE_OPEN
+
+    asyncio.run(scenario())
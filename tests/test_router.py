@@ -0,0 +1,43 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from router import SONAR, SONAR_PRO, SONAR_REASONING_PRO, classify, route  # noqa: E402
+
+
+def test_reason_prefix_picks_reasoning_model():
+    decision = route(1, "!reason giá vàng hôm nay")
+    assert decision.profile is SONAR_REASONING_PRO
+    assert decision.text == "giá vàng hôm nay"
+
+
+def test_deep_is_not_a_model_prefix():
+    # /deep là chế độ tìm song song; "!deep" không còn chọn model
+    decision = route(1, "!deep giá vàng hôm nay")
+    assert decision.reason != "prefix"
+    assert decision.text == "!deep giá vàng hôm nay"
+
+
+@pytest.mark.parametrize("text", [
+    "Whyte Horse ở đâu",  # "why"
+    "cách improve tiếng Anh",  # "prove"
+    "reasonable price laptop",  # "reason"
+    "giá vé máy bay hôm nay",
+])
+def test_keywords_do_not_match_inside_words(text):
+    profile, _ = classify(text)
+    assert profile is SONAR
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("why is the sky blue", SONAR_PRO),
+    ("analysis of the market", SONAR_PRO),  # gốc từ "analy*"
+    ("Tại sao trời xanh", SONAR_PRO),
+    ("so sánh và chứng minh công thức", SONAR_REASONING_PRO),
+])
+def test_keywords_match_whole_words(text, expected):
+    profile, _ = classify(text)
+    assert profile is expected
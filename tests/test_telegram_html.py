@@ -0,0 +1,136 @@
+import html
+import random
+import re
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from telegram_html import MarkdownRenderer, render_markdown, split_html  # noqa: E402
+
+# Property-based test kiểu "tự sinh": markup lồng nhau ngẫu nhiên với seed cố định,
+# để lỗi nào cũng tái hiện được bằng seed in trong thông báo assert.
+_TAG_RE = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^>]*>")
+_WORDS = ["alpha", "beta", "gamma", "tiếng", "Việt", "đường", "xin", "chào", "x" * 25, "😀", "𝄞𝄞", "👍🏽", "a😀b"]
+_ENTITIES = ["&amp;", "&lt;", "&gt;", "&quot;", "&#39;", "&#x1F600;"]
+_SEPARATORS = [" ", " ", " ", "\n", "\n\n", ""]
+
+
+def _random_text(rng: random.Random) -> str:
+    parts = []
+    for _ in range(rng.randint(1, 8)):
+        parts.append(rng.choice(_ENTITIES) if rng.random() < 0.15 else rng.choice(_WORDS))
+        parts.append(rng.choice(_SEPARATORS))
+    return "".join(parts)
+
+
+def _random_markup(rng: random.Random, depth: int = 0) -> str:
+    out = []
+    for _ in range(rng.randint(1, 4)):
+        roll = rng.random()
+        if depth >= 3 or roll < 0.4:
+            out.append(_random_text(rng))
+        elif roll < 0.55:
+            out.append(f"<b>{_random_markup(rng, depth + 1)}</b>")
+        elif roll < 0.7:
+            out.append(f"<i>{_random_markup(rng, depth + 1)}</i>")
+        elif roll < 0.8:
+            out.append(f'<a href="https://example.com/{rng.randint(1, 99)}?a=1&amp;b=2">{_random_markup(rng, depth + 1)}</a>')
+        elif roll < 0.9:
+            out.append(f"<code>{_random_text(rng)}</code>")
+        else:
+            lang = rng.choice(["", ' class="language-python"'])
+            out.append(f"<pre><code{lang}>{_random_text(rng)}\n{_random_text(rng)}</code></pre>")
+    return "".join(out)
+
+
+def _utf16_units(text: str) -> int:
+    # Tự đếm, không dùng telegram_html.utf16_len: test không được dựa vào chính hàm cần kiểm tra
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _visible(chunk: str) -> str:
+    """Văn bản hiển thị: bỏ tag, giải entity (như Telegram khi parse_mode=HTML)."""
+    return html.unescape(_TAG_RE.sub("", chunk))
+
+
+def _assert_balanced(chunk: str, context: str) -> None:
+    stack = []
+    for m in _TAG_RE.finditer(chunk):
+        name = m.group(2).lower()
+        if m.group(1):
+            assert stack and stack[-1] == name, f"{context}: </{name}> không khớp trong {chunk!r}"
+            stack.pop()
+        else:
+            stack.append(name)
+    assert not stack, f"{context}: tag chưa đóng {stack} trong {chunk!r}"
+
+
+@pytest.mark.parametrize("seed", range(500))
+def test_split_html_random_markup(seed):
+    rng = random.Random(seed)
+    text = _random_markup(rng)
+    limit = rng.choice([2, 3, 5, 8, 13, 40, 100])
+    chunks = split_html(text, limit)
+    context = f"seed={seed} limit={limit}"
+
+    for chunk in chunks:
+        _assert_balanced(chunk, context)
+        assert _utf16_units(_visible(chunk)) <= limit, f"{context}: phần quá dài {chunk!r}"
+
+    # Điểm cắt chỉ được bỏ khoảng trắng/xuống dòng tại chỗ cắt, không mất hay lặp chữ
+    joined = "".join(_visible(chunk) for chunk in chunks)
+    assert re.sub(r"\s+", "", joined) == re.sub(r"\s+", "", _visible(text)), context
+
+
+def test_split_html_short_text_unchanged():
+    text = "<b>xin chào</b> &amp; 😀"
+    assert split_html(text, 4096) == [text]
+
+
+def test_split_html_counts_utf16_units():
+    # 3 emoji = 6 UTF-16 unit: limit 4 phải cắt dù chỉ có 3 ký tự Python
+    chunks = split_html("😀😀😀", 4)
+    assert chunks == ["😀😀", "😀"]
+
+
+def test_split_html_reopens_tags_with_attributes():
+    text = '<a href="https://example.com">one two three</a>'
+    chunks = split_html(text, 8)
+    assert all(c.startswith('<a href="https://example.com">') and c.endswith("</a>") for c in chunks)
+    assert [_visible(c) for c in chunks] == ["one two", "three"]
+
+
+@pytest.mark.parametrize("markdown, expected", [
+    ("***x***", "<b><i>x</i></b>"),
+    ("a ***đậm nghiêng*** b", "a <b><i>đậm nghiêng</i></b> b"),
+    ("**a *b***", "<b>a <i>b</i></b>"),
+    ("*a **b***", "<i>a <b>b</b></i>"),
+    ("# Tiêu đề ***x***", "<b>Tiêu đề <i>x</i></b>"),
+])
+def test_render_triple_asterisk(markdown, expected):
+    assert render_markdown(markdown) == expected
+
+
+@pytest.mark.parametrize("markdown, expected", [
+    (
+        "xem [Mercury](https://en.wikipedia.org/wiki/Mercury_(disambiguation)) nhé",
+        'xem <a href="https://en.wikipedia.org/wiki/Mercury_(disambiguation)">Mercury</a> nhé',
+    ),
+    (
+        "[a](https://example.com/a_(b)_c(d)) (ghi chú)",
+        '<a href="https://example.com/a_(b)_c(d)">a</a> (ghi chú)',
+    ),
+    ("([a](https://example.com/x))", '(<a href="https://example.com/x">a</a>)'),
+])
+def test_render_link_with_parentheses(markdown, expected):
+    assert render_markdown(markdown) == expected
+
+
+def test_render_streamed_matches_one_shot():
+    text = "## Tổng quan\n\n***x*** và **đậm** *nghiêng* [w](https://x.org/a_(b))\n- ý `code`\n```py\nx < 1\n```\n"
+    renderer = MarkdownRenderer()
+    streamed = "".join(renderer.feed(ch) for ch in text) + renderer.finish()
+    assert streamed == render_markdown(text)
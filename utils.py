@@ -1,160 +1,79 @@
 import asyncio
+import contextlib
+import html
 import logging
 import re
-from datetime import datetime
+import time
+from typing import AsyncIterator
 
-from telegram import Update
+from telegram import Bot, Message, Update
 from telegram.constants import ChatAction
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import ContextTypes
 
-from database import add_message
-from perplexity_client import ask_perplexity
+from config import settings
+from access import check_request, log_unauthorized, refund_request
+from database import add_turn, begin_request, finish_requests, get_active_session
+from perplexity_client import ask_perplexity, stream_perplexity
+from metrics import DUPLICATE_UPDATES, IN_FLIGHT, MESSAGE_SECONDS, QUEUE_DEPTH, STAGE_SECONDS
+from router import ModelProfile, route
+from fanout import CitationIndex, SubAnswer, combine, decompose, fan_out, synthesize
+from scheduler import MODE_CHAT, MODE_DEEP, Job, UserScheduler
+from telegram_html import MarkdownRenderer, render_markdown, split_html
 
 TELEGRAM_MSG_LIMIT = 4096  # Giới hạn ký tự mỗi tin nhắn của Telegram
 
-logger = logging.getLogger(__name__)
-
-
-def _build_export_content(username: str, messages: list[dict]) -> str:
-    """Tạo nội dung file Markdown từ danh sách tin nhắn."""
-    exported_at = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-    lines: list[str] = [
-        "# Lịch sử hội thoại — Perplexity Bot",
-        f"> Người dùng : {username}",
-        f"> Xuất lúc   : {exported_at}",
-        f"> Tổng số    : {len(messages)} tin nhắn",
-        "",
-    ]
-
-    # Nhóm từng cặp user/assistant thành một "lượt"
-    i = 0
-    turn = 1
-    while i < len(messages):
-        msg = messages[i]
-        ts = _fmt_timestamp(msg["timestamp"])
-
-        if msg["role"] == "user":
-            lines += [
-                "---",
-                "",
-                f"### Lượt {turn}",
-                "",
-                f"**[{ts}] Bạn**",
-                "",
-                msg["content"],
-                "",
-            ]
-            # Kiểm tra xem tin tiếp theo có phải assistant không
-            if i + 1 < len(messages) and messages[i + 1]["role"] == "assistant":
-                i += 1
-                reply = messages[i]
-                ts_r = _fmt_timestamp(reply["timestamp"])
-                lines += [
-                    f"**[{ts_r}] Trợ lý**",
-                    "",
-                    reply["content"],
-                    "",
-                ]
-                if reply["citations"]:
-                    lines.append("**Nguồn tham khảo:**")
-                    for idx, url in enumerate(reply["citations"], 1):
-                        lines.append(f"[{idx}] {url}")
-                    lines.append("")
-            turn += 1
-        else:
-            # Tin nhắn assistant đứng riêng (không có cặp user)
-            lines += [
-                "---",
-                "",
-                f"**[{ts}] Trợ lý**",
-                "",
-                msg["content"],
-                "",
-            ]
-            if msg["citations"]:
-                lines.append("**Nguồn tham khảo:**")
-                for idx, url in enumerate(msg["citations"], 1):
-                    lines.append(f"[{idx}] {url}")
-                lines.append("")
-
-        i += 1
-
-    lines += ["---", "", "*Được tạo bởi Perplexity Telegram Bot*"]
-    return "\n".join(lines)
+# Stream câu trả lời vào tin nhắn được sửa dần (mặc định bật)
+STREAM_ANSWERS = settings.stream_answers
+# Khoảng cách tối thiểu giữa hai lần sửa tin nhắn — Telegram giới hạn ~1 edit/giây/chat
+STREAM_EDIT_INTERVAL = settings.stream_edit_interval
 
+# Số câu hỏi tối đa được chờ cho mỗi user và cách xử lý khi hàng đợi đầy (drop | merge)
+USER_QUEUE_MAX = settings.user_queue_max
+USER_QUEUE_POLICY = settings.user_queue_policy
 
-def _fmt_timestamp(ts: str) -> str:
-    """Chuyển chuỗi timestamp SQLite sang định dạng dd/mm/yyyy HH:MM."""
-    try:
-        dt = datetime.fromisoformat(ts)
-        return dt.strftime("%d/%m/%Y %H:%M")
-    except (ValueError, TypeError):
-        return ts
+logger = logging.getLogger(__name__)
 
 
 async def _handle_unauthorized(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    uid = update.effective_user.id if update.effective_user else "?"
-    logger.warning("Từ chối truy cập từ user_id=%s", uid)
+    log_unauthorized(update.effective_user.id if update.effective_user else "?")
 
 
 def md_to_html(text: str) -> str:
     """Chuyển đổi Markdown (Perplexity trả về) sang HTML hợp lệ cho Telegram.
 
-    Quy trình:
-      1. Escape ký tự HTML đặc biệt trong toàn bộ văn bản thô.
-      2. Áp dụng các pattern Markdown → HTML (thứ tự quan trọng).
+    Render một lượt bằng ``telegram_html.MarkdownRenderer``; tag luôn cân bằng.
     """
-    # --- Bước 1: Escape HTML ------------------------------------------------
-    text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-
-    # --- Bước 2: Fenced code block ```lang\ncode\n``` -----------------------
-    text = re.sub(
-        r"```(?:\w+)?\n?(.*?)```",
-        lambda m: f"<pre><code>{m.group(1).strip()}</code></pre>",
-        text,
-        flags=re.DOTALL,
-    )
-
-    # --- Bước 3: Inline code `code` -----------------------------------------
-    text = re.sub(r"`([^`\n]+)`", r"<code>\1</code>", text)
-
-    # --- Bước 4: Bold **text** hoặc __text__ --------------------------------
-    text = re.sub(r"\*\*(.+?)\*\*", r"<b>\1</b>", text, flags=re.DOTALL)
-    text = re.sub(r"__(.+?)__", r"<b>\1</b>", text, flags=re.DOTALL)
+    with STAGE_SECONDS.time(stage="render"):
+        return render_markdown(text)
+
+
+def format_citations(citations: list[str]) -> str:
+    """Tạo khối HTML liệt kê nguồn trích dẫn để nối vào cuối câu trả lời."""
+    if not citations:
+        return ""
+    lines = ["", "", "<b>Nguồn tham khảo:</b>"]
+    for idx, url in enumerate(citations, 1):
+        safe = html.escape(url)
+        lines.append(f'[{idx}] <a href="{safe}">{safe}</a>')
+    return "\n".join(lines)
 
-    # --- Bước 5: Italic *text* (đơn, không phải **) -------------------------
-    text = re.sub(r"(?<!\*)\*(?!\*)(.+?)(?<!\*)\*(?!\*)", r"<i>\1</i>", text)
 
-    # --- Bước 6: Headings # / ## / ### → in đậm + xuống dòng ---------------
-    text = re.sub(r"^#{1,3} +(.+)$", r"<b>\1</b>", text, flags=re.MULTILINE)
+def split_message(text: str, limit: int = TELEGRAM_MSG_LIMIT) -> list[str]:
+    """Cắt tin nhắn HTML dài thành nhiều phần ≤ limit ký tự, ưu tiên cắt tại dòng trống.
 
-    return text
+    Không bao giờ cắt giữa tag: tag đang mở được đóng lại và mở lại ở phần sau
+    (xem ``telegram_html.split_html``).
+    """
+    with STAGE_SECONDS.time(stage="split"):
+        return split_html(text, limit)
 
 
-def split_message(text: str, limit: int = TELEGRAM_MSG_LIMIT) -> list[str]:
-    """Cắt tin nhắn dài thành nhiều phần ≤ limit ký tự, ưu tiên cắt tại dòng trống."""
-    if len(text) <= limit:
-        return [text]
-
-    parts: list[str] = []
-    while len(text) > limit:
-        cut = text.rfind("\n\n", 0, limit)
-        if cut == -1:
-            cut = text.rfind("\n", 0, limit)
-        if cut == -1:
-            cut = limit
-        parts.append(text[:cut].strip())
-        text = text[cut:].strip()
-    if text:
-        parts.append(text)
-    return parts
-
-
-async def _keep_typing(chat, stop_event: asyncio.Event) -> None:
+async def _keep_typing(bot: Bot, chat_id: int, stop_event: asyncio.Event) -> None:
     """Gửi ChatAction.TYPING mỗi 4 giây cho đến khi stop_event được set."""
     while not stop_event.is_set():
         try:
-            await chat.send_action(ChatAction.TYPING)
+            await bot.send_chat_action(chat_id, ChatAction.TYPING)
         except Exception:
             pass  # Không để lỗi mạng nhỏ dừng vòng lặp
         try:
@@ -163,27 +82,277 @@ async def _keep_typing(chat, stop_event: asyncio.Event) -> None:
             pass
 
 
+class _StreamingReply:
+    """Hiển thị câu trả lời đang stream bằng cách sửa tin nhắn tại chỗ.
+
+    Mỗi lần ``update`` nhận toàn bộ HTML hiện có; HTML được cắt bằng
+    ``split_message`` và mỗi phần ứng với một tin nhắn Telegram. Phần đã đầy được
+    giữ nguyên, phần cuối được sửa dần; khi vượt giới hạn 4096 ký tự thì gửi
+    tin nhắn mới. Các lần sửa được giãn cách ``interval`` giây để không chạm
+    rate limit của Telegram.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, interval: float = STREAM_EDIT_INTERVAL):
+        self._bot = bot
+        self._chat_id = chat_id
+        self._interval = interval
+        self._sent: list[Message] = []
+        self._texts: list[str] = []
+        self._next_flush = 0.0
+
+    @property
+    def due(self) -> bool:
+        """Đã đến lúc được phép sửa tin nhắn tiếp theo chưa."""
+        return time.monotonic() >= self._next_flush
+
+    async def update(self, html_text: str, final: bool = False) -> None:
+        if not final and not self.due:
+            return
+        self._next_flush = time.monotonic() + self._interval
+
+        for idx, part in enumerate(split_message(html_text)):
+            if not part.strip():
+                continue
+            if idx < len(self._sent) and self._texts[idx] == part:
+                continue
+            await self._publish(idx, part, final)
+
+    async def _publish(self, idx: int, part: str, final: bool) -> None:
+        try:
+            await self._send_or_edit(idx, part, parse_mode="HTML")
+        except RetryAfter as e:
+            if not final:
+                # Bỏ qua lần cập nhật này, lùi lần kế tiếp theo yêu cầu của Telegram
+                self._next_flush = time.monotonic() + e.retry_after
+                return
+            await asyncio.sleep(e.retry_after)
+            await self._send_or_edit(idx, part, parse_mode="HTML")
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                self._texts[idx] = part
+                return
+            if not final:
+                logger.debug("Bỏ qua bản nháp stream không hợp lệ: %s", e)
+                return
+            # HTML bị Telegram từ chối: gửi bản văn bản thuần để không mất câu trả lời
+            logger.warning("Telegram từ chối HTML, gửi văn bản thuần: %s", e)
+            await self._send_or_edit(idx, html.unescape(re.sub(r"<[^>]+>", "", part)), parse_mode=None)
+
+    async def _send_or_edit(self, idx: int, text: str, parse_mode: str | None) -> None:
+        with STAGE_SECONDS.time(stage="telegram_send"):
+            if idx < len(self._sent):
+                await self._sent[idx].edit_text(text, parse_mode=parse_mode)
+                self._texts[idx] = text
+            else:
+                self._sent.append(await self._bot.send_message(self._chat_id, text, parse_mode=parse_mode))
+                self._texts.append(text)
+
+
+async def _stream_answer(
+        job: Job,
+        session_id: int,
+        profile: ModelProfile,
+        user_text: str,
+        stop_typing: asyncio.Event,
+) -> tuple[str, list[str]]:
+    """Stream câu trả lời từ Perplexity vào chat, trả về (answer, citations) đầy đủ."""
+    reply = _StreamingReply(job.bot, job.chat_id)
+    renderer = MarkdownRenderer()
+    chunks: list[str] = []
+    rendered: list[str] = []
+    citations: list[str] = []
+    async for delta, citations in stream_perplexity(job.user_id, user_text, session_id, profile):
+        # Token đầu tiên đã tới — tin nhắn thật thay cho typing indicator
+        stop_typing.set()
+        chunks.append(delta)
+        with STAGE_SECONDS.time(stage="render"):
+            rendered.append(renderer.feed(delta))
+        if reply.due:
+            with STAGE_SECONDS.time(stage="render"):
+                draft = "".join(rendered) + renderer.peek()
+            await reply.update(draft)
+
+    with STAGE_SECONDS.time(stage="render"):
+        rendered.append(renderer.finish())
+    await reply.update("".join(rendered) + format_citations(citations), final=True)
+    return "".join(chunks), citations
+
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await submit_question(update, context, update.message.text)
+
+
+async def submit_question(
+        update: Update, context: ContextTypes.DEFAULT_TYPE, user_text: str, mode: str = MODE_CHAT
+) -> None:
+    """Nhận một câu hỏi (tin nhắn thường hoặc /deep) và xếp vào hàng đợi của user."""
     user_id = update.effective_user.id
-    user_text = update.message.text
-    logger.info("Nhận tin nhắn từ user %d: %s", user_id, user_text[:80])
+    message = update.message
+    logger.info("Nhận tin nhắn từ user %d (%s): %s", user_id, mode, user_text[:80])
+
+    # Ghi nhận câu hỏi trước mọi thứ khác: sống sót qua lần dừng bot giữa chừng, và
+    # update_id làm khoá idempotency — Telegram gửi lại các update chưa được xác nhận
+    # sau khi bot khởi động lại, không được tốn thêm request Perplexity cho chúng
+    if not await begin_request(
+            update.update_id, user_id, message.chat_id, message.message_id, user_text, time.time(), mode
+    ):
+        DUPLICATE_UPDATES.inc()
+        logger.info("Bỏ qua update %d đã nhận trước đó (user %d)", update.update_id, user_id)
+        return
+
+    # Rate limit và hạn mức ngày: từ chối trước khi xếp hàng, không tốn request Perplexity
+    refusal = await check_request(user_id)
+    if refusal:
+        await finish_requests([update.update_id], time.time())
+        await message.reply_text(refusal)
+        return
+
+    # Không xử lý trực tiếp: xếp vào hàng đợi của user để giữ đúng thứ tự context
+    job = Job(context.bot, user_id, message.chat_id, user_text, [update.update_id], mode)
+    status, position = scheduler.submit(user_id, job)
+    if status == "queued":
+        await message.reply_text(
+            f"Đang trả lời câu hỏi trước — câu hỏi này ở vị trí <b>{position}</b> trong hàng đợi.",
+            parse_mode="HTML",
+        )
+    elif status == "merged":
+        await message.reply_text(
+            "Hàng đợi đã đầy — tin nhắn được gộp vào câu hỏi cuối cùng đang chờ."
+        )
+    elif status == "dropped":
+        logger.warning("Hàng đợi của user %d đầy, bỏ tin nhắn", user_id)
+        # User được yêu cầu gửi lại: câu hỏi này không được tính vào hạn mức ngày
+        await refund_request(user_id)
+        await finish_requests([update.update_id], time.time())
+        await message.reply_text(
+            "Hàng đợi đã đầy. Vui lòng chờ các câu trả lời trước rồi gửi lại."
+        )
+
+
+async def _answer_message(job: Job) -> None:
+    """Trả lời một câu hỏi đã xếp hàng rồi đánh dấu nó đã xong trong ``pending_requests``.
+
+    Bị huỷ giữa chừng (bot dừng quá ``SHUTDOWN_DRAIN_TIMEOUT``) thì câu hỏi giữ
+    trạng thái pending để được khôi phục ở lần khởi động sau. Lỗi thường không
+    được thử lại: scheduler đã ghi log, câu hỏi vẫn được đánh dấu xong.
+    """
+    with MESSAGE_SECONDS.time():
+        try:
+            await (_answer_deep(job) if job.mode == MODE_DEEP else _answer(job))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await finish_requests(job.update_ids, time.time())
+            raise
+        await finish_requests(job.update_ids, time.time())
 
-    # Bắt đầu typing indicator chạy nền
-    stop_typing = asyncio.Event()
-    typing_task = asyncio.create_task(
-        _keep_typing(update.message.chat, stop_typing)
-    )
 
+@contextlib.asynccontextmanager
+async def _typing(bot: Bot, chat_id: int) -> AsyncIterator[asyncio.Event]:
+    """Chạy typing indicator nền trong khối ``async with``; set event trả về để dừng sớm."""
+    stop_typing = asyncio.Event()
+    typing_task = asyncio.create_task(_keep_typing(bot, chat_id, stop_typing))
     try:
-        answer, citations = await ask_perplexity(user_id, user_text)
+        yield stop_typing
     finally:
+        # Huỷ thay vì chờ: khi bot dừng, không đợi một lần send_chat_action đang treo
         stop_typing.set()
-        await typing_task
+        typing_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await typing_task
+
+
+async def _send_html(job: Job, html_text: str) -> None:
+    for part in split_message(html_text):
+        with STAGE_SECONDS.time(stage="telegram_send"):
+            await job.bot.send_message(job.chat_id, part, parse_mode="HTML")
+
+
+async def _answer(job: Job) -> None:
+    """Gọi Perplexity, lưu lịch sử và gửi câu trả lời vào chat của ``job``."""
+    user_id = job.user_id
+    # Chốt session ngay từ đầu: /new trong lúc đang trả lời không làm câu trả lời lạc sang session mới
+    session_id = await get_active_session(user_id)
+    # Chọn model theo tiền tố / /model / heuristic; lưu câu hỏi đã bỏ tiền tố
+    decision = route(user_id, job.text)
+    user_text = decision.text
+
+    async with _typing(job.bot, job.chat_id) as stop_typing:
+        if STREAM_ANSWERS:
+            answer, citations = await _stream_answer(
+                job, session_id, decision.profile, user_text, stop_typing
+            )
+        else:
+            answer, citations = await ask_perplexity(user_id, user_text, session_id, decision.profile)
+
+    await add_turn(user_id, user_text, answer, citations, session_id=session_id)
+
+    if STREAM_ANSWERS:
+        return
+
+    await _send_html(job, md_to_html(answer) + format_citations(citations))
+
+
+async def _answer_deep(job: Job) -> None:
+    """/deep: tách câu hỏi thành truy vấn con, gọi song song, gửi từng phần ngay khi xong,
+    rồi stream câu trả lời tổng hợp kèm danh sách nguồn đã gộp.
+
+    Truy vấn con không kèm lịch sử hội thoại; lượt hỏi/đáp vẫn được lưu vào session
+    như câu hỏi thường. Không tách được thì trả lời như câu hỏi thường.
+    """
+    session_id = await get_active_session(job.user_id)
+    async with _typing(job.bot, job.chat_id):
+        queries, method = await decompose(job.text)
+    if len(queries) < 2:
+        logger.info("/deep: không tách được câu hỏi, trả lời như câu hỏi thường")
+        await _answer(job)
+        return
+
+    logger.info("/deep: %d truy vấn con (%s)", len(queries), method)
+    async with _typing(job.bot, job.chat_id):
+        await _send_html(job, "🔎 <b>Tìm song song:</b>\n" + "\n".join(
+            f"{i}. {html.escape(q)}" for i, q in enumerate(queries, 1)
+        ))
+
+        index = CitationIndex()
+        answers: list[SubAnswer] = []
+        started = time.monotonic()
+        # aclosing: gửi Telegram lỗi giữa chừng thì các truy vấn con còn lại bị huỷ ngay,
+        # không tiếp tục chạy ngầm và giữ slot gọi API
+        async with contextlib.aclosing(fan_out(queries)) as subs:
+            async for sub in subs:
+                if sub.ok:
+                    sub.answer = index.add(sub.answer, sub.citations)
+                    answers.append(sub)
+                # Mỗi phần được gửi ngay khi về, theo thứ tự hoàn thành
+                await _send_html(
+                    job,
+                    f"<b>[{sub.index + 1}/{len(queries)}] {html.escape(sub.query)}</b>\n\n" + md_to_html(sub.answer),
+                )
+        STAGE_SECONDS.observe(time.monotonic() - started, stage="deep_fanout")
+
+        if len(answers) >= 2:
+            reply = _StreamingReply(job.bot, job.chat_id)
+            renderer = MarkdownRenderer()
+            chunks: list[str] = []
+            rendered: list[str] = ["<b>Tổng hợp</b>\n\n"]
+            async for delta in synthesize(job.text, answers):
+                chunks.append(delta)
+                rendered.append(renderer.feed(delta))
+                if reply.due:
+                    await reply.update("".join(rendered) + renderer.peek())
+            rendered.append(renderer.finish())
+            await reply.update("".join(rendered) + format_citations(index.urls), final=True)
+            answer = "".join(chunks)
+        else:
+            # Không đủ phần để tổng hợp: các phần đã hiện trong chat, chỉ còn bảng nguồn
+            answer = combine(answers) or "Không tìm được thông tin cho câu hỏi này."
+            if index.urls:
+                await _send_html(job, format_citations(index.urls).lstrip())
 
-    await add_message(user_id, "user", user_text)
-    await add_message(user_id, "assistant", answer, citations)
+    await add_turn(job.user_id, job.text, answer, index.urls, session_id=session_id)
 
-    html_answer = md_to_html(answer)
 
-    for part in split_message(html_answer):
-        await update.message.reply_text(part, parse_mode="HTML")
+scheduler = UserScheduler(_answer_message, max_queue=USER_QUEUE_MAX, policy=USER_QUEUE_POLICY)
+QUEUE_DEPTH.set_function(scheduler.depth)
+IN_FLIGHT.set_function(scheduler.in_flight)
@@ -0,0 +1,129 @@
+import asyncio
+import hmac
+import json
+import logging
+import signal
+
+from telegram import Update
+from telegram.ext import Application
+
+from http_server import HttpServer, Request, Response
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+# Update của Telegram chỉ vài KB; chặn sớm body bất thường
+_MAX_UPDATE_BODY = 256 * 1024
+
+
+class WebhookServer:
+    """Nhận update từ Telegram qua webhook và đẩy vào ``application.update_queue``.
+
+    Chạy trên ``HttpServer`` dùng chung (``/metrics`` có thể gắn cùng cổng). Mỗi
+    request được xác thực bằng header ``X-Telegram-Bot-Api-Secret-Token`` rồi trả
+    200 ngay sau khi xếp hàng, không chờ xử lý xong; PTB xử lý các update song song
+    (``concurrent_updates``). ``GET /healthz`` trả 200 khi bot đang nhận update và
+    503 khi đang khởi động hoặc đang dừng.
+    """
+
+    def __init__(self, application: Application, host: str, port: int, path: str, secret: str):
+        self.application = application
+        self.path = path
+        self._secret = secret.encode()
+        self.accepting = False
+        self.server = HttpServer(host, port, max_body=_MAX_UPDATE_BODY)
+        self.server.route("POST", path, self._handle_update)
+        self.server.route("GET", "/healthz", self._handle_health)
+
+    async def _handle_update(self, request: Request) -> Response:
+        token = request.headers.get(SECRET_HEADER, "").encode()
+        if not hmac.compare_digest(token, self._secret):
+            logger.warning("Webhook: secret token không khớp, bỏ qua request")
+            return Response(403)
+        if not self.accepting:
+            # Telegram sẽ gửi lại update khi nhận mã lỗi
+            return Response(503)
+        try:
+            data = json.loads(request.body)
+            update = Update.de_json(data, self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning("Webhook: update không hợp lệ: %s", e)
+            return Response(400)
+        if update is None:
+            return Response(400)
+        await self.application.update_queue.put(update)
+        return Response(200)
+
+    async def _handle_health(self, request: Request) -> Response:
+        healthy = self.accepting and self.application.running
+        body = json.dumps({
+            "status": "ok" if healthy else "unavailable",
+            "mode": "webhook",
+            "pending_updates": self.application.update_queue.qsize(),
+        })
+        return Response(200 if healthy else 503, body, content_type="application/json")
+
+
+async def run_webhook(
+        application: Application,
+        *,
+        host: str,
+        port: int,
+        path: str,
+        secret: str,
+        url: str | None = None,
+        allowed_updates: list[str] | None = None,
+) -> None:
+    """Chạy bot ở chế độ webhook cho tới khi nhận SIGINT/SIGTERM.
+
+    Thay cho ``application.run_webhook`` của PTB (cần tornado): tự gọi đúng vòng đời
+    ``initialize`` → ``post_init`` → ``start`` và khi dừng ``stop`` → ``post_stop`` →
+    ``shutdown`` → ``post_shutdown``. Server ngừng nhận update trước, nên ``post_stop``
+    có thể chờ các câu hỏi đang xử lý trong khi bot vẫn gửi được tin nhắn.
+
+    ``HttpServer`` được đặt vào ``application.bot_data["http_server"]`` trước
+    ``post_init`` để các thành phần khác (metrics) gắn route vào cùng cổng.
+
+    Args:
+        url: URL công khai đăng ký với Telegram (``setWebhook``). Bỏ trống để không
+            đăng ký, vd. khi thử local bằng cách POST update JSON trực tiếp.
+    """
+    webhook = WebhookServer(application, host, port, path, secret)
+    application.bot_data["http_server"] = webhook.server
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await webhook.server.start()
+        if url:
+            await application.bot.set_webhook(
+                url=url,
+                secret_token=secret,
+                allowed_updates=allowed_updates,
+            )
+            logger.info("Đã đăng ký webhook: %s", url)
+        else:
+            logger.warning("WEBHOOK_URL trống — không gọi setWebhook, chỉ nhận update POST trực tiếp")
+        await application.start()
+        webhook.accepting = True
+        await stop.wait()
+    finally:
+        logger.info("Đang dừng webhook...")
+        webhook.accepting = False
+        # Không xoá webhook: Telegram giữ update trong lúc bot dừng và gửi lại khi chạy lại
+        await webhook.server.stop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)